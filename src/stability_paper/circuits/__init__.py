@@ -2,3 +2,6 @@ from stability_paper.circuits._surface_code_circuit import (
     surface_code_stability_experiment_circuit,
     surface_code_memory_experiment_circuit,
 )
+from stability_paper.circuits._rounds_template import (
+    RoundsTemplate,
+)
@@ -0,0 +1,67 @@
+from typing import Callable, Optional
+
+import stim
+
+from stability_paper.tools import NoiseModel
+
+ROUNDS_TEMPLATE_ROUNDS = 4
+
+
+class RoundsTemplate:
+    """An experiment circuit with its number of rounds left open.
+
+    The surface code experiment circuits are an initialization round, a REPEAT block
+    repeating the bulk round `rounds - 2` times, and a final round. The final round's
+    detectors and observable refer to measurements by their offset relative to the
+    final round, and the round before it measures the same qubits whether it's the
+    initialization round or a bulk round, so the final round is the same for every
+    number of rounds. A template keeps the (possibly noisy) pieces around the REPEAT
+    block, so each variant only requires changing the repetition count instead of
+    building and noising a whole new circuit.
+    """
+
+    def __init__(self, *, prefix: stim.Circuit, body: stim.Circuit, suffix: stim.Circuit):
+        self.prefix = prefix
+        self.body = body
+        self.suffix = suffix
+
+    @staticmethod
+    def build(constructor: Callable[..., stim.Circuit],
+              *,
+              noise: Optional[NoiseModel] = None,
+              **kwargs) -> 'RoundsTemplate':
+        """Builds a template by calling an experiment circuit constructor (and noising the result) once.
+
+        Args:
+            constructor: A function like `surface_code_memory_experiment_circuit`, taking a `rounds`
+                keyword argument.
+            noise: Noise model to apply to the circuit, or None to leave it noiseless.
+            **kwargs: The other keyword arguments to give to the constructor.
+        """
+        circuit = constructor(rounds=ROUNDS_TEMPLATE_ROUNDS, **kwargs)
+        if noise is not None:
+            circuit = noise.noisy_circuit_vectorized(circuit)
+        return RoundsTemplate.from_circuit(circuit, rounds=ROUNDS_TEMPLATE_ROUNDS)
+
+    @staticmethod
+    def from_circuit(circuit: stim.Circuit, *, rounds: int) -> 'RoundsTemplate':
+        """Splits a circuit containing a single top-level REPEAT block of `rounds - 2` repetitions."""
+        blocks = [k for k, op in enumerate(circuit) if isinstance(op, stim.CircuitRepeatBlock)]
+        if len(blocks) != 1:
+            raise ValueError(f'Expected exactly one top-level REPEAT block but found {len(blocks)}.')
+        k, = blocks
+        block = circuit[k]
+        if block.repeat_count != rounds - 2:
+            raise ValueError(f'{block.repeat_count=} != {rounds=} - 2')
+        return RoundsTemplate(prefix=circuit[:k], body=block.body_copy(), suffix=circuit[k + 1:])
+
+    def circuit(self, *, rounds: int) -> stim.Circuit:
+        if rounds < 2:
+            raise ValueError(f'{rounds=} < 2')
+        result = self.prefix.copy()
+        if rounds == 3:
+            result += self.body
+        elif rounds > 3:
+            result.append(stim.CircuitRepeatBlock(repeat_count=rounds - 2, body=self.body))
+        result += self.suffix
+        return result
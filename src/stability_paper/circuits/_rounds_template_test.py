@@ -0,0 +1,35 @@
+import pytest
+import stim
+
+from stability_paper.circuits import RoundsTemplate, surface_code_memory_experiment_circuit, \
+    surface_code_stability_experiment_circuit
+from stability_paper.tools import NoiseModel
+
+
+@pytest.mark.parametrize('constructor,basis', [
+    (surface_code_stability_experiment_circuit, 'X'),
+    (surface_code_stability_experiment_circuit, 'Z'),
+    (surface_code_memory_experiment_circuit, 'X'),
+    (surface_code_memory_experiment_circuit, 'Z'),
+])
+def test_rounds_template_matches_direct_construction(constructor, basis):
+    noise = NoiseModel.depolarizing_cz_noise(1e-3)
+    noiseless = RoundsTemplate.build(constructor, diam=4, basis=basis)
+    noisy = RoundsTemplate.build(constructor, diam=4, basis=basis, noise=noise)
+    for rounds in range(2, 7):
+        expected = constructor(diam=4, rounds=rounds, basis=basis)
+        assert noiseless.circuit(rounds=rounds) == expected
+        assert noisy.circuit(rounds=rounds) == noise.noisy_circuit(expected)
+    assert noisy.circuit(rounds=10000).num_detectors == noise.noisy_circuit(
+        constructor(diam=4, rounds=10000, basis=basis)).num_detectors
+
+
+def test_rounds_template_from_circuit():
+    with pytest.raises(ValueError, match='exactly one'):
+        RoundsTemplate.from_circuit(stim.Circuit('H 0'), rounds=4)
+    with pytest.raises(ValueError, match='repeat_count'):
+        RoundsTemplate.from_circuit(stim.Circuit('REPEAT 3 {\n H 0\n}'), rounds=4)
+    template = RoundsTemplate.from_circuit(stim.Circuit('R 0\nREPEAT 2 {\n H 0\n TICK\n}\nM 0'), rounds=4)
+    assert template.circuit(rounds=2) == stim.Circuit('R 0\nM 0')
+    with pytest.raises(ValueError):
+        template.circuit(rounds=1)
@@ -1,19 +1,35 @@
-from typing import List, Iterable, Dict
+import dataclasses
+import functools
+from typing import Any, Iterable, Dict, FrozenSet, Tuple
 
 import stim
 
 from stability_paper.tools import Builder, AtLayer, Tile, surface_code_tiles
+from stability_paper.tools._util import sorted_complex
 
 
-def measure_surface_code_tiles(
+@dataclasses.dataclass(frozen=True)
+class RoundSchedule:
+    """The instructions of one round of surface code stabilizer measurements.
+
+    Each step is a (gate name, qubits) pair. The qubits of CZ steps are a tuple of
+    pairs in target order, and TICK steps have no qubits. Other steps use frozensets,
+    so that builders can reuse their cached sorted qubit indices between rounds.
+    """
+    steps: Tuple[Tuple[str, Any], ...]
+    measured: FrozenSet[complex]
+
+
+def surface_code_round_schedule(
         tiles: Iterable[Tile],
         *,
         data_init: Dict[complex, str],
-        data_measure: Dict[complex, str],
-        out: Builder,
-        layer: int):
-    out.gate("R", [tile.measure_qubit for tile in tiles] + list(data_init.keys()))
-    out.tick()
+        data_measure: Dict[complex, str]) -> RoundSchedule:
+    tiles = list(tiles)
+    steps = [
+        ("R", frozenset([tile.measure_qubit for tile in tiles] + list(data_init.keys()))),
+        ("TICK", None),
+    ]
 
     # Figure out what basis each qubit needs to be rotated into in each layer.
     x_basis_layers = [set(d for d, b in data_init.items() if b == 'X')]
@@ -30,91 +46,246 @@ def measure_surface_code_tiles(
     for k in range(4):
         switch = x_basis_layers[k + 1] ^ x_basis_layers[k]
         if switch:
-            out.gate("H", switch)
-            out.tick()
+            steps.append(("H", frozenset(switch)))
+            steps.append(("TICK", None))
 
+        pairs = []
         for tile in tiles:
             if tile.ordered_data[k] is not None:
-                out.gate("CZ", [tile.ordered_data[k], tile.measure_qubit])
-        out.tick()
-    
-    out.gate("H", x_basis_layers[-1] ^ x_basis_layers[-2])
-    out.tick()
+                pairs.extend(sorted_complex([tile.ordered_data[k], tile.measure_qubit]))
+        if pairs:
+            steps.append(("CZ", tuple(pairs)))
+        steps.append(("TICK", None))
+
+    steps.append(("H", frozenset(x_basis_layers[-1] ^ x_basis_layers[-2])))
+    steps.append(("TICK", None))
+
+    return RoundSchedule(
+        steps=tuple(steps),
+        measured=frozenset([tile.measure_qubit for tile in tiles] + list(data_measure.keys())),
+    )
+
 
-    out.measure([tile.measure_qubit for tile in tiles] + list(data_measure.keys()), layer=layer)
+def append_round(schedule: RoundSchedule, *, out: Builder, layer: int) -> None:
+    for name, qubits in schedule.steps:
+        if name == "TICK":
+            out.tick()
+        elif name == "CZ":
+            out.gate_in_order(name, qubits)
+        else:
+            out.gate(name, qubits)
+    out.measure(schedule.measured, layer=layer)
+
+
+@dataclasses.dataclass(frozen=True)
+class SurfaceCodeSchedule:
+    """The tiles and rounds of a surface code experiment, which don't depend on the number of rounds."""
+    tiles: Tuple[Tile, ...]
+    qubits: FrozenSet[complex]
+    time_basis: str
+    init_round: RoundSchedule
+    bulk_round: RoundSchedule
+    final_round: RoundSchedule
+
+    @staticmethod
+    def from_tiles(tiles: Iterable[Tile], *, time_basis: str) -> 'SurfaceCodeSchedule':
+        tiles = tuple(tiles)
+        data_set = {q for tile in tiles for q in tile.data_set}
+        return SurfaceCodeSchedule(
+            tiles=tiles,
+            qubits=frozenset(q for tile in tiles for q in tile.used_set),
+            time_basis=time_basis,
+            init_round=surface_code_round_schedule(
+                tiles,
+                data_init={d: time_basis for d in data_set},
+                data_measure={},
+            ),
+            bulk_round=surface_code_round_schedule(tiles, data_init={}, data_measure={}),
+            final_round=surface_code_round_schedule(
+                tiles,
+                data_init={},
+                data_measure={d: time_basis for d in data_set},
+            ),
+        )
 
 
-def build_surface_code_circuit(*, tiles: List[Tile], rounds: int, time_basis: str, builder: Builder) -> None:
+@functools.lru_cache(maxsize=64)
+def surface_code_schedule(*,
+                          diam: int,
+                          side_basis: str,
+                          top_bot_basis: str,
+                          x_order: Tuple[complex, ...],
+                          z_order: Tuple[complex, ...],
+                          time_basis: str,
+                          patches: int = 1) -> SurfaceCodeSchedule:
+    """Returns the (cached) schedule for a surface code layout.
+
+    Sweeps build many circuits for each layout (one per noise strength and number of
+    rounds), so the tiles and gate layers are computed once per layout instead of
+    once per circuit.
+
+    When `patches` is more than 1, the layout contains that many copies of the patch
+    side by side (see `patch_offset`), with the tiles of each copy listed together.
+    """
+    tiles = surface_code_tiles(
+        diam=diam,
+        side_basis=side_basis,
+        top_bot_basis=top_bot_basis,
+        x_order=list(x_order),
+        z_order=list(z_order),
+    )
+    if patches != 1:
+        tiles = [
+            _shifted_tile(tile, patch_offset(diam=diam, patch=k))
+            for k in range(patches)
+            for tile in tiles
+        ]
+    return SurfaceCodeSchedule.from_tiles(tiles, time_basis=time_basis)
+
+
+def patch_offset(*, diam: int, patch: int) -> complex:
+    """Returns the displacement of a copy of a patch in a packed circuit.
+
+    Copies are separated along the real axis, with a gap wide enough that no
+    tile of one copy touches a qubit of another.
+    """
+    return patch * (diam + 2) + 0j
+
+
+def patch_index(q: complex, *, diam: int) -> int:
+    """Returns which copy of a patch, in a packed circuit, the given qubit belongs to."""
+    return int((q.real + 1) // (diam + 2))
+
+
+def _shifted_tile(tile: Tile, offset: complex) -> Tile:
+    return Tile(
+        ordered_data=tuple(None if d is None else d + offset for d in tile.ordered_data),
+        measure_qubit=tile.measure_qubit + offset,
+        basis=tile.basis,
+    )
+
+
+def build_surface_code_circuit(*, schedule: SurfaceCodeSchedule, rounds: int, builder: Builder) -> None:
     assert rounds >= 2
-    data_set = {q for tile in tiles for q in tile.data_set}
+    tiles = schedule.tiles
 
     # Initialize.
     cur_layer = 0
-    measure_surface_code_tiles(
-        tiles,
-        out=builder,
-        layer=cur_layer,
-        data_init={d: time_basis for d in data_set},
-        data_measure={},
+    append_round(schedule.init_round, out=builder, layer=cur_layer)
+    time_tiles = [tile for tile in tiles if tile.basis == schedule.time_basis]
+    builder.detectors(
+        [[AtLayer(tile.measure_qubit, cur_layer)] for tile in time_tiles],
+        positions=[tile.measure_qubit for tile in time_tiles],
     )
-    for tile in tiles:
-        if tile.basis == time_basis:
-            builder.detector([AtLayer(tile.measure_qubit, cur_layer)], pos=tile.measure_qubit)
     builder.shift_coords(dt=1)
     builder.tick()
     cur_layer += 1
 
     # Loop body.
     if rounds > 2:
-        loop_builder = Builder(q2i=builder.q2i, circuit=stim.Circuit(), tracker=builder.tracker)
-        measure_surface_code_tiles(tiles, out=loop_builder, layer=cur_layer, data_measure={}, data_init={})
-        for tile in tiles:
-            loop_builder.detector([
-                AtLayer(tile.measure_qubit, cur_layer),
-                AtLayer(tile.measure_qubit, cur_layer - 1),
-            ], pos=tile.measure_qubit)
+        loop_builder = Builder(
+            q2i=builder.q2i,
+            circuit=stim.Circuit(),
+            tracker=builder.tracker,
+            buffered=builder.buffered,
+        )
+        append_round(schedule.bulk_round, out=loop_builder, layer=cur_layer)
+        loop_builder.detectors(
+            [[AtLayer(tile.measure_qubit, cur_layer), AtLayer(tile.measure_qubit, cur_layer - 1)] for tile in tiles],
+            positions=[tile.measure_qubit for tile in tiles],
+        )
         loop_builder.shift_coords(dt=1)
         loop_builder.tick()
         builder.circuit += loop_builder.circuit * (rounds - 2)
         cur_layer += 1
 
     # Measure.
-    measure_surface_code_tiles(
-        tiles,
-        out=builder,
-        layer=cur_layer,
-        data_init={},
-        data_measure={d: time_basis for d in data_set},
+    append_round(schedule.final_round, out=builder, layer=cur_layer)
+    builder.detectors(
+        [[AtLayer(tile.measure_qubit, cur_layer), AtLayer(tile.measure_qubit, cur_layer - 1)] for tile in tiles],
+        positions=[tile.measure_qubit for tile in tiles],
     )
-    for tile in tiles:
-        builder.detector([
-            AtLayer(tile.measure_qubit, cur_layer),
-            AtLayer(tile.measure_qubit, cur_layer - 1),
-        ], pos=tile.measure_qubit)
     builder.shift_coords(dt=1)
-    for tile in tiles:
-        if tile.basis == time_basis:
-            builder.detector([AtLayer(q, cur_layer) for q in tile.used_set], pos=tile.measure_qubit)
+    builder.detectors(
+        [[AtLayer(q, cur_layer) for q in tile.used_set] for tile in time_tiles],
+        positions=[tile.measure_qubit for tile in time_tiles],
+    )
+
 
+def surface_code_stability_experiment_circuit(*,
+                                              diam: int,
+                                              rounds: int,
+                                              basis: str,
+                                              buffered: bool = True,
+                                              patches: int = 1) -> stim.Circuit:
+    """Builds a stability experiment circuit.
 
-def surface_code_stability_experiment_circuit(*, diam: int, rounds: int, basis: str) -> stim.Circuit:
-    tiles = surface_code_tiles(diam=diam, top_bot_basis=basis, side_basis=basis, x_order=[0, 1j, 1, 1 + 1j], z_order=[0, 1, 1j, 1 + 1j])
+    Args:
+        diam: The diameter of the patch.
+        rounds: The number of rounds of stabilizer measurements.
+        basis: The basis of the patch's boundaries.
+        buffered: Whether to build the circuit using a buffered `Builder`.
+        patches: The number of independent copies of the experiment to put side by side
+            in the circuit. Copy k sets observable k. Packing several small experiments
+            into one circuit amortizes per-shot overhead when sampling.
+    """
     other_basis = 'X' if basis == 'Z' else 'Z'
-    builder = Builder.for_qubits({q for tile in tiles for q in tile.used_set})
-    build_surface_code_circuit(tiles=tiles, rounds=rounds, time_basis=other_basis, builder=builder)
+    schedule = surface_code_schedule(
+        diam=diam,
+        side_basis=basis,
+        top_bot_basis=basis,
+        x_order=(0, 1j, 1, 1 + 1j),
+        z_order=(0, 1, 1j, 1 + 1j),
+        time_basis=other_basis,
+        patches=patches,
+    )
+    builder = Builder.for_qubits(schedule.qubits, buffered=buffered)
+    build_surface_code_circuit(schedule=schedule, rounds=rounds, builder=builder)
     last_layer = 2 if rounds > 2 else 1
-    builder.obs_include([AtLayer(tile.measure_qubit, last_layer) for tile in tiles if tile.basis == basis], obs_index=0)
+    for k in range(patches):
+        builder.obs_include([
+            AtLayer(tile.measure_qubit, last_layer)
+            for tile in schedule.tiles
+            if tile.basis == basis and patch_index(tile.measure_qubit, diam=diam) == k
+        ], obs_index=k)
     return builder.circuit
 
 
-def surface_code_memory_experiment_circuit(*, diam: int, rounds: int, basis: str) -> stim.Circuit:
-    tiles = surface_code_tiles(diam=diam, top_bot_basis='Z', side_basis='X', x_order=[0, 1j, 1, 1 + 1j], z_order=[0, 1, 1j, 1 + 1j])
-    builder = Builder.for_qubits({q for tile in tiles for q in tile.used_set})
-    build_surface_code_circuit(tiles=tiles, rounds=rounds, time_basis=basis, builder=builder)
-    data_set = {d for tile in tiles for d in tile.data_set}
+def surface_code_memory_experiment_circuit(*,
+                                           diam: int,
+                                           rounds: int,
+                                           basis: str,
+                                           buffered: bool = True,
+                                           patches: int = 1) -> stim.Circuit:
+    """Builds a memory experiment circuit.
+
+    Args:
+        diam: The diameter of the patch.
+        rounds: The number of rounds of stabilizer measurements.
+        basis: The basis that the logical qubit is prepared and measured in.
+        buffered: Whether to build the circuit using a buffered `Builder`.
+        patches: The number of independent copies of the experiment to put side by side
+            in the circuit. Copy k sets observable k. Packing several small experiments
+            into one circuit amortizes per-shot overhead when sampling.
+    """
+    schedule = surface_code_schedule(
+        diam=diam,
+        side_basis='X',
+        top_bot_basis='Z',
+        x_order=(0, 1j, 1, 1 + 1j),
+        z_order=(0, 1, 1j, 1 + 1j),
+        time_basis=basis,
+        patches=patches,
+    )
+    builder = Builder.for_qubits(schedule.qubits, buffered=buffered)
+    build_surface_code_circuit(schedule=schedule, rounds=rounds, builder=builder)
+    data_set = {d for tile in schedule.tiles for d in tile.data_set}
     last_layer = 2 if rounds > 2 else 1
-    if basis == 'X':
-        builder.obs_include([AtLayer(d, last_layer) for d in data_set if d.imag == 0], obs_index=0)
-    else:
-        builder.obs_include([AtLayer(d, last_layer) for d in data_set if d.real == 0], obs_index=0)
+    for k in range(patches):
+        offset = patch_offset(diam=diam, patch=k)
+        patch_data = [d for d in data_set if patch_index(d, diam=diam) == k]
+        if basis == 'X':
+            builder.obs_include([AtLayer(d, last_layer) for d in patch_data if (d - offset).imag == 0], obs_index=k)
+        else:
+            builder.obs_include([AtLayer(d, last_layer) for d in patch_data if (d - offset).real == 0], obs_index=k)
     return builder.circuit
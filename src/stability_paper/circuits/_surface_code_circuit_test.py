@@ -3,6 +3,7 @@ import stim
 
 from stability_paper.circuits import \
     surface_code_stability_experiment_circuit, surface_code_memory_experiment_circuit
+from stability_paper.circuits._surface_code_circuit import patch_index, patch_offset, surface_code_schedule
 from stability_paper.tools import NoiseModel
 
 
@@ -354,3 +355,61 @@ def test_circuit_distances(diam: int, rounds: int, basis: str):
     noise = NoiseModel.depolarizing_cz_noise(1e-3)
     assert len(noise.noisy_circuit(stability_circuit).shortest_graphlike_error()) == rounds
     assert len(noise.noisy_circuit(memory_circuit).shortest_graphlike_error()) == diam
+
+
+@pytest.mark.parametrize('rounds,basis', [(2, 'X'), (3, 'Z'), (6, 'X'), (6, 'Z')])
+def test_buffered_construction_matches_unbuffered(rounds: int, basis: str):
+    for constructor in [surface_code_stability_experiment_circuit, surface_code_memory_experiment_circuit]:
+        assert constructor(diam=5, rounds=rounds, basis=basis, buffered=True) == constructor(
+            diam=5, rounds=rounds, basis=basis, buffered=False)
+
+
+def test_surface_code_schedule_is_shared_between_circuits():
+    surface_code_schedule.cache_clear()
+    for rounds in [2, 3, 4]:
+        for noise in [1e-3, 2e-3]:
+            NoiseModel.depolarizing_cz_noise(noise).noisy_circuit(
+                surface_code_stability_experiment_circuit(diam=4, rounds=rounds, basis='Z'))
+    info = surface_code_schedule.cache_info()
+    assert info.misses == 1
+    assert info.hits == 5
+
+    schedule = surface_code_schedule(
+        diam=3,
+        side_basis='X',
+        top_bot_basis='Z',
+        x_order=(0, 1j, 1, 1 + 1j),
+        z_order=(0, 1, 1j, 1 + 1j),
+        time_basis='Z',
+    )
+    assert len(schedule.tiles) == 8
+    assert len(schedule.qubits) == 17
+    assert schedule.bulk_round.measured == frozenset(tile.measure_qubit for tile in schedule.tiles)
+    assert schedule.final_round.measured == schedule.qubits
+    names = [name for name, _ in schedule.init_round.steps if name != 'TICK']
+    assert names[0] == 'R' and names[-1] == 'H'
+    assert names.count('CZ') == 4
+
+
+@pytest.mark.parametrize('constructor,basis', [
+    (surface_code_stability_experiment_circuit, 'Z'),
+    (surface_code_memory_experiment_circuit, 'X'),
+])
+def test_packed_circuits_contain_independent_copies(constructor, basis):
+    noise = NoiseModel.depolarizing_cz_noise(1e-3)
+    single = noise.noisy_circuit(constructor(diam=3, rounds=4, basis=basis))
+    packed = noise.noisy_circuit(constructor(diam=3, rounds=4, basis=basis, patches=3))
+    assert packed.num_observables == 3
+    assert packed.num_detectors == 3 * single.num_detectors
+    assert packed.num_qubits == 3 * single.num_qubits
+    single_dem = single.detector_error_model(decompose_errors=True, flatten_loops=True)
+    packed_dem = packed.detector_error_model(decompose_errors=True, flatten_loops=True)
+    assert packed_dem.num_errors == 3 * single_dem.num_errors
+    assert len(packed.shortest_graphlike_error()) == len(single.shortest_graphlike_error())
+
+    # Each copy's detectors are the original detectors, displaced along the real axis.
+    expected = sorted(3 * [tuple(c) for c in single.get_detector_coordinates().values()])
+    actual = []
+    for x, y, t in packed.get_detector_coordinates().values():
+        actual.append((x - patch_offset(diam=3, patch=patch_index(x + 1j * y, diam=3)).real, y, t))
+    assert sorted(actual) == expected
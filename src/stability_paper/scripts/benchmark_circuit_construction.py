@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+from typing import Callable
+
+import stim
+
+from stability_paper.circuits import surface_code_stability_experiment_circuit
+
+
+def time_per_call(func: Callable[[], stim.Circuit], *, repetitions: int) -> float:
+    func()  # Warm up.
+    t0 = time.perf_counter()
+    for _ in range(repetitions):
+        func()
+    return (time.perf_counter() - t0) / repetitions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times building stability experiment circuits with and without Builder's buffered mode.")
+    parser.add_argument("--diams", nargs='+', default=[25], type=int)
+    parser.add_argument("--rounds", default=25, type=int)
+    parser.add_argument("--basis", default='Z', type=str)
+    parser.add_argument("--repetitions", default=5, type=int)
+    args = parser.parse_args()
+
+    print("diam,unbuffered_seconds,buffered_seconds,speedup")
+    for diam in args.diams:
+        def build(buffered: bool) -> stim.Circuit:
+            return surface_code_stability_experiment_circuit(
+                diam=diam,
+                rounds=args.rounds,
+                basis=args.basis,
+                buffered=buffered,
+            )
+        assert build(True) == build(False)
+        unbuffered = time_per_call(lambda: build(False), repetitions=args.repetitions)
+        buffered = time_per_call(lambda: build(True), repetitions=args.repetitions)
+        print(f"{diam},{unbuffered:.4f},{buffered:.4f},{unbuffered / buffered:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing
+import pathlib
+import sys
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import sinter
+
+from stability_paper.scripts.generate_circuit_files import add_sweep_args, iter_json_metadata_from_args, \
+    iter_sinter_tasks, noisy_circuit_for, parametric_dem_for
+from stability_paper.tools import iter_circuit_bundle, read_circuit_bundle_index
+from stability_paper.tools._dem_sidecar import read_dem_sidecar
+from stability_paper.tools._packed_sampling import PackedTask, collect_packed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Samples a sweep of circuits with sinter. The circuits either come from bundle files "
+                    "or are built in memory on demand from the given sweep arguments.")
+    parser.add_argument("--bundles", nargs='+', default=None, type=str)
+    add_sweep_args(parser, required=False)
+    parser.add_argument("--decoders", nargs='+', required=True, type=str)
+    parser.add_argument("--processes", required=True, type=int)
+    parser.add_argument("--save_resume_filepath", required=True, type=str)
+    parser.add_argument("--max_shots", default=None, type=int)
+    parser.add_argument("--max_errors", default=None, type=int)
+    parser.add_argument("--dem_dir", default=None, type=str,
+                        help="Directory of detector error models cached by generate_circuit_files.py.")
+    parser.add_argument("--parametric_dems", action='store_true',
+                        help="Instantiate each task's detector error model from a parametric error model of its "
+                             "circuit family, instead of extracting it from the circuit. Much faster to prepare, "
+                             "but the error models (and so the strong ids) differ slightly from sinter's, so don't "
+                             "mix the resulting stats with stats collected without this flag. Requires sweep "
+                             "arguments instead of --bundles.")
+    parser.add_argument("--patches", default=1, type=int,
+                        help="Samples circuits holding this many independent copies of each task's circuit, "
+                             "and splits the results back into shots of the original tasks. Faster for "
+                             "small codes. Requires --max_shots and sweep arguments instead of --bundles.")
+    args = parser.parse_args()
+
+    if args.parametric_dems and (args.bundles is not None or args.dem_dir is not None):
+        raise ValueError("--parametric_dems can't be combined with --bundles or --dem_dir")
+
+    if args.patches != 1:
+        if args.max_shots is None:
+            raise ValueError('--patches requires --max_shots')
+        if args.bundles is not None:
+            # Packed circuits are rebuilt from the sweep entries, and could differ from the bundled
+            # circuits whose strong ids the stats would be recorded under.
+            raise ValueError("--patches can't be combined with --bundles")
+        collect_packed_to_file(
+            json_metadatas=list(iter_json_metadata_from_args(args)),
+            patches=args.patches,
+            decoders=args.decoders,
+            processes=args.processes,
+            max_shots=args.max_shots,
+            max_errors=args.max_errors,
+            save_resume_filepath=args.save_resume_filepath,
+            dem_dir=args.dem_dir,
+            parametric_dems=args.parametric_dems,
+        )
+        return
+
+    if args.bundles is not None:
+        num_tasks = sum(len(read_circuit_bundle_index(path)) for path in args.bundles)
+        tasks = iter_sinter_tasks_from_bundles(args.bundles)
+    else:
+        json_metadatas = list(iter_json_metadata_from_args(args))
+        num_tasks = len(json_metadatas)
+        tasks = iter_sinter_tasks(json_metadatas, parametric_dems=args.parametric_dems)
+    if args.dem_dir is not None:
+        tasks = with_cached_dems(tasks, dem_dir=args.dem_dir)
+
+    sinter.collect(
+        num_workers=args.processes,
+        tasks=tasks,
+        hint_num_tasks=num_tasks,
+        decoders=args.decoders,
+        max_shots=args.max_shots,
+        max_errors=args.max_errors,
+        save_resume_filepath=args.save_resume_filepath,
+        print_progress=True,
+    )
+
+
+def iter_sinter_tasks_from_bundles(paths: List[str]) -> Iterator[sinter.Task]:
+    for path in paths:
+        for json_metadata, circuit in iter_circuit_bundle(path):
+            yield sinter.Task(circuit=circuit, json_metadata=json_metadata)
+
+
+def collect_packed_to_file(*,
+                           json_metadatas: List[Dict[str, Any]],
+                           patches: int,
+                           decoders: List[str],
+                           processes: int,
+                           max_shots: int,
+                           max_errors: Optional[int],
+                           save_resume_filepath: str,
+                           dem_dir: Optional[str] = None,
+                           parametric_dems: bool = False) -> None:
+    """Collects stats by sampling packed copies of each sweep entry's circuit, appending them to a sinter csv file.
+
+    The circuits are built by the workers, from the sweep entries, so they aren't all held in
+    memory or sent between processes.
+    """
+    jobs = [
+        (json_metadata, decoder, patches, max_shots, max_errors, save_resume_filepath, dem_dir, parametric_dems)
+        for json_metadata in json_metadatas
+        for decoder in decoders
+    ]
+    path = pathlib.Path(save_resume_filepath)
+    if not path.exists() or path.stat().st_size == 0:
+        with open(path, 'w') as f:
+            print(sinter.CSV_HEADER, file=f)
+    with multiprocessing.Pool(processes) as pool:
+        for k, stats in enumerate(pool.imap_unordered(_collect_packed_job, jobs)):
+            with open(path, 'a') as f:
+                for s in stats:
+                    print(s.to_csv_line(), file=f)
+            print(f'finished {k + 1}/{len(jobs)} tasks', file=sys.stderr)
+
+
+def _collect_packed_job(
+        job: Tuple[Dict[str, Any], str, int, int, Optional[int], str, Optional[str], bool]) -> List[sinter.TaskStats]:
+    json_metadata, decoder, patches, max_shots, max_errors, save_resume_filepath, dem_dir, parametric_dems = job
+    circuit = noisy_circuit_for(json_metadata)
+    if parametric_dems:
+        dem = parametric_dem_for(json_metadata)
+    elif dem_dir is not None:
+        dem = read_dem_sidecar(dem_dir, circuit)
+    else:
+        dem = None
+    packed = PackedTask(
+        task=sinter.Task(
+            circuit=circuit,
+            decoder=decoder,
+            detector_error_model=dem,
+            json_metadata=json_metadata,
+        ),
+        packed_circuit=noisy_circuit_for(json_metadata, patches=patches),
+        patches=patches,
+    )
+    return list(collect_packed(
+        tasks=[packed],
+        max_shots=max_shots,
+        max_errors=max_errors,
+        existing_data_filepath=save_resume_filepath,
+    ))
+
+
+def with_cached_dems(tasks: Iterable[sinter.Task], *, dem_dir: str) -> Iterator[sinter.Task]:
+    """Attaches cached detector error models to tasks, so sinter's workers don't have to derive them.
+
+    Tasks whose circuit has no cached error model are passed through unchanged.
+    """
+    for task in tasks:
+        dem = read_dem_sidecar(dem_dir, task.circuit)
+        if dem is None:
+            yield task
+        else:
+            yield sinter.Task(
+                circuit=task.circuit,
+                decoder=task.decoder,
+                detector_error_model=dem,
+                json_metadata=task.json_metadata,
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,70 +1,445 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
 import pathlib
 import sys
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from stability_paper.circuits import surface_code_stability_experiment_circuit, \
+import sinter
+import stim
+
+from stability_paper.circuits import RoundsTemplate, surface_code_stability_experiment_circuit, \
     surface_code_memory_experiment_circuit
+from stability_paper.circuits._rounds_template import ROUNDS_TEMPLATE_ROUNDS
 from stability_paper.tools import NoiseModel
+from stability_paper.tools._bundle import CircuitBundleWriter, compress_circuit, decompress_circuit_text, \
+    read_circuit_bundle_index, read_compressed
+from stability_paper.tools._dem_sidecar import dem_sidecar_path, write_dem_sidecar
 from stability_paper.tools._noise import NoiseRule
+from stability_paper.tools._noise_template import NoisyCircuitTemplate
+from stability_paper.tools._parametric_dem import ParametricDetectorErrorModel
+
+# Bump this when a change to the circuit construction code changes the generated files.
+CODE_VERSION = 1
+MANIFEST_FILE_NAME = 'manifest.json'
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--out_dir", required=True, type=str)
-    parser.add_argument("--bases", nargs='+', required=True, type=str)
-    parser.add_argument("--measure_noise", nargs='+', required=True, type=float)
-    parser.add_argument("--data_noise", nargs='+', required=True, type=float)
-    parser.add_argument("--type", choices=['stability', 'memory'], required=True)
-    parser.add_argument("--rounds", nargs='+', required=True, type=int)
-    parser.add_argument("--diams", nargs='+', required=True, type=int)
+    parser.add_argument("--out_dir", default=None, type=str, help="Directory to write one .stim file per circuit into.")
+    parser.add_argument("--out_bundle", default=None, type=str, help="Bundle file to write all the circuits into.")
+    add_sweep_args(parser)
+    parser.add_argument("--workers", default=1, type=int)
+    parser.add_argument("--force", action='store_true', help="Rebuild circuits even if their inputs are unchanged.")
+    parser.add_argument("--dem_dir", default=None, type=str, help="Directory to cache each circuit's detector error model in.")
     args = parser.parse_args()
+    if args.workers < 1:
+        raise ValueError(f'{args.workers=} < 1')
+    if (args.out_dir is None) == (args.out_bundle is None):
+        raise ValueError("Specify exactly one of --out_dir or --out_bundle")
 
-    if args.type == 'stability':
-        method = surface_code_stability_experiment_circuit
-    elif args.type == 'memory':
-        method = surface_code_memory_experiment_circuit
+    if args.out_dir is not None:
+        _write_circuit_dir(args)
     else:
-        raise NotImplementedError(f'{args.type=}')
+        _write_circuit_bundle(args)
+
 
+def _write_circuit_dir(args: argparse.Namespace) -> None:
     out_dir = pathlib.Path(args.out_dir)
     out_dir.mkdir(exist_ok=True, parents=True)
-    for measure_noise in args.measure_noise:
-        for data_noise in args.data_noise:
-            noise = NoiseModel(
-                idle_depolarization=data_noise,
-                any_clifford_1q_rule=NoiseRule(after={'DEPOLARIZE1': data_noise}),
-                measure_rules={
-                    'Z': NoiseRule(after={'DEPOLARIZE1': measure_noise}, flip_result=measure_noise),
-                },
-                gate_rules={
-                    'R': NoiseRule(after={'X_ERROR': measure_noise}),
-                    'CZ': NoiseRule(after={'DEPOLARIZE2': data_noise}),
-                }
-            )
-
-            for basis in args.bases:
-                for diam in args.diams:
-                    for rounds in args.rounds:
-                        circuit = method(
-                            basis=basis,
-                            rounds=rounds,
-                            diam=diam)
-                        noisy_circuit = noise.noisy_circuit(circuit)
-                        json_metadata = {
-                            'type': args.type,
+    manifest_path = out_dir / MANIFEST_FILE_NAME
+    manifest = _read_manifest(manifest_path)
+
+    jobs = []
+    dem_jobs = []
+    for json_metadata in iter_json_metadata_from_args(args):
+        name = file_name_for(json_metadata)
+        key = generation_key(json_metadata)
+        if not args.force and manifest.get(name) == key and (out_dir / name).exists():
+            print(f'unchanged {out_dir / name}', file=sys.stderr)
+            if args.dem_dir is not None:
+                dem_jobs.append((args.dem_dir, (out_dir / name).read_text()))
+        else:
+            jobs.append((out_dir, json_metadata, key, args.dem_dir))
+
+    _ensure_dem_sidecars(dem_jobs, workers=args.workers)
+    results = _parallel_map(_write_circuit_file, jobs, workers=args.workers)
+    _record_results(results, manifest=manifest, manifest_path=manifest_path)
+
+
+def _write_circuit_bundle(args: argparse.Namespace) -> None:
+    """Writes the sweep's circuits into a bundle file.
+
+    Entries of an existing bundle that are outside the sweep are kept, so several sweeps
+    (e.g. stability and memory experiments) can be written into the same bundle.
+    """
+    path = pathlib.Path(args.out_bundle)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    existing_entries = read_circuit_bundle_index(path) if path.exists() else []
+
+    entries = [
+        (json_metadata, generation_key(json_metadata))
+        for json_metadata in iter_json_metadata_from_args(args)
+    ]
+    names = {file_name_for(json_metadata) for json_metadata, _ in entries}
+    other_entries = [e for e in existing_entries if file_name_for(e.json_metadata) not in names]
+    old_entries = {}
+    if not args.force:
+        old_entries = {e.key: e for e in existing_entries if e.key is not None}
+    if args.dem_dir is not None:
+        _ensure_dem_sidecars([
+            (args.dem_dir, decompress_circuit_text(read_compressed(path, old_entries[key])))
+            for _, key in entries
+            if key in old_entries
+        ], workers=args.workers)
+
+    jobs = [(json_metadata, args.dem_dir) for json_metadata, key in entries if key not in old_entries]
+    new_data = _parallel_map(_compressed_circuit, jobs, workers=args.workers)
+    with CircuitBundleWriter(path) as writer:
+        for entry in other_entries:
+            writer.write_compressed(entry.json_metadata, read_compressed(path, entry), key=entry.key)
+        for json_metadata, key in entries:
+            name = file_name_for(json_metadata)
+            if key in old_entries:
+                # Copy the compressed bytes over from the previous version of the bundle.
+                writer.write_compressed(json_metadata, read_compressed(path, old_entries[key]), key=key)
+                print(f'unchanged {path}[{name}]', file=sys.stderr)
+            else:
+                writer.write_compressed(json_metadata, next(new_data), key=key)
+                print(f'wrote {path}[{name}]', file=sys.stderr)
+
+
+def _parallel_map(func: Callable[[Any], Any], items: List[Any], *, workers: int) -> Iterator[Any]:
+    if workers == 1:
+        yield from map(func, items)
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            # imap yields in submission order, so progress output stays deterministic.
+            yield from pool.imap(func, items)
+
+
+def _record_results(
+        results: Iterable[Tuple[pathlib.Path, str]],
+        *,
+        manifest: Dict[str, str],
+        manifest_path: pathlib.Path) -> None:
+    unsaved = 0
+    try:
+        for path, key in results:
+            print(f'wrote {path}', file=sys.stderr)
+            manifest[path.name] = key
+            unsaved += 1
+            if unsaved >= 100:
+                _write_text_atomically(manifest_path, json.dumps(manifest, indent=2, sort_keys=True))
+                unsaved = 0
+    finally:
+        # Also save on interruption, so a resumed run skips the files that were finished.
+        if unsaved:
+            _write_text_atomically(manifest_path, json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def add_sweep_args(parser: argparse.ArgumentParser, *, required: bool = True) -> None:
+    """Adds the arguments describing a sweep of circuits to a parser."""
+    parser.add_argument("--bases", nargs='+', required=required, type=str)
+    parser.add_argument("--measure_noise", nargs='+', required=required, type=float)
+    parser.add_argument("--data_noise", nargs='+', required=required, type=float)
+    parser.add_argument("--type", choices=['stability', 'memory'], required=required)
+    parser.add_argument("--rounds", nargs='+', required=required, type=int)
+    parser.add_argument("--diams", nargs='+', required=required, type=int)
+
+
+def iter_json_metadata_from_args(args: argparse.Namespace) -> Iterator[Dict[str, Any]]:
+    missing = [k for k in ['bases', 'measure_noise', 'data_noise', 'type', 'rounds', 'diams'] if getattr(args, k) is None]
+    if missing:
+        raise ValueError(f'Missing sweep arguments: {missing}')
+    return iter_json_metadata(
+        circuit_type=args.type,
+        bases=args.bases,
+        measure_noises=args.measure_noise,
+        data_noises=args.data_noise,
+        diams=args.diams,
+        rounds=args.rounds,
+    )
+
+
+def iter_json_metadata(
+        *,
+        circuit_type: str,
+        bases: Iterable[str],
+        measure_noises: Iterable[float],
+        data_noises: Iterable[float],
+        diams: Iterable[int],
+        rounds: Iterable[int]) -> Iterator[Dict[str, Any]]:
+    """Yields the metadata of each circuit in a sweep, in generation order."""
+    bases = list(bases)
+    data_noises = list(data_noises)
+    diams = list(diams)
+    rounds = list(rounds)
+    for measure_noise in measure_noises:
+        for data_noise in data_noises:
+            for basis in bases:
+                for diam in diams:
+                    for r in rounds:
+                        # Keys are sorted to match what sinter parses out of the file names,
+                        # because the key order affects sinter's strong ids.
+                        yield {
                             'b': basis,
                             'd': diam,
-                            'r': rounds,
-                            'pm': measure_noise,
                             'pd': data_noise,
+                            'pm': measure_noise,
+                            'r': r,
+                            'type': circuit_type,
                         }
-                        name = ','.join(f'{k}={json_metadata[k]}' for k in sorted(json_metadata.keys()))
-                        path = out_dir / f'{name}.stim'
-                        with open(path, 'w') as f:
-                            print(noisy_circuit, file=f)
-                        print(f'wrote {path}', file=sys.stderr)
+
+
+def iter_sinter_tasks(json_metadatas: Iterable[Dict[str, Any]], *, parametric_dems: bool = False) -> Iterator[sinter.Task]:
+    """Lazily yields a sinter task for each sweep entry, without touching the disk.
+
+    Each circuit is only built when its task is requested, so sampling can start
+    before the whole sweep has been generated. The metadata matches what sinter
+    would recover from the file names written by `main`.
+
+    Args:
+        json_metadatas: The sweep entries.
+        parametric_dems: Attach detector error models instantiated from a parametric error
+            model of each circuit family, instead of leaving sinter to extract each one.
+            Entries are reordered so that each family's entries are adjacent (with each noise
+            point's round counts adjacent within the family, so noisy circuits are still shared
+            across round counts), and each parametric error model only has to be built once.
+            The error models differ from
+            the ones sinter would extract by floating point error, which changes the
+            strong ids of the tasks.
+    """
+    if parametric_dems:
+        json_metadatas = sorted(json_metadatas, key=lambda e: (e['type'], e['b'], e['d'], e['pm'], e['pd'], e['r']))
+    family = None
+    family_dems: Dict[int, ParametricDetectorErrorModel] = {}
+    for json_metadata in json_metadatas:
+        dem = None
+        if parametric_dems:
+            # Keep the parametric error models of the current family, one per round count.
+            key = (json_metadata['type'], json_metadata['b'], json_metadata['d'])
+            if key != family:
+                family = key
+                family_dems = {}
+            r = json_metadata['r']
+            if r not in family_dems:
+                family_dems[r] = _parametric_dem(
+                    circuit_type=json_metadata['type'],
+                    basis=json_metadata['b'],
+                    diam=json_metadata['d'],
+                    rounds=r,
+                )
+            dem = family_dems[r].instantiate(measure=json_metadata['pm'], data=json_metadata['pd'])
+        yield sinter.Task(
+            circuit=noisy_circuit_for(json_metadata),
+            detector_error_model=dem,
+            json_metadata=json_metadata,
+        )
+
+
+def noise_model_for(*, measure_noise: float, data_noise: float) -> NoiseModel:
+    return NoiseModel(
+        idle_depolarization=data_noise,
+        any_clifford_1q_rule=NoiseRule(after={'DEPOLARIZE1': data_noise}),
+        measure_rules={
+            'Z': NoiseRule(after={'DEPOLARIZE1': measure_noise}, flip_result=measure_noise),
+        },
+        gate_rules={
+            'R': NoiseRule(after={'X_ERROR': measure_noise}),
+            'CZ': NoiseRule(after={'DEPOLARIZE2': data_noise}),
+        }
+    )
+
+
+def file_name_for(json_metadata: Dict[str, Any]) -> str:
+    name = ','.join(f'{k}={json_metadata[k]}' for k in sorted(json_metadata.keys()))
+    return f'{name}.stim'
+
+
+def noisy_circuit_for(json_metadata: Dict[str, Any], *, patches: int = 1) -> stim.Circuit:
+    """Builds the noisy circuit described by a sweep entry's metadata.
+
+    Args:
+        json_metadata: The sweep entry.
+        patches: Number of independent copies of the circuit to pack side by side.
+    """
+    template = _noisy_rounds_template(
+        circuit_type=json_metadata['type'],
+        basis=json_metadata['b'],
+        diam=json_metadata['d'],
+        measure_noise=json_metadata['pm'],
+        data_noise=json_metadata['pd'],
+        patches=patches,
+    )
+    return template.circuit(rounds=json_metadata['r'])
+
+
+@functools.lru_cache(maxsize=16)
+def _noisy_rounds_template(*,
+                           circuit_type: str,
+                           basis: str,
+                           diam: int,
+                           measure_noise: float,
+                           data_noise: float,
+                           patches: int) -> RoundsTemplate:
+    """Builds and noises a circuit once for all the round counts in a sweep."""
+    noise_template = _noise_template(
+        circuit_type=circuit_type,
+        basis=basis,
+        diam=diam,
+        patches=patches,
+        rounds=ROUNDS_TEMPLATE_ROUNDS,
+    )
+    return RoundsTemplate.from_circuit(
+        noise_template.instantiate(measure=measure_noise, data=data_noise),
+        rounds=ROUNDS_TEMPLATE_ROUNDS,
+    )
+
+
+def parametric_dem_for(json_metadata: Dict[str, Any]) -> stim.DetectorErrorModel:
+    """Returns the detector error model of a sweep entry's circuit, via its family's parametric error model."""
+    parametric_dem = _parametric_dem(
+        circuit_type=json_metadata['type'],
+        basis=json_metadata['b'],
+        diam=json_metadata['d'],
+        rounds=json_metadata['r'],
+    )
+    return parametric_dem.instantiate(measure=json_metadata['pm'], data=json_metadata['pd'])
+
+
+@functools.lru_cache(maxsize=2)
+def _parametric_dem(*, circuit_type: str, basis: str, diam: int, rounds: int) -> ParametricDetectorErrorModel:
+    """Derives the error models of a circuit for all the noise strengths in a sweep."""
+    return ParametricDetectorErrorModel(template=_noise_template(
+        circuit_type=circuit_type,
+        basis=basis,
+        diam=diam,
+        patches=1,
+        rounds=rounds,
+    ))
+
+
+# Unbounded, because sweeps vary the noise outermost and revisit every (basis, diam) at each noise
+# point. The number of entries is bounded by the sweep's size.
+@functools.lru_cache(maxsize=None)
+def _noise_template(*, circuit_type: str, basis: str, diam: int, patches: int, rounds: int) -> NoisyCircuitTemplate:
+    """Builds a circuit once for all the noise strengths in a sweep."""
+    if circuit_type == 'stability':
+        method = surface_code_stability_experiment_circuit
+    elif circuit_type == 'memory':
+        method = surface_code_memory_experiment_circuit
+    else:
+        raise NotImplementedError(f'{circuit_type=}')
+    return NoisyCircuitTemplate(
+        circuit=method(basis=basis, diam=diam, patches=patches, rounds=rounds),
+        noise_for=lambda measure, data: noise_model_for(measure_noise=measure, data_noise=data),
+        slots=['measure', 'data'],
+    )
+
+
+def generation_key(json_metadata: Dict[str, Any]) -> str:
+    """Hashes everything that determines the contents of a sweep entry's circuit file."""
+    noise = noise_model_for(measure_noise=json_metadata['pm'], data_noise=json_metadata['pd'])
+    inputs = {
+        'code_version': CODE_VERSION,
+        'metadata': json_metadata,
+        'noise': _noise_model_description(noise),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def _noise_model_description(noise: NoiseModel) -> Dict[str, Any]:
+    def rule(r: Optional[NoiseRule]) -> Any:
+        if r is None:
+            return None
+        return {'after': r.after, 'flip_result': r.flip_result}
+
+    def rules(rs: Optional[Dict[str, NoiseRule]]) -> Any:
+        if rs is None:
+            return None
+        return {k: rule(v) for k, v in rs.items()}
+
+    return {
+        'idle_depolarization': noise.idle_depolarization,
+        'additional_depolarization_waiting_for_mr': noise.additional_depolarization_waiting_for_mr,
+        'gate_rules': rules(noise.gate_rules),
+        'measure_rules': rules(noise.measure_rules),
+        'any_clifford_1q_rule': rule(noise.any_clifford_1q_rule),
+        'any_clifford_2q_rule': rule(noise.any_clifford_2q_rule),
+    }
+
+
+def _read_manifest(path: pathlib.Path) -> Dict[str, str]:
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_text_atomically(path: pathlib.Path, text: str) -> None:
+    """Writes a file via a temporary file and a rename, so readers never see a partial file."""
+    _write_chunks_atomically(path, [text, '\n'])
+
+
+def _write_chunks_atomically(path: pathlib.Path, chunks: Iterable[str]) -> None:
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_path, 'w') as f:
+            f.writelines(chunks)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _ensure_dem_sidecars(jobs: List[Tuple[str, str]], *, workers: int) -> None:
+    """Caches error models for circuits that were generated before a --dem_dir was given."""
+    for path in _parallel_map(_ensure_dem_sidecar, jobs, workers=workers):
+        if path is not None:
+            print(f'wrote {path}', file=sys.stderr)
+
+
+def _ensure_dem_sidecar(job: Tuple[str, str]) -> Optional[pathlib.Path]:
+    dem_dir, circuit_text = job
+    circuit = stim.Circuit(circuit_text)
+    if dem_sidecar_path(dem_dir, circuit).exists():
+        return None
+    return write_dem_sidecar(dem_dir, circuit)
+
+
+def _compressed_circuit(job: Tuple[Dict[str, Any], Optional[str]]) -> bytes:
+    json_metadata, dem_dir = job
+    noisy_circuit = noisy_circuit_for(json_metadata)
+    if dem_dir is not None:
+        write_dem_sidecar(dem_dir, noisy_circuit)
+    return compress_circuit(noisy_circuit)
+
+
+def _write_circuit_file(job: Tuple[pathlib.Path, Dict[str, Any], str, Optional[str]]) -> Tuple[pathlib.Path, str]:
+    out_dir, json_metadata, key, dem_dir = job
+    noisy_circuit = noisy_circuit_for(json_metadata)
+    if dem_dir is not None:
+        write_dem_sidecar(dem_dir, noisy_circuit)
+    path = out_dir / file_name_for(json_metadata)
+    _write_chunks_atomically(path, _iter_circuit_text(noisy_circuit))
+    return path, key
+
+
+def _iter_circuit_text(circuit: stim.Circuit) -> Iterator[str]:
+    """Yields the text of `print(circuit)` one top level instruction at a time.
+
+    Avoids holding the text of a whole large circuit in memory at once.
+    """
+    if len(circuit) == 0:
+        yield '\n'
+    for k in range(len(circuit)):
+        yield str(circuit[k:k + 1]) + '\n'
 
 
 if __name__ == '__main__':
@@ -0,0 +1,36 @@
+import argparse
+import pathlib
+import tempfile
+
+from stability_paper.scripts.generate_circuit_files import _write_circuit_bundle, file_name_for
+from stability_paper.tools._bundle import read_circuit_bundle_index
+
+
+def _sweep_args(path: pathlib.Path, circuit_type: str, *, force: bool = False) -> argparse.Namespace:
+    return argparse.Namespace(
+        out_bundle=str(path),
+        bases=['X'],
+        measure_noise=[0.001],
+        data_noise=[0.001],
+        type=circuit_type,
+        rounds=[3],
+        diams=[4],
+        workers=1,
+        force=force,
+        dem_dir=None,
+    )
+
+
+def test_write_circuit_bundle_keeps_other_sweeps():
+    with tempfile.TemporaryDirectory() as d:
+        path = pathlib.Path(d) / 'circuits.bundle'
+        _write_circuit_bundle(_sweep_args(path, 'stability'))
+        _write_circuit_bundle(_sweep_args(path, 'memory'))
+        entries = read_circuit_bundle_index(path)
+        assert sorted(e.json_metadata['type'] for e in entries) == ['memory', 'stability']
+
+        # Regenerating one sweep replaces its entries instead of duplicating them.
+        _write_circuit_bundle(_sweep_args(path, 'stability', force=True))
+        entries = read_circuit_bundle_index(path)
+        names = [file_name_for(e.json_metadata) for e in entries]
+        assert len(names) == len(set(names)) == 2
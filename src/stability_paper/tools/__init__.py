@@ -2,15 +2,31 @@ from stability_paper.tools._builder import (
     Builder,
     AtLayer,
 )
+from stability_paper.tools._bundle import (
+    CircuitBundleEntry,
+    CircuitBundleWriter,
+    iter_circuit_bundle,
+    read_circuit_bundle_entry,
+    read_circuit_bundle_index,
+)
 from stability_paper.tools._noise import (
     NoiseModel,
 )
+from stability_paper.tools._noise_cache import (
+    NoisyCircuitCache,
+)
 from stability_paper.tools._surface_code import (
+    surface_code_tile_set,
     surface_code_tiles,
     Tile,
+    TileSet,
+)
+from stability_paper.tools._unsigned_stabilizers import (
+    failing_unsigned_stabilizers,
 )
 from stability_paper.tools._util import (
     circuit_has_unsigned_stabilizers,
     not_nones,
     score_binomial_line,
+    score_binomial_lines,
 )
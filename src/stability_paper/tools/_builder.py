@@ -1,10 +1,11 @@
-from typing import Iterable, Dict, Callable, Any, Optional, List, Tuple, Generic, TypeVar
+from typing import Iterable, Dict, Callable, Any, Optional, List, Tuple, Generic, TypeVar, FrozenSet
 
 import dataclasses
 
+import numpy as np
 import stim
 
-from stability_paper.tools._util import complex_key, sorted_complex
+from stability_paper.tools._util import sorted_complex
 
 
 T = TypeVar("T")
@@ -17,51 +18,297 @@ class AtLayer(Generic[T]):
     layer: int
 
 
+_OBSTACLE = -1
+_GROUP = -2
+_MAX_FORK_DEPTH = 32
+
+
 class MeasurementTracker:
-    """Tracks measurements and groups of measurements, for producing stim record targets."""
-    def __init__(self):
-        self.recorded: Dict[Any, Optional[List[int]]] = {}
+    """Tracks measurements and groups of measurements, for producing stim record targets.
+
+    Keys are interned to integer ids. Keys naming a single measurement (the common case)
+    store their measurement index in a numpy array indexed by key id, so batches of keys
+    can be resolved with vectorized lookups. Groups of measurements are stored separately.
+
+    Trackers can be forked cheaply. Forking moves the existing records into a frozen
+    snapshot shared by both trackers, and each tracker then only stores its own new
+    records, falling back to the snapshot chain for older keys.
+
+    Args:
+        horizon: Optional look-back window, for bounding memory when building very long
+            circuits. When set, `AtLayer` keys whose layer is more than `horizon` layers
+            older than the newest recorded layer are forgotten: they are no longer `in`
+            the tracker, and looking them up raises a ValueError. Other keys are never
+            forgotten. Keys recorded at an already forgotten layer (such as the default
+            layer of `Builder.measure_pauli_product`) stay accessible until the next
+            layer is forgotten. Keys recorded before the tracker was forked become
+            inaccessible in the same way, but their memory is only reclaimed along with
+            the shared snapshot holding them.
+    """
+    def __init__(self, *, horizon: Optional[int] = None):
+        if horizon is not None and horizon < 0:
+            raise ValueError(f'{horizon=} < 0')
+        self._base: Optional[MeasurementTracker] = None
+        self._id_offset = 0
+        self._depth = 0
+        self._key_ids: Dict[Any, int] = {}
+        self._values = np.zeros(64, dtype=np.int64)
+        self._size = 0
+        self._groups: Dict[int, np.ndarray] = {}
+        self.horizon = horizon
+        self._max_layer: Optional[int] = None
+        self._evicted_below: Optional[int] = None
+        self._evicted_ids_below = 0
+        self._keys_by_layer: Dict[int, List[Any]] = {}
         self.next_measurement_index = 0
 
     def copy(self) -> 'MeasurementTracker':
-        result = MeasurementTracker()
-        result.recorded = {k: list(v) for k, v in self.recorded.items()}
+        return self.fork()
+
+    def fork(self) -> 'MeasurementTracker':
+        """Returns an independent tracker that shares (without copying) this tracker's records.
+
+        Costs O(1), instead of O(number of records) for a deep copy. Lookups of keys recorded
+        before the fork walk a chain of snapshots, which is compacted if it gets too deep.
+        """
+        if self._key_ids:
+            snapshot = MeasurementTracker()
+            snapshot._base = self._base
+            snapshot._id_offset = self._id_offset
+            snapshot._depth = self._depth
+            snapshot._key_ids = self._key_ids
+            snapshot._values = self._values
+            snapshot._size = self._size
+            snapshot._groups = self._groups
+            if snapshot._depth >= _MAX_FORK_DEPTH:
+                snapshot._compact()
+            self._base = snapshot
+            self._id_offset = snapshot._id_offset + snapshot._size
+            self._depth = snapshot._depth + 1
+            self._key_ids = {}
+            self._values = np.zeros(64, dtype=np.int64)
+            self._size = 0
+            self._groups = {}
+            self._keys_by_layer = {}
+
+        result = MeasurementTracker(horizon=self.horizon)
+        result._base = self._base
+        result._id_offset = self._id_offset
+        result._depth = self._depth
+        result._max_layer = self._max_layer
+        result._evicted_below = self._evicted_below
+        result._evicted_ids_below = self._evicted_ids_below
         result.next_measurement_index = self.next_measurement_index
         return result
 
-    def _rec(self, key: Any, value: Optional[List[int]]) -> None:
-        if key in self.recorded:
+    def _chain(self) -> List['MeasurementTracker']:
+        """This tracker followed by the snapshots it falls back to, newest first."""
+        result = []
+        t = self
+        while t is not None:
+            result.append(t)
+            t = t._base
+        return result
+
+    def _compact(self) -> None:
+        """Merges the snapshot chain into this tracker's own records.
+
+        Only used on freshly made snapshots, which no other tracker has written into.
+        """
+        chain = self._chain()[::-1]
+        key_ids = {}
+        for t in chain:
+            key_ids.update(t._key_ids)
+        values = np.concatenate([t._values[:t._size] for t in chain])
+        groups = {}
+        for t in chain:
+            groups.update(t._groups)
+        self._base = None
+        self._id_offset = 0
+        self._depth = 0
+        self._key_ids = key_ids
+        self._values = values
+        self._size = len(values)
+        self._groups = groups
+
+    def _is_old(self, key: Any) -> bool:
+        return self._evicted_below is not None and isinstance(key, AtLayer) and key.layer < self._evicted_below
+
+    def _is_evicted(self, key: Any, key_id: int) -> bool:
+        return key_id < self._evicted_ids_below and self._is_old(key)
+
+    def _find_key_id(self, key: Any) -> Optional[int]:
+        """Returns the id of a recorded key, or None if the key is missing or was forgotten."""
+        t = self
+        while t is not None:
+            key_id = t._key_ids.get(key)
+            if key_id is not None:
+                return None if self._is_evicted(key, key_id) else key_id
+            t = t._base
+        return None
+
+    def _evict_layers_before(self, layer: int) -> None:
+        self._evicted_below = layer
+        for old_layer in [e for e in self._keys_by_layer if e < layer]:
+            for key in self._keys_by_layer.pop(old_layer):
+                self._groups.pop(self._key_ids.pop(key), None)
+        if self._size > 2 * len(self._key_ids) + 64:
+            self._renumber()
+        self._evicted_ids_below = self._id_offset + self._size
+
+    def _renumber(self) -> None:
+        """Reclaims the slots of forgotten keys by giving the remaining keys consecutive ids."""
+        old_ids = np.array(list(self._key_ids.values()), dtype=np.int64)
+        new_ids = self._id_offset + np.arange(len(old_ids), dtype=np.int64)
+        values = np.zeros(max(2 * len(old_ids), 64), dtype=np.int64)
+        values[:len(old_ids)] = self._values[old_ids - self._id_offset]
+        remap = dict(zip(old_ids.tolist(), new_ids.tolist()))
+        self._key_ids = {key: remap[key_id] for key, key_id in self._key_ids.items()}
+        self._groups = {remap[key_id]: group for key_id, group in self._groups.items()}
+        self._values = values
+        self._size = len(old_ids)
+
+    @property
+    def recorded(self) -> Dict[Any, Optional[List[int]]]:
+        """The measurement indices of each recorded key (None for obstacles)."""
+        result = {}
+        for t in self._chain()[::-1]:
+            for key, key_id in t._key_ids.items():
+                if self._is_evicted(key, key_id):
+                    continue
+                v = t._values[key_id - t._id_offset]
+                if v == _OBSTACLE:
+                    result[key] = None
+                elif v == _GROUP:
+                    result[key] = [int(e) for e in t._groups[key_id]]
+                else:
+                    result[key] = [int(v)]
+        return result
+
+    def __contains__(self, key: Any) -> bool:
+        return self._find_key_id(key) is not None
+
+    def _rec(self, key: Any, value: int, group: Optional[np.ndarray] = None) -> None:
+        if key in self:
             raise ValueError(f'Measurement key collision: {key=}')
-        self.recorded[key] = value
+        n = self._size
+        if n == len(self._values):
+            self._values = np.concatenate([self._values, np.zeros(max(n, 64), dtype=np.int64)])
+        key_id = self._id_offset + n
+        self._key_ids[key] = key_id
+        self._values[n] = value
+        self._size += 1
+        if group is not None:
+            self._groups[key_id] = group
+        if self.horizon is not None and isinstance(key, AtLayer):
+            self._keys_by_layer.setdefault(key.layer, []).append(key)
+            if self._max_layer is None or key.layer > self._max_layer:
+                self._max_layer = key.layer
+                self._evict_layers_before(key.layer - self.horizon)
 
     def record_measurement(self, key: Any) -> None:
-        self._rec(key, [self.next_measurement_index])
+        self._rec(key, self.next_measurement_index)
         self.next_measurement_index += 1
 
     def make_measurement_group(self, sub_keys: Iterable[Any], *, key: Any) -> None:
-        self._rec(key, self.measurement_indices(sub_keys))
+        indices = self._measurement_index_array(sub_keys)
+        if len(indices) == 1:
+            self._rec(key, indices[0])
+        else:
+            self._rec(key, _GROUP, indices)
 
     def record_obstacle(self, key: Any) -> None:
-        self._rec(key, None)
+        self._rec(key, _OBSTACLE)
+
+    def _key_id(self, key: Any) -> int:
+        key_id = self._find_key_id(key)
+        if key_id is not None:
+            return key_id
+        if self._is_old(key):
+            raise ValueError(
+                f"Measurement {key=} was forgotten, because its layer is more than "
+                f"horizon={self.horizon} layers older than the newest layer ({self._max_layer}).")
+        raise ValueError(f"No such measurement: {key=}")
+
+    def _values_of(self, ids: np.ndarray) -> np.ndarray:
+        if self._base is None:
+            return self._values[ids]
+        values = np.empty_like(ids)
+        todo = np.ones(len(ids), dtype=np.bool_)
+        for t in self._chain():
+            mine = todo & (ids >= t._id_offset)
+            values[mine] = t._values[ids[mine] - t._id_offset]
+            todo &= ~mine
+        return values
+
+    def _group(self, key_id: int) -> np.ndarray:
+        t = self
+        while key_id < t._id_offset:
+            t = t._base
+        return t._groups[key_id]
+
+    def _resolve(self, keys: Iterable[Any]) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the measurement indices of the keys, and the position of the key each came from."""
+        keys = list(keys)
+        ids = np.array([self._key_id(key) for key in keys], dtype=np.int64)
+        values = self._values_of(ids)
+        owners = np.arange(len(keys), dtype=np.int64)
+        special = values < 0
+        if np.any(special):
+            expanded_values = [values[~special]]
+            expanded_owners = [owners[~special]]
+            for k in np.flatnonzero(special):
+                if values[k] == _OBSTACLE:
+                    raise ValueError(f"Obstacle at key={keys[k]!r}")
+                group = self._group(ids[k])
+                expanded_values.append(group)
+                expanded_owners.append(np.full(len(group), k, dtype=np.int64))
+            values = np.concatenate(expanded_values)
+            owners = np.concatenate(expanded_owners)
+        return values, owners
+
+    def _measurement_index_array(self, keys: Iterable[Any]) -> np.ndarray:
+        values, _ = self._resolve(keys)
+        return _odd_parity_values(np.zeros(len(values), dtype=np.int64), values, 1)[0]
 
     def measurement_indices(self, keys: Iterable[Any]) -> List[int]:
-        result = set()
-        for key in keys:
-            if key not in self.recorded:
-                raise ValueError(f"No such measurement: {key=}")
-            for v in self.recorded[key]:
-                if v is None:
-                    raise ValueError(f"Obstacle at {key=}")
-                if v in result:
-                    result.remove(v)
-                else:
-                    result.add(v)
-        return sorted(result)
+        return [int(e) for e in self._measurement_index_array(keys)]
+
+    def measurement_indices_batch(self, key_groups: Iterable[Iterable[Any]]) -> List[np.ndarray]:
+        """Computes `measurement_indices` for many groups of keys in one vectorized pass.
+
+        Returns:
+            A sorted array of measurement indices for each group of keys.
+        """
+        key_groups = [list(keys) for keys in key_groups]
+        flat_keys = [key for keys in key_groups for key in keys]
+        group_of_key = np.repeat(np.arange(len(key_groups), dtype=np.int64), [len(keys) for keys in key_groups])
+        values, owners = self._resolve(flat_keys)
+        return _odd_parity_values(group_of_key[owners], values, len(key_groups))
 
     def current_measurement_record_targets_for(self, keys: Iterable[Any]) -> List[stim.GateTarget]:
         t0 = self.next_measurement_index
         times = self.measurement_indices(keys)
-        return [stim.target_rec(t - t0) for t in sorted(times)]
+        return [stim.target_rec(t - t0) for t in times]
+
+
+def _odd_parity_values(groups: np.ndarray, values: np.ndarray, num_groups: int) -> List[np.ndarray]:
+    """Splits values by group, keeping the values that occur an odd number of times within their group.
+
+    Returns:
+        A sorted array of surviving values for each group.
+    """
+    order = np.lexsort((values, groups))
+    groups = groups[order]
+    values = values[order]
+    if len(values):
+        starts = np.flatnonzero(np.concatenate([[True], (groups[1:] != groups[:-1]) | (values[1:] != values[:-1])]))
+        counts = np.diff(np.concatenate([starts, [len(values)]]))
+        keep = starts[counts % 2 == 1]
+        groups = groups[keep]
+        values = values[keep]
+    bounds = np.searchsorted(groups, np.arange(num_groups + 1))
+    return [values[bounds[k]:bounds[k + 1]] for k in range(num_groups)]
 
 
 class Builder:
@@ -69,40 +316,181 @@ class Builder:
 
     Handles qubit indexing (complex -> int conversion).
     Handles measurement tracking (naming results and referring to them by name).
+
+    Qubits are sorted by a rank precomputed from `complex_key` instead of calling
+    `complex_key` on every use. When qubits are given as a frozenset, the sorted
+    qubits and their indices are cached, so reusing the same frozenset (e.g. the
+    same layer of gates in every round) skips sorting and index lookups entirely.
+
+    Builders can be forked cheaply (see `fork`), for building many variants of a
+    circuit that share a common prefix.
+
+    In buffered mode, operations are collected as stim program text instead of being
+    appended to the circuit one at a time (each `stim.Circuit.append` call is
+    expensive compared to parsing a line of text). Adjacent gates with the same name
+    are merged while buffering, and the buffer is parsed into the circuit in one step
+    when `.circuit` is read. The resulting circuit is identical in both modes.
     """
 
     def __init__(self,
                  *,
                  q2i: Dict[complex, int],
                  circuit: stim.Circuit,
-                 tracker: MeasurementTracker):
+                 tracker: MeasurementTracker,
+                 buffered: bool = False):
         self.q2i = q2i
-        self.circuit = circuit
+        self._circuit = circuit
+        self._circuit_prefix: Tuple[stim.Circuit, ...] = ()
+        self._buffer: Optional[List[Tuple[str, Optional[List[Any]]]]] = [] if buffered else None
         self.tracker = tracker
+        self._rank: Optional[Dict[complex, int]] = None
+        self._sorted_cache: Dict[FrozenSet[complex], Tuple[List[complex], List[int]]] = {}
+        self._ordered_cache: Dict[Tuple[complex, ...], List[int]] = {}
+
+    def _qubit_rank(self) -> Dict[complex, int]:
+        if self._rank is None:
+            self._rank = {q: k for k, q in enumerate(sorted_complex(self.q2i.keys()))}
+        return self._rank
+
+    def _sorted_qubits_and_indices(self, qubits: Iterable[complex]) -> Tuple[List[complex], List[int]]:
+        """Returns the given qubits in `complex_key` order, along with their qubit indices."""
+        is_frozen = isinstance(qubits, frozenset)
+        if is_frozen:
+            cached = self._sorted_cache.get(qubits)
+            if cached is not None:
+                return cached
+        sorted_qubits = sorted(qubits, key=self._qubit_rank().__getitem__)
+        result = sorted_qubits, [self.q2i[q] for q in sorted_qubits]
+        if is_frozen:
+            self._sorted_cache[qubits] = result
+        return result
+
+    @property
+    def buffered(self) -> bool:
+        return self._buffer is not None
+
+    def _append_gate(self, name: str, targets: List[Any]) -> None:
+        """Appends an instruction, merging it into the previous instruction when buffering.
+
+        Only for gates that stim itself would merge (not e.g. detectors or MPP).
+        """
+        if self._buffer is None:
+            self._circuit.append(name, targets)
+        elif self._buffer and self._buffer[-1][0] == name:
+            self._buffer[-1][1].extend(targets)
+        else:
+            self._buffer.append((name, list(targets)))
+
+    def _append_line(self, line: str) -> None:
+        """Appends one line of stim program text."""
+        if self._buffer is None:
+            self._circuit.append_from_stim_program_text(line)
+        else:
+            self._buffer.append((line, None))
+
+    def _flush(self) -> None:
+        if self._buffer:
+            self._circuit.append_from_stim_program_text('\n'.join(
+                head if targets is None else f'{head} {" ".join(map(str, targets))}'
+                for head, targets in self._buffer
+            ))
+            self._buffer.clear()
+
+    @property
+    def circuit(self) -> stim.Circuit:
+        self._flush()
+        if self._circuit_prefix:
+            full = stim.Circuit()
+            for piece in self._circuit_prefix:
+                full += piece
+            full += self._circuit
+            self._circuit = full
+            self._circuit_prefix = ()
+        return self._circuit
+
+    @circuit.setter
+    def circuit(self, value: stim.Circuit) -> None:
+        if self._buffer is not None:
+            self._buffer.clear()
+        self._circuit = value
+        self._circuit_prefix = ()
 
     def copy(self) -> 'Builder':
-        return Builder(q2i=dict(self.q2i), circuit=self.circuit.copy(), tracker=self.tracker.copy())
+        """Returns an independent builder holding its own copy of the circuit built so far.
+
+        Unlike `fork`, nothing is shared with the copy, so circuits read from either
+        builder can be mutated freely.
+        """
+        return Builder(
+            q2i=dict(self.q2i),
+            circuit=self.circuit.copy(),
+            tracker=self.tracker.copy(),
+            buffered=self.buffered,
+        )
+
+    def fork(self) -> 'Builder':
+        """Returns an independent builder that continues from this builder's current state.
+
+        The circuit built so far and the measurement history are shared with the fork
+        instead of being copied, and each builder only stores what is added to it
+        afterwards. Reading `.circuit` joins the shared pieces together. Circuits read
+        from this builder before forking must not be mutated, since they are shared.
+
+        The qubit index mapping is also shared.
+        """
+        self._flush()
+        if len(self._circuit):
+            self._circuit_prefix += (self._circuit,)
+            self._circuit = stim.Circuit()
+        result = Builder(
+            q2i=self.q2i,
+            circuit=stim.Circuit(),
+            tracker=self.tracker.fork(),
+            buffered=self.buffered,
+        )
+        result._circuit_prefix = self._circuit_prefix
+        result._rank = self._rank
+        result._sorted_cache = self._sorted_cache
+        result._ordered_cache = self._ordered_cache
+        return result
 
     @staticmethod
-    def for_qubits(qubits: Iterable[complex]) -> 'Builder':
+    def for_qubits(qubits: Iterable[complex],
+                   *,
+                   buffered: bool = False,
+                   measurement_horizon: Optional[int] = None) -> 'Builder':
         q2i = {q: i for i, q in enumerate(sorted_complex(set(qubits)))}
         circuit = stim.Circuit()
-        for q, i in q2i.items():
-            circuit.append("QUBIT_COORDS", [i], [q.real, q.imag])
+        if q2i:
+            circuit.append_from_stim_program_text('\n'.join(
+                f'QUBIT_COORDS({q.real!r}, {q.imag!r}) {i}'
+                for q, i in q2i.items()
+            ))
         return Builder(
             q2i=q2i,
             circuit=circuit,
-            tracker=MeasurementTracker(),
+            tracker=MeasurementTracker(horizon=measurement_horizon),
+            buffered=buffered,
         )
 
     def gate(self,
              name: str,
              qubits: Iterable[complex]) -> None:
-        qubits = sorted_complex(qubits)
-        self.circuit.append(name, [self.q2i[q] for q in qubits])
+        _, indices = self._sorted_qubits_and_indices(qubits)
+        self._append_gate(name, indices)
+
+    def gate_in_order(self,
+                      name: str,
+                      qubits: Tuple[complex, ...]) -> None:
+        """Like `gate`, but keeps the qubits in the given order (e.g. pairs of two qubit gate targets)."""
+        indices = self._ordered_cache.get(qubits)
+        if indices is None:
+            indices = [self.q2i[q] for q in qubits]
+            self._ordered_cache[qubits] = indices
+        self._append_gate(name, indices)
 
     def shift_coords(self, *, dp: complex = 0, dt: int):
-        self.circuit.append("SHIFT_COORDS", [], [dp.real, dp.imag, dt])
+        self._append_line(f'SHIFT_COORDS({dp.real!r}, {dp.imag!r}, {dt!r})')
 
     def measure(self,
                 qubits: Iterable[complex],
@@ -110,8 +498,8 @@ class Builder:
                 basis: str = 'Z',
                 tracker_key: Callable[[complex], Any] = lambda e: e,
                 layer: int) -> None:
-        qubits = sorted_complex(qubits)
-        self.circuit.append(f"M{basis}", [self.q2i[q] for q in qubits])
+        qubits, indices = self._sorted_qubits_and_indices(qubits)
+        self._append_gate(f"M{basis}", indices)
         for q in qubits:
             self.tracker.record_measurement(AtLayer(tracker_key(q), layer))
 
@@ -150,20 +538,15 @@ class Builder:
         z |= xy
         vals = {}
         for q in x:
-            vals[q] = stim.target_x(self.q2i[q])
+            vals[q] = 'X'
         for q in y:
-            vals[q] = stim.target_y(self.q2i[q])
+            vals[q] = 'Y'
         for q in z:
-            vals[q] = stim.target_z(self.q2i[q])
+            vals[q] = 'Z'
 
-        targets = []
-        comb = stim.target_combiner()
-        for q in sorted_complex(vals.keys()):
-            targets.append(vals[q])
-            targets.append(comb)
-        if targets:
-            targets.pop()
-            self.circuit.append('MPP', targets)
+        qubits, indices = self._sorted_qubits_and_indices(vals.keys())
+        if qubits:
+            self._append_line('MPP ' + '*'.join(f'{vals[q]}{i}' for q, i in zip(qubits, indices)))
             self.tracker.record_measurement(AtLayer(key, layer))
         else:
             self.tracker.make_measurement_group([], key=AtLayer(key, layer))
@@ -185,32 +568,58 @@ class Builder:
             coords = None
 
         if ignore_non_existent:
-            keys = [k for k in keys if k in self.tracker.recorded]
-        targets = self.tracker.current_measurement_record_targets_for(keys)
-        self.circuit.append('DETECTOR', targets, coords)
+            keys = [k for k in keys if k in self.tracker]
+        self._append_line(_record_line('DETECTOR', coords, self._record_offsets(keys)))
+
+    def detectors(self,
+                  key_groups: Iterable[Iterable[Any]],
+                  *,
+                  positions: Iterable[Optional[complex]],
+                  t: int = 0) -> None:
+        """Adds one detector per group of keys, resolving all the keys in one batch.
+
+        Equivalent to calling `detector(keys, pos=pos, t=t)` for each group of keys and its
+        position, but the detectors are added to the circuit in a single step.
+        """
+        key_groups = list(key_groups)
+        positions = list(positions)
+        if len(key_groups) != len(positions):
+            raise ValueError(f'{len(key_groups)=} != {len(positions)=}')
+        t0 = self.tracker.next_measurement_index
+        lines = []
+        for indices, pos in zip(self.tracker.measurement_indices_batch(key_groups), positions):
+            coords = None if pos is None else [pos.real, pos.imag, t]
+            lines.append(_record_line('DETECTOR', coords, (indices - t0).tolist()))
+        if not lines:
+            return
+        if self._buffer is None:
+            self._circuit.append_from_stim_program_text('\n'.join(lines))
+        else:
+            self._buffer.extend((line, None) for line in lines)
 
     def obs_include(self,
                     keys: Iterable[Any],
                     *,
                     obs_index: int) -> None:
-        self.circuit.append(
-            'OBSERVABLE_INCLUDE',
-            self.tracker.current_measurement_record_targets_for(keys),
-            obs_index,
-        )
+        self._append_line(_record_line('OBSERVABLE_INCLUDE', [obs_index], self._record_offsets(keys)))
 
     def tick(self) -> None:
-        self.circuit.append('TICK')
+        self._append_line('TICK')
 
     def cz(self, pairs: List[Tuple[complex, complex]]) -> None:
+        rank = self._qubit_rank()
         sorted_pairs = []
         for a, b in pairs:
-            if complex_key(a) > complex_key(b):
+            if rank[a] > rank[b]:
                 a, b = b, a
             sorted_pairs.append((a, b))
-        sorted_pairs = sorted(sorted_pairs, key=lambda e: (complex_key(e[0]), complex_key(e[1])))
+        sorted_pairs = sorted(sorted_pairs, key=lambda e: (rank[e[0]], rank[e[1]]))
+        targets = []
         for a, b in sorted_pairs:
-            self.circuit.append('CZ', [self.q2i[a], self.q2i[b]])
+            targets.append(self.q2i[a])
+            targets.append(self.q2i[b])
+        if targets:
+            self._append_gate('CZ', targets)
 
     def classical_paulis(self,
                          *,
@@ -218,7 +627,24 @@ class Builder:
                          targets: Iterable[complex],
                          basis: str) -> None:
         gate = f'C{basis}'
-        indices = [self.q2i[q] for q in sorted_complex(targets)]
-        for rec in self.tracker.current_measurement_record_targets_for(control_keys):
+        _, indices = self._sorted_qubits_and_indices(targets)
+        pairs = []
+        for offset in self._record_offsets(control_keys):
+            rec = f'rec[{offset}]'
             for i in indices:
-                self.circuit.append(gate, [rec, i])
+                pairs.append(rec)
+                pairs.append(i)
+        if pairs:
+            self._append_line(f'{gate} {" ".join(map(str, pairs))}')
+
+    def _record_offsets(self, keys: Iterable[Any]) -> List[int]:
+        t0 = self.tracker.next_measurement_index
+        return [t - t0 for t in self.tracker.measurement_indices(keys)]
+
+
+def _record_line(name: str, args: Optional[List[Any]], offsets: Iterable[int]) -> str:
+    """Formats an instruction targeting measurement records as a line of stim program text."""
+    recs = ''.join(f' rec[{offset}]' for offset in offsets)
+    if args is None:
+        return f'{name}{recs}'
+    return f'{name}({", ".join(repr(e) for e in args)}){recs}'
@@ -0,0 +1,249 @@
+import numpy as np
+import pytest
+import stim
+
+from stability_paper.tools import AtLayer, Builder
+from stability_paper.tools._builder import MeasurementTracker
+
+
+def test_measurement_tracker():
+    tracker = MeasurementTracker()
+    for k in range(200):
+        tracker.record_measurement(k)
+    tracker.make_measurement_group([1, 2, 3], key='g')
+    tracker.make_measurement_group([5], key='single')
+    tracker.make_measurement_group([], key='empty')
+    tracker.record_obstacle('wall')
+
+    assert 5 in tracker
+    assert 'wall' in tracker
+    assert 'other' not in tracker
+    assert tracker.recorded['g'] == [1, 2, 3]
+    assert tracker.recorded['single'] == [5]
+    assert tracker.recorded['empty'] == []
+    assert tracker.recorded['wall'] is None
+
+    assert tracker.measurement_indices([]) == []
+    assert tracker.measurement_indices([7, 3]) == [3, 7]
+    assert tracker.measurement_indices([3, 3, 7]) == [7]
+    assert tracker.measurement_indices(['g', 2, 150]) == [1, 3, 150]
+    assert tracker.measurement_indices(['g', 'g']) == []
+    with pytest.raises(ValueError, match='No such measurement'):
+        tracker.measurement_indices(['other'])
+    with pytest.raises(ValueError, match='Obstacle'):
+        tracker.measurement_indices(['wall'])
+    with pytest.raises(ValueError, match='collision'):
+        tracker.record_measurement(5)
+
+    groups = [[], [7, 3], [3, 3, 7], ['g', 2, 150], ['g', 'g'], ['single', 'empty', 199]]
+    batch = tracker.measurement_indices_batch(groups)
+    assert [e.tolist() for e in batch] == [tracker.measurement_indices(g) for g in groups]
+    assert all(e.dtype == np.int64 for e in batch)
+
+    assert tracker.current_measurement_record_targets_for([199, 198]) == [stim.target_rec(-2), stim.target_rec(-1)]
+
+    c = tracker.copy()
+    c.record_measurement('new')
+    assert 'new' in c
+    assert 'new' not in tracker
+
+
+def test_builder_detectors_matches_detector():
+    qubits = [0, 1, 2, 1j, 1 + 1j]
+    b1 = Builder.for_qubits(qubits)
+    b2 = Builder.for_qubits(qubits)
+    for b in [b1, b2]:
+        b.measure(qubits, layer=0)
+        b.measure(qubits, layer=1)
+
+    key_groups = [
+        [AtLayer(q, 1), AtLayer(q, 0)]
+        for q in qubits
+    ] + [[AtLayer(0, 0), AtLayer(1, 1), AtLayer(2, 1)]]
+    positions = [q + 0.5 for q in qubits] + [None]
+    for keys, pos in zip(key_groups, positions):
+        b1.detector(keys, pos=pos, t=2)
+    b2.detectors(key_groups, positions=positions, t=2)
+    assert b1.circuit == b2.circuit
+
+    with pytest.raises(ValueError):
+        b2.detectors(key_groups, positions=positions[1:])
+
+
+def test_builder_sorts_qubits_by_complex_key():
+    qubits = [0.5, 1j, 0, 1, 1 + 1j, 0.5 + 1j]
+    b = Builder.for_qubits(qubits)
+    assert b.q2i == {0: 0, 1j: 1, 1: 2, 1 + 1j: 3, 0.5: 4, 0.5 + 1j: 5}
+
+    layer = frozenset([1 + 1j, 0.5, 0])
+    b.gate('H', layer)
+    b.gate('H', layer)
+    b.gate('X', [0.5 + 1j, 1j])
+    b.cz([(0.5, 1), (1j, 0)])
+    b.cz([])
+    b.measure(layer, layer=0)
+    assert b.circuit[6:] == stim.Circuit("""
+        H 0 3 4 0 3 4
+        X 1 5
+        CZ 0 1 2 4
+        M 0 3 4
+    """)
+    assert b.tracker.measurement_indices([AtLayer(0.5, 0)]) == [2]
+
+
+def test_builder_fork():
+    qubits = [0, 1, 2]
+    base = Builder.for_qubits(qubits)
+    base.gate('H', qubits)
+    base.measure(qubits, layer=0)
+
+    forked = base.fork()
+    copied = base.copy()
+    for b in [forked, copied]:
+        b.gate('X', [1])
+        b.measure(qubits, layer=1)
+        b.detector([AtLayer(1, 0), AtLayer(1, 1)], pos=None)
+    base.gate('Y', [2])
+    base.measure([0], layer=1)
+
+    assert forked.circuit == copied.circuit
+    assert forked.circuit == stim.Circuit("""
+        QUBIT_COORDS(0, 0) 0
+        QUBIT_COORDS(1, 0) 1
+        QUBIT_COORDS(2, 0) 2
+        H 0 1 2
+        M 0 1 2
+        X 1
+        M 0 1 2
+        DETECTOR rec[-5] rec[-2]
+    """)
+    assert base.circuit[-2:] == stim.Circuit("""
+        Y 2
+        M 0
+    """)
+    assert AtLayer(2, 1) in forked.tracker
+    assert AtLayer(2, 1) not in base.tracker
+    assert base.tracker.measurement_indices([AtLayer(0, 1)]) == [3]
+
+
+def test_builder_copy_does_not_share_circuit():
+    b = Builder.for_qubits([0, 1])
+    b.gate('H', [0])
+    circuit = b.circuit
+    copied = b.copy()
+    circuit.append('X', [1])
+    b.gate('Y', [0])
+    copied.gate('Z', [1])
+    assert copied.circuit == stim.Circuit("""
+        QUBIT_COORDS(0, 0) 0
+        QUBIT_COORDS(1, 0) 1
+        H 0
+        Z 1
+    """)
+    assert b.circuit[-2:] == stim.Circuit("""
+        X 1
+        Y 0
+    """)
+
+
+def test_measurement_tracker_deep_fork_chain():
+    tracker = MeasurementTracker()
+    trackers = [tracker]
+    for k in range(100):
+        tracker = tracker.fork()
+        tracker.record_measurement(k)
+        trackers.append(tracker)
+    assert tracker.measurement_indices([0, 50, 99]) == [0, 50, 99]
+    assert trackers[10].measurement_indices([9]) == [9]
+    assert 10 not in trackers[10]
+
+
+def test_buffered_builder_matches_unbuffered():
+    qubits = [0, 1, 2, 1j, 1 + 1j]
+    circuits = []
+    for buffered in [False, True]:
+        b = Builder.for_qubits(qubits, buffered=buffered)
+        b.gate('R', qubits)
+        b.gate('H', [0, 1])
+        b.gate('H', [2])
+        b.gate('H', [])
+        b.tick()
+        b.cz([(0, 1), (1j, 1 + 1j)])
+        b.measure(qubits, layer=0)
+        b.measure_pauli_product(xs=[0, 1], zs=[1, 2], key='p')
+        b.measure_pauli_product(xs=[], key='empty')
+        b.detector([AtLayer(0, 0), AtLayer('p', -1)], pos=1 + 2j, t=3, mark_as_post_selected=True)
+        b.detector([AtLayer(1, 0)])
+        b.detectors([[AtLayer(2, 0)], [AtLayer(1j, 0), AtLayer('empty', -1)]], positions=[0.5, None])
+        b.shift_coords(dp=0.5j, dt=1)
+        b.classical_paulis(control_keys=[AtLayer(0, 0), AtLayer('p', -1)], targets=[1, 2], basis='X')
+        b.classical_paulis(control_keys=[AtLayer(2, 0)], targets=[0], basis='X')
+        b.obs_include([AtLayer(1 + 1j, 0)], obs_index=2)
+        forked = b.fork()
+        forked.gate('X', [0])
+        circuits.append((b.circuit, forked.circuit))
+    assert circuits[0] == circuits[1]
+    assert circuits[1][1][-1] == stim.CircuitInstruction('X', [0])
+
+
+def test_measurement_tracker_horizon():
+    tracker = MeasurementTracker(horizon=1)
+    tracker.record_measurement('forever')
+    for layer in range(1000):
+        for q in range(10):
+            tracker.record_measurement(AtLayer(q, layer))
+        tracker.make_measurement_group([AtLayer(0, layer), AtLayer(1, layer)], key=AtLayer('g', layer))
+        if layer:
+            assert tracker.measurement_indices([AtLayer(3, layer), AtLayer(3, layer - 1)]) == [
+                10 * layer - 6, 10 * layer + 4]
+            assert tracker.measurement_indices([AtLayer('g', layer - 1)]) == [10 * layer - 9, 10 * layer - 8]
+    assert len(tracker._key_ids) == 23
+    assert len(tracker._values) <= 256
+    assert tracker.measurement_indices(['forever']) == [0]
+    assert len(tracker.recorded) == 23
+
+    with pytest.raises(ValueError, match='forgotten'):
+        tracker.measurement_indices([AtLayer(3, 997)])
+    assert AtLayer(3, 2) not in tracker
+
+    forked = tracker.fork()
+    forked.record_measurement(AtLayer(0, 1000))
+    assert forked.measurement_indices([AtLayer(0, 999)]) == [tracker.next_measurement_index - 10]
+    with pytest.raises(ValueError, match='forgotten'):
+        forked.measurement_indices([AtLayer(1, 998)])
+    assert AtLayer(1, 998) in tracker
+
+
+def test_measurement_tracker_horizon_keys_recorded_at_old_layers():
+    tracker = MeasurementTracker(horizon=1)
+    for layer in range(5):
+        tracker.record_measurement(AtLayer(0, layer))
+    tracker.record_measurement(AtLayer('late', 1))
+    assert AtLayer('late', 1) in tracker
+    assert AtLayer(0, 1) not in tracker
+    assert tracker.measurement_indices([AtLayer('late', 1)]) == [5]
+    forked = tracker.fork()
+    assert forked.measurement_indices([AtLayer('late', 1)]) == [5]
+
+    # Keys at old layers are still forgotten once the next layer is forgotten.
+    for t in [tracker, forked]:
+        t.record_measurement(AtLayer(0, 5))
+        assert AtLayer('late', 1) not in t
+        with pytest.raises(ValueError, match='forgotten'):
+            t.measurement_indices([AtLayer('late', 1)])
+
+
+def test_builder_horizon():
+    b = Builder.for_qubits([0, 1], measurement_horizon=2)
+    for layer in range(5):
+        b.measure([0, 1], layer=layer)
+    b.measure_pauli_product(zs=[0, 1], key='p')
+    b.detector([AtLayer('p', -1), AtLayer(0, 4)], pos=None)
+    b.detector([AtLayer(0, 0), AtLayer(0, 4), AtLayer(0, 3)], pos=None, ignore_non_existent=True)
+    with pytest.raises(ValueError, match='forgotten'):
+        b.detector([AtLayer(0, 0)], pos=None)
+    assert b.circuit[-3:] == stim.Circuit("""
+        MPP Z0*Z1
+        DETECTOR rec[-3] rec[-1]
+        DETECTOR rec[-5] rec[-3]
+    """)
@@ -0,0 +1,128 @@
+import dataclasses
+import json
+import os
+import pathlib
+import struct
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import stim
+
+BUNDLE_MAGIC = b'STIM_CIRCUIT_BUNDLE_V1\n'
+_TRAILER = struct.Struct('<QQ')
+
+
+@dataclasses.dataclass(frozen=True)
+class CircuitBundleEntry:
+    """Locates one compressed circuit within a circuit bundle file."""
+    json_metadata: Dict[str, Any]
+    offset: int
+    length: int
+    key: Optional[str] = None
+
+
+class CircuitBundleWriter:
+    """Writes many circuits into a single file with a random-access index.
+
+    Each circuit is compressed separately, so readers can decompress any one entry
+    without touching the others. The index is stored at the end of the file, and
+    is only written when the writer is closed. The bundle is written to a temporary
+    file that replaces the destination on close, so an interrupted write never
+    leaves behind a truncated bundle.
+
+    File layout:
+        BUNDLE_MAGIC
+        zlib(circuit text) for each entry, back to back
+        zlib(json index)
+        trailer: little endian uint64 index offset, uint64 index length
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path]):
+        self.path = pathlib.Path(path)
+        self._tmp_path = self.path.with_name(f'.{self.path.name}.{os.getpid()}.tmp')
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(BUNDLE_MAGIC)
+        self._entries: List[CircuitBundleEntry] = []
+
+    def __enter__(self) -> 'CircuitBundleWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            self._tmp_path.unlink(missing_ok=True)
+
+    def write(self, json_metadata: Dict[str, Any], circuit: stim.Circuit, *, key: Optional[str] = None) -> None:
+        self.write_compressed(json_metadata, compress_circuit(circuit), key=key)
+
+    def write_compressed(self, json_metadata: Dict[str, Any], data: bytes, *, key: Optional[str] = None) -> None:
+        """Adds an already-compressed entry (e.g. from `compress_circuit` or `read_compressed`)."""
+        offset = self._file.tell()
+        self._file.write(data)
+        self._entries.append(CircuitBundleEntry(
+            json_metadata=json_metadata,
+            offset=offset,
+            length=len(data),
+            key=key,
+        ))
+
+    def close(self) -> None:
+        index = json.dumps([dataclasses.asdict(e) for e in self._entries]).encode('utf8')
+        index = zlib.compress(index)
+        index_offset = self._file.tell()
+        self._file.write(index)
+        self._file.write(_TRAILER.pack(index_offset, len(index)))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+
+def compress_circuit(circuit: stim.Circuit) -> bytes:
+    return zlib.compress(f'{circuit}\n'.encode('utf8'))
+
+
+def decompress_circuit_text(data: bytes) -> str:
+    return zlib.decompress(data).decode('utf8')
+
+
+def read_circuit_bundle_index(path: Union[str, pathlib.Path]) -> List[CircuitBundleEntry]:
+    with open(path, 'rb') as f:
+        return _read_index(f)
+
+
+def read_compressed(path: Union[str, pathlib.Path], entry: CircuitBundleEntry) -> bytes:
+    with open(path, 'rb') as f:
+        f.seek(entry.offset)
+        return f.read(entry.length)
+
+
+def read_circuit_bundle_entry(path: Union[str, pathlib.Path], json_metadata: Dict[str, Any]) -> stim.Circuit:
+    """Loads the single circuit with the given metadata from a bundle."""
+    with open(path, 'rb') as f:
+        for entry in _read_index(f):
+            if entry.json_metadata == json_metadata:
+                return _read_entry(f, entry)
+    raise KeyError(f'No entry with {json_metadata=} in {path}')
+
+
+def iter_circuit_bundle(path: Union[str, pathlib.Path]) -> Iterator[Tuple[Dict[str, Any], stim.Circuit]]:
+    """Lazily yields the (metadata, circuit) pairs stored in a bundle, in the order they were written."""
+    with open(path, 'rb') as f:
+        for entry in _read_index(f):
+            yield entry.json_metadata, _read_entry(f, entry)
+
+
+def _read_entry(f, entry: CircuitBundleEntry) -> stim.Circuit:
+    f.seek(entry.offset)
+    return stim.Circuit(decompress_circuit_text(f.read(entry.length)))
+
+
+def _read_index(f) -> List[CircuitBundleEntry]:
+    if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+        raise ValueError(f'Not a circuit bundle: {f.name}')
+    f.seek(-_TRAILER.size, os.SEEK_END)
+    index_offset, index_length = _TRAILER.unpack(f.read(_TRAILER.size))
+    f.seek(index_offset)
+    index = json.loads(zlib.decompress(f.read(index_length)).decode('utf8'))
+    return [CircuitBundleEntry(**e) for e in index]
@@ -0,0 +1,53 @@
+import pytest
+import stim
+
+from stability_paper.tools._bundle import CircuitBundleWriter, iter_circuit_bundle, read_circuit_bundle_entry, \
+    read_circuit_bundle_index, read_compressed
+
+
+def test_circuit_bundle_round_trip(tmp_path):
+    path = tmp_path / 'test.bundle'
+    c1 = stim.Circuit("""
+        H 0
+        CX 0 1
+        M 0 1
+        DETECTOR rec[-1] rec[-2]
+    """)
+    c2 = stim.Circuit("""
+        REPEAT 3 {
+            X_ERROR(0.125) 0
+            M 0
+        }
+    """)
+    with CircuitBundleWriter(path) as writer:
+        writer.write({'d': 2}, c1, key='a')
+        writer.write({'d': 3}, c2)
+
+    assert list(iter_circuit_bundle(path)) == [({'d': 2}, c1), ({'d': 3}, c2)]
+    assert read_circuit_bundle_entry(path, {'d': 3}) == c2
+    assert read_circuit_bundle_entry(path, {'d': 2}) == c1
+    with pytest.raises(KeyError):
+        read_circuit_bundle_entry(path, {'d': 4})
+
+    index = read_circuit_bundle_index(path)
+    assert [e.key for e in index] == ['a', None]
+
+    # Compressed entries can be copied into a new bundle without decompressing them.
+    path2 = tmp_path / 'test2.bundle'
+    with CircuitBundleWriter(path2) as writer:
+        writer.write_compressed({'x': 1}, read_compressed(path, index[1]))
+    assert list(iter_circuit_bundle(path2)) == [({'x': 1}, c2)]
+
+
+def test_circuit_bundle_interrupted_write_keeps_old_bundle(tmp_path):
+    path = tmp_path / 'test.bundle'
+    with CircuitBundleWriter(path) as writer:
+        writer.write({'d': 2}, stim.Circuit('H 0'))
+
+    with pytest.raises(RuntimeError):
+        with CircuitBundleWriter(path) as writer:
+            writer.write({'d': 3}, stim.Circuit('H 1'))
+            raise RuntimeError('interrupted')
+
+    assert list(iter_circuit_bundle(path)) == [({'d': 2}, stim.Circuit('H 0'))]
+    assert [p.name for p in tmp_path.iterdir()] == ['test.bundle']
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import pathlib
+from typing import Optional, Union
+
+import stim
+
+
+def sinter_detector_error_model(circuit: stim.Circuit) -> stim.DetectorErrorModel:
+    """Derives a circuit's error model the same way sinter does when a task doesn't provide one.
+
+    Using exactly the same options matters, because the error model's text is part of
+    the strong id that sinter uses to match new samples against previously saved stats.
+    """
+    return circuit.detector_error_model(
+        allow_gauge_detectors=False,
+        approximate_disjoint_errors=True,
+        block_decomposition_from_introducing_remnant_edges=False,
+        decompose_errors=True,
+        flatten_loops=True,
+        ignore_decomposition_failures=False,
+    )
+
+
+def dem_sidecar_path(dem_dir: Union[str, pathlib.Path], circuit: stim.Circuit) -> pathlib.Path:
+    """Returns the content-addressed location of a circuit's cached detector error model."""
+    digest = hashlib.sha256(str(circuit).encode('utf8')).hexdigest()
+    return pathlib.Path(dem_dir) / f'{digest}.dem'
+
+
+def write_dem_sidecar(dem_dir: Union[str, pathlib.Path], circuit: stim.Circuit) -> pathlib.Path:
+    """Computes and saves a circuit's detector error model, unless it is already saved."""
+    path = dem_sidecar_path(dem_dir, circuit)
+    if path.exists():
+        return path
+    path.parent.mkdir(exist_ok=True, parents=True)
+    dem = sinter_detector_error_model(circuit)
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        dem.to_file(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return path
+
+
+def read_dem_sidecar(dem_dir: Union[str, pathlib.Path], circuit: stim.Circuit) -> Optional[stim.DetectorErrorModel]:
+    """Loads a circuit's cached detector error model, or returns None if it wasn't cached."""
+    path = dem_sidecar_path(dem_dir, circuit)
+    if not path.exists():
+        return None
+    return stim.DetectorErrorModel.from_file(path)
@@ -0,0 +1,21 @@
+import stim
+
+from stability_paper.tools._dem_sidecar import dem_sidecar_path, read_dem_sidecar, sinter_detector_error_model, \
+    write_dem_sidecar
+
+
+def test_dem_sidecar_round_trip(tmp_path):
+    circuit = stim.Circuit.generated('repetition_code:memory', distance=3, rounds=4, after_clifford_depolarization=0.01)
+    other = stim.Circuit.generated('repetition_code:memory', distance=3, rounds=5, after_clifford_depolarization=0.01)
+
+    assert read_dem_sidecar(tmp_path, circuit) is None
+    path = write_dem_sidecar(tmp_path, circuit)
+    assert path == dem_sidecar_path(tmp_path, circuit)
+    assert path != dem_sidecar_path(tmp_path, other)
+    assert read_dem_sidecar(tmp_path, circuit) == sinter_detector_error_model(circuit)
+    assert read_dem_sidecar(tmp_path, other) is None
+
+    # Writing again reuses the existing file.
+    mtime = path.stat().st_mtime_ns
+    assert write_dem_sidecar(tmp_path, circuit) == path
+    assert path.stat().st_mtime_ns == mtime
@@ -1,6 +1,10 @@
-from typing import Optional, Dict, Set, List, Iterator, Union, AbstractSet, DefaultDict, Any
+from typing import Optional, Dict, Set, List, Iterator, Union, AbstractSet, DefaultDict, Any, Callable, NamedTuple, \
+    Tuple, FrozenSet, TextIO
 
 import collections
+import hashlib
+import json
+import types
 
 import stim
 
@@ -96,6 +100,7 @@ OP_MEASURE_BASES = {
     'MPP': '',
 }
 COLLAPSING_OPS = {op for op, t in OP_TYPES.items() if t == JUST_RESET_1Q or t == JUST_MEASURE_1Q or t == MPP or t == MEASURE_RESET_1Q}
+RESULT_PRODUCING_OP_TYPES = {MPP, JUST_MEASURE_1Q, MEASURE_RESET_1Q}
 
 
 class NoiseRule:
@@ -125,6 +130,29 @@ class NoiseRule:
         self.after = after
         self.flip_result = flip_result
 
+    def to_json(self) -> Dict[str, Any]:
+        """Returns a canonical json-compatible description of the rule."""
+        return {
+            'after': {k: float(p) for k, p in sorted(self.after.items())},
+            'flip_result': float(self.flip_result),
+        }
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> 'NoiseRule':
+        """Inverts `to_json`."""
+        return NoiseRule(after=dict(data['after']), flip_result=data['flip_result'])
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, NoiseRule):
+            return NotImplemented
+        return self.to_json() == other.to_json()
+
+    def __hash__(self) -> int:
+        return hash((tuple(sorted(self.after.items())), self.flip_result))
+
+    def __repr__(self) -> str:
+        return f'stability_paper.tools._noise.NoiseRule(after={self.after!r}, flip_result={self.flip_result!r})'
+
     def append_noisy_version_of(self,
                                 *,
                                 split_op: stim.CircuitInstruction,
@@ -144,20 +172,219 @@ class NoiseRule:
             after_moments[(op_name, arg)].append(op_name, raw_targets, arg)
 
 
+class MomentCacheInfo(NamedTuple):
+    """Statistics about a noise model's cache of noisy moments (like `functools.lru_cache`'s `cache_info`)."""
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+def _noise_setting(name: str) -> property:
+    """A noise model attribute that recompiles the model's rules when it's assigned.
+
+    Rule dictionaries are exposed as read-only views, so they can be replaced but not edited in place.
+    """
+    private_name = f'_{name}'
+
+    def get(self: 'NoiseModel') -> Any:
+        value = getattr(self, private_name)
+        if isinstance(value, dict):
+            return types.MappingProxyType(value)
+        return value
+
+    def set(self: 'NoiseModel', value: Any) -> None:
+        if value is not None and name.endswith('_rules'):
+            value = dict(value)
+        old_value = getattr(self, private_name)
+        setattr(self, private_name, value)
+        try:
+            self._settings_changed()
+        except BaseException:
+            setattr(self, private_name, old_value)
+            self._settings_changed()
+            raise
+
+    return property(get, set)
+
+
 class NoiseModel:
+    idle_depolarization = _noise_setting('idle_depolarization')
+    additional_depolarization_waiting_for_mr = _noise_setting('additional_depolarization_waiting_for_mr')
+    gate_rules = _noise_setting('gate_rules')
+    measure_rules = _noise_setting('measure_rules')
+    any_clifford_1q_rule = _noise_setting('any_clifford_1q_rule')
+    any_clifford_2q_rule = _noise_setting('any_clifford_2q_rule')
+
     def __init__(self,
                  idle_depolarization: float,
                  additional_depolarization_waiting_for_mr: float = 0,
                  gate_rules: Optional[Dict[str, NoiseRule]] = None,
                  measure_rules: Optional[Dict[str, NoiseRule]] = None,
                  any_clifford_1q_rule: Optional[NoiseRule] = None,
-                 any_clifford_2q_rule: Optional[NoiseRule] = None):
-        self.idle_depolarization = idle_depolarization
-        self.additional_depolarization_waiting_for_mr = additional_depolarization_waiting_for_mr
-        self.gate_rules = gate_rules
-        self.measure_rules = measure_rules
-        self.any_clifford_1q_rule = any_clifford_1q_rule
-        self.any_clifford_2q_rule = any_clifford_2q_rule
+                 any_clifford_2q_rule: Optional[NoiseRule] = None,
+                 moment_cache_size: int = 256):
+        """
+        The rules are compiled into a dispatch table when the model is created, and again
+        whenever one of these attributes is assigned, so invalid configurations (unknown gates,
+        result flips on gates that don't produce results, malformed measurement bases) are
+        reported immediately.
+
+        Args:
+            idle_depolarization: Depolarization applied to system qubits that aren't operated on
+                during a moment.
+            additional_depolarization_waiting_for_mr: Extra depolarization applied to idle qubits
+                during moments where some system qubit isn't being measured or reset.
+            gate_rules: Noise rules for specific gates, by gate name. Takes precedence over the
+                other rules.
+            measure_rules: Noise rules for measurements, by the Pauli product basis they measure
+                (e.g. "Z" for M or "XX" for MPP X0*X1).
+            any_clifford_1q_rule: Noise rule for single qubit Clifford gates without a gate rule.
+            any_clifford_2q_rule: Noise rule for two qubit Clifford gates without a gate rule.
+            moment_cache_size: How many noisy moments to remember. Circuits repeat the same
+                moments over and over (e.g. the layers of a surface code round), so the noisy
+                version of each moment is memoized, keyed by the moment's operations and the
+                system qubits. The least recently used moments are forgotten first, and all of
+                them are forgotten when the model's attributes are assigned.
+        """
+        self._idle_depolarization = idle_depolarization
+        self._additional_depolarization_waiting_for_mr = additional_depolarization_waiting_for_mr
+        self._gate_rules = None if gate_rules is None else dict(gate_rules)
+        self._measure_rules = None if measure_rules is None else dict(measure_rules)
+        self._any_clifford_1q_rule = any_clifford_1q_rule
+        self._any_clifford_2q_rule = any_clifford_2q_rule
+        self._moment_cache: collections.OrderedDict = collections.OrderedDict()
+        self._moment_cache_size = moment_cache_size
+        self._moment_cache_hits = 0
+        self._moment_cache_misses = 0
+        self._settings_changed()
+
+    def _settings_changed(self) -> None:
+        self._rule_table, self._basis_dependent_ops = self._compile_rule_table()
+        self._moment_cache.clear()
+
+    def _compile_rule_table(self) -> Tuple[Dict[Tuple[str, Optional[str]], Optional[NoiseRule]], FrozenSet[str]]:
+        """Resolves the noise rule for every gate ahead of time.
+
+        Returns:
+            A (table, basis_dependent_ops) tuple. The table maps (gate name, measured basis) to
+            the gate's noise rule, or to None for annotations (which never get noise). The
+            measured basis is only part of the key for the gates in basis_dependent_ops (i.e.
+            MPP resolved through measure_rules); otherwise it is None. Missing keys are gates
+            that no rule covers.
+        """
+        gate_rules = {} if self.gate_rules is None else self.gate_rules
+        for name in gate_rules:
+            if name not in OP_TYPES:
+                raise ValueError(f'Unknown gate {name!r} in gate_rules.')
+            if OP_TYPES[name] == ANNOTATION:
+                raise ValueError(f'Annotations never get noise, but gate_rules has a rule for {name!r}.')
+        measure_rules = {} if self.measure_rules is None else self.measure_rules
+        for basis in measure_rules:
+            if not isinstance(basis, str) or not basis or basis.strip('XYZ'):
+                raise ValueError(f'Not a Pauli product basis: {basis!r} in measure_rules.')
+
+        table = {}
+        basis_dependent_ops = set()
+        for name, t in OP_TYPES.items():
+            if t == ANNOTATION:
+                table[(name, None)] = None
+                continue
+            rule = gate_rules.get(name)
+            if rule is None and t == CLIFFORD_1Q:
+                rule = self.any_clifford_1q_rule
+            elif rule is None and t == CLIFFORD_2Q:
+                rule = self.any_clifford_2q_rule
+            if rule is None and t == MPP:
+                basis_dependent_ops.add(name)
+                for basis, measure_rule in measure_rules.items():
+                    table[(name, basis)] = measure_rule
+                continue
+            if rule is None:
+                rule = measure_rules.get(OP_MEASURE_BASES.get(name))
+            if rule is None:
+                continue
+            if rule.flip_result and t not in RESULT_PRODUCING_OP_TYPES:
+                raise ValueError(f"The noise rule for {name!r} has a flip_result, but {name!r} doesn't produce results.")
+            table[(name, None)] = rule
+        return table, frozenset(basis_dependent_ops)
+
+    def to_json(self) -> Dict[str, Any]:
+        """Returns a canonical json-compatible description of the noise model.
+
+        Only the rules are described; the moment cache size doesn't affect results.
+        """
+        def rules(rs: Optional[Dict[str, NoiseRule]]) -> Any:
+            if rs is None:
+                return None
+            return {k: v.to_json() for k, v in sorted(rs.items())}
+
+        return {
+            'idle_depolarization': float(self.idle_depolarization),
+            'additional_depolarization_waiting_for_mr': float(self.additional_depolarization_waiting_for_mr),
+            'gate_rules': rules(self.gate_rules),
+            'measure_rules': rules(self.measure_rules),
+            'any_clifford_1q_rule': None if self.any_clifford_1q_rule is None else self.any_clifford_1q_rule.to_json(),
+            'any_clifford_2q_rule': None if self.any_clifford_2q_rule is None else self.any_clifford_2q_rule.to_json(),
+        }
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> 'NoiseModel':
+        """Inverts `to_json`."""
+        def rule(r: Optional[Dict[str, Any]]) -> Optional[NoiseRule]:
+            return None if r is None else NoiseRule.from_json(r)
+
+        def rules(rs: Optional[Dict[str, Any]]) -> Optional[Dict[str, NoiseRule]]:
+            return None if rs is None else {k: NoiseRule.from_json(v) for k, v in rs.items()}
+
+        return NoiseModel(
+            idle_depolarization=data['idle_depolarization'],
+            additional_depolarization_waiting_for_mr=data['additional_depolarization_waiting_for_mr'],
+            gate_rules=rules(data['gate_rules']),
+            measure_rules=rules(data['measure_rules']),
+            any_clifford_1q_rule=rule(data['any_clifford_1q_rule']),
+            any_clifford_2q_rule=rule(data['any_clifford_2q_rule']),
+        )
+
+    def content_hash(self) -> str:
+        """Returns a stable hex digest of the noise model's rules, e.g. for keying caches on disk."""
+        text = json.dumps(self.to_json(), sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, NoiseModel):
+            return NotImplemented
+        return self.to_json() == other.to_json()
+
+    def __hash__(self) -> int:
+        return hash(self.content_hash())
+
+    def __repr__(self) -> str:
+        return f'stability_paper.tools._noise.NoiseModel.from_json({self.to_json()!r})'
+
+    def moment_cache_info(self) -> MomentCacheInfo:
+        """Returns hit/miss statistics for the memoized noisy moments."""
+        return MomentCacheInfo(
+            hits=self._moment_cache_hits,
+            misses=self._moment_cache_misses,
+            maxsize=self._moment_cache_size,
+            currsize=len(self._moment_cache),
+        )
+
+    def _memoized_moment(self, key: Any, compute: Callable[[], Any]) -> Any:
+        """Returns the cached value for a moment signature, computing and caching it if needed."""
+        cache = self._moment_cache
+        result = cache.get(key)
+        if result is not None:
+            cache.move_to_end(key)
+            self._moment_cache_hits += 1
+            return result
+        self._moment_cache_misses += 1
+        result = compute()
+        cache[key] = result
+        if len(cache) > self._moment_cache_size:
+            cache.popitem(last=False)
+        return result
 
     @staticmethod
     def depolarizing_cz_noise(p: float) -> 'NoiseModel':
@@ -194,25 +421,17 @@ class NoiseModel:
         )
 
     def _noise_rule_for_split_operation(self, *, split_op: stim.CircuitInstruction) -> Optional[NoiseRule]:
-        if _occurs_in_classical_control_system(split_op=split_op):
+        name = split_op.name
+        if OP_TYPES[name] == CLIFFORD_2Q and _occurs_in_classical_control_system(split_op=split_op):
             return None
-
-        rule = self.gate_rules.get(split_op.name)
-        if rule is not None:
-            return rule
-
-        t = OP_TYPES[split_op.name]
-
-        if self.any_clifford_1q_rule is not None and t == CLIFFORD_1Q:
-            return self.any_clifford_1q_rule
-        if self.any_clifford_2q_rule is not None and t == CLIFFORD_2Q:
-            return self.any_clifford_2q_rule
-        if self.measure_rules is not None:
-            rule = self.measure_rules.get(_measure_basis(split_op=split_op))
-            if rule is not None:
-                return rule
-
-        raise ValueError(f"No noise (or lack of noise) specified for {split_op=}.")
+        if name in self._basis_dependent_ops:
+            key = (name, _measure_basis(split_op=split_op))
+        else:
+            key = (name, None)
+        try:
+            return self._rule_table[key]
+        except KeyError:
+            raise ValueError(f"No noise (or lack of noise) specified for {split_op=}.") from None
 
     def _append_idle_error(self,
                            *,
@@ -259,8 +478,19 @@ class NoiseModel:
                              *,
                              moment_split_ops: List[stim.CircuitInstruction],
                              out: stim.Circuit,
-                             system_qubits: AbstractSet[int]
+                             system_qubits: frozenset
                              ) -> None:
+        out += self._memoized_moment(
+            ('circuit', system_qubits, tuple(moment_split_ops)),
+            lambda: self._noisy_moment(moment_split_ops=moment_split_ops, system_qubits=system_qubits),
+        )
+
+    def _noisy_moment(self,
+                      *,
+                      moment_split_ops: List[stim.CircuitInstruction],
+                      system_qubits: AbstractSet[int]
+                      ) -> stim.Circuit:
+        out = stim.Circuit()
         after = collections.defaultdict(stim.Circuit)
         for split_op in moment_split_ops:
             rule = self._noise_rule_for_split_operation(split_op=split_op)
@@ -272,6 +502,7 @@ class NoiseModel:
             out += after[k]
 
         self._append_idle_error(moment_split_ops=moment_split_ops, out=out, system_qubits=system_qubits)
+        return out
 
     def noisy_circuit(self,
                       circuit: stim.Circuit,
@@ -288,7 +519,8 @@ class NoiseModel:
             The noisy version of the circuit.
         """
         if system_qubits is None:
-            system_qubits = set(range(circuit.num_qubits))
+            system_qubits = range(circuit.num_qubits)
+        system_qubits = frozenset(system_qubits)
 
         result = stim.Circuit()
 
@@ -309,6 +541,86 @@ class NoiseModel:
 
         return result
 
+    def iter_noisy_circuit_text(self,
+                                circuit: stim.Circuit,
+                                *,
+                                system_qubits: Optional[Set[int]] = None,
+                                ) -> Iterator[str]:
+        """Yields the text of the noisy version of a circuit, one moment at a time.
+
+        The noisy circuit is never materialized, so memory use is bounded by the size of a
+        moment instead of the size of the whole noisy circuit. The concatenated chunks are
+        exactly the text written by `print(self.noisy_circuit(circuit), file=f)`.
+
+        Args:
+            circuit: The circuit to layer noise over.
+            system_qubits: All qubits used by the circuit. These are the qubits eligible for idling noise.
+
+        Yields:
+            Chunks of text, each made up of whole lines.
+        """
+        if system_qubits is None:
+            system_qubits = range(circuit.num_qubits)
+        system_qubits = frozenset(system_qubits)
+
+        empty = True
+        for chunk in self._iter_noisy_text(circuit, system_qubits=system_qubits, indent=''):
+            empty = False
+            yield chunk
+        if empty:
+            yield '\n'
+
+    def write_noisy_circuit(self,
+                            circuit: stim.Circuit,
+                            out: TextIO,
+                            *,
+                            system_qubits: Optional[Set[int]] = None,
+                            ) -> None:
+        """Writes the noisy version of a circuit to a file, without materializing it.
+
+        Writes the same text as `print(self.noisy_circuit(circuit), file=out)`.
+        """
+        for chunk in self.iter_noisy_circuit_text(circuit, system_qubits=system_qubits):
+            out.write(chunk)
+
+    def _iter_noisy_text(self, circuit: stim.Circuit, *, system_qubits: frozenset, indent: str) -> Iterator[str]:
+        # Mirrors the structure of `noisy_circuit`.
+        first = True
+        after_block = False
+        for moment_split_ops in _iter_split_op_moments(circuit):
+            if first:
+                first = False
+            elif not after_block:
+                yield f'{indent}TICK\n'
+            if isinstance(moment_split_ops, stim.CircuitRepeatBlock):
+                yield f'{indent}REPEAT {moment_split_ops.repeat_count} {{\n'
+                yield from self._iter_noisy_text(
+                    moment_split_ops.body_copy(), system_qubits=system_qubits, indent=indent + '    ')
+                yield f'{indent}    TICK\n{indent}}}\n'
+                after_block = True
+            else:
+                # Moments are delimited by TICKs, so they print independently of each other.
+                text = self._memoized_moment(
+                    ('printed', system_qubits, tuple(moment_split_ops)),
+                    lambda: str(self._noisy_moment(moment_split_ops=moment_split_ops, system_qubits=system_qubits)),
+                )
+                if text:
+                    after_block = False
+                    yield ''.join(f'{indent}{line}\n' for line in text.split('\n'))
+
+    def noisy_circuit_vectorized(self,
+                                 circuit: stim.Circuit,
+                                 *,
+                                 system_qubits: Optional[Set[int]] = None,
+                                 ) -> stim.Circuit:
+        """Returns the same result as `noisy_circuit`, computed with array operations.
+
+        Much faster for large circuits, because moments are processed with numpy masks
+        and emitted as text in bulk instead of one instruction at a time.
+        """
+        from stability_paper.tools._noise_vectorized import noisy_circuit_vectorized
+        return noisy_circuit_vectorized(self, circuit, system_qubits=system_qubits)
+
 
 def _occurs_in_classical_control_system(*, split_op: stim.CircuitInstruction) -> bool:
     """Determines if an operation is an annotation or a classical control system update."""
@@ -401,8 +713,8 @@ def _measure_basis(*, split_op: stim.CircuitInstruction) -> Optional[str]:
         str: Pauli product string that the operation measures (e.g. "XX" or "Y").
     """
     result = OP_MEASURE_BASES.get(split_op.name)
-    targets = split_op.targets_copy()
     if result == '':
+        targets = split_op.targets_copy()
         for k in range(0, len(targets), 2):
             t = targets[k]
             if t.is_x_target:
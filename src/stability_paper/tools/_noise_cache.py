@@ -0,0 +1,107 @@
+import hashlib
+import os
+import pathlib
+from typing import List, Optional, Union
+
+import stim
+
+from stability_paper.tools._noise import NoiseModel
+
+
+class NoisyCircuitCache:
+    """A directory of noisy circuits, keyed by (noiseless circuit, noise model).
+
+    Lets repeated sweeps, notebooks, and test runs reuse noisy circuits across processes.
+    Entries are written atomically, so concurrent processes can share a directory. When
+    the directory grows past `max_bytes`, the least recently used entries are deleted.
+
+    Circuits are stored as stim program text, except that gate arguments are written
+    with full precision (stim's own text format rounds them), so cached circuits are
+    exactly equal to freshly computed ones.
+    """
+
+    def __init__(self, directory: Union[str, pathlib.Path], *, max_bytes: int = 1 << 30):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+
+    def path_for(self, circuit: stim.Circuit, noise: NoiseModel) -> pathlib.Path:
+        """Returns the content-addressed location of a noisy circuit."""
+        circuit_digest = hashlib.sha256(exact_circuit_text(circuit).encode('utf8')).hexdigest()
+        key = f'{circuit_digest}:{noise.content_hash()}'
+        return self.directory / f'{hashlib.sha256(key.encode("utf8")).hexdigest()}.stim'
+
+    def get(self, circuit: stim.Circuit, noise: NoiseModel) -> Optional[stim.Circuit]:
+        """Returns the cached noisy version of a circuit, or None if it isn't cached."""
+        path = self.path_for(circuit, noise)
+        try:
+            text = path.read_text()
+            # Mark the entry as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return stim.Circuit(text)
+
+    def put(self, circuit: stim.Circuit, noise: NoiseModel, noisy_circuit: stim.Circuit) -> pathlib.Path:
+        """Saves the noisy version of a circuit, then evicts old entries if the cache is too big."""
+        path = self.path_for(circuit, noise)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        try:
+            tmp_path.write_text(exact_circuit_text(noisy_circuit))
+            os.replace(tmp_path, path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        self.evict(keep=path)
+        return path
+
+    def noisy_circuit(self, circuit: stim.Circuit, noise: NoiseModel) -> stim.Circuit:
+        """Returns `noise.noisy_circuit(circuit)`, reusing a cached result when there is one."""
+        result = self.get(circuit, noise)
+        if result is None:
+            result = noise.noisy_circuit_vectorized(circuit)
+            self.put(circuit, noise, result)
+        return result
+
+    def evict(self, *, keep: Optional[pathlib.Path] = None) -> None:
+        """Deletes least recently used entries until the cache fits within `max_bytes`."""
+        entries = []
+        total = 0
+        for path in self.directory.glob('*.stim'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+
+
+def exact_circuit_text(circuit: stim.Circuit) -> str:
+    """Returns stim program text for a circuit, with gate arguments written at full precision."""
+    out = []
+    _append_exact_lines(circuit, iter(str(circuit).splitlines()), out)
+    return '\n'.join(out) + '\n'
+
+
+def _append_exact_lines(circuit: stim.Circuit, lines, out: List[str]) -> None:
+    for op in circuit:
+        line = next(lines)
+        if isinstance(op, stim.CircuitRepeatBlock):
+            out.append(line)
+            _append_exact_lines(op.body_copy(), lines, out)
+            out.append(next(lines))
+            continue
+        args = op.gate_args_copy()
+        if args:
+            targets = line[line.index(')') + 1:]
+            indent = line[:len(line) - len(line.lstrip())]
+            line = f'{indent}{op.name}({", ".join(repr(float(a)) for a in args)}){targets}'
+        out.append(line)
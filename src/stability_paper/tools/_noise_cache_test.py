@@ -0,0 +1,58 @@
+import os
+
+import stim
+
+from stability_paper.circuits import surface_code_stability_experiment_circuit
+from stability_paper.tools import NoiseModel, NoisyCircuitCache
+from stability_paper.tools._noise_cache import exact_circuit_text
+
+
+def test_exact_circuit_text():
+    circuit = stim.Circuit()
+    circuit.append('X_ERROR', [0], 1 / 3)
+    circuit.append('MPP', [stim.target_x(0), stim.target_combiner(), stim.target_z(1, invert=True)], 1 / 7)
+    circuit.append('DETECTOR', [stim.target_rec(-1)], [1 / 3, 2])
+    circuit.append(stim.CircuitRepeatBlock(3, circuit.copy() + stim.Circuit('''
+        REPEAT 2 {
+            DEPOLARIZE1(0.001) 0 1
+        }
+    ''')))
+    assert stim.Circuit(str(circuit)) != circuit
+    assert stim.Circuit(exact_circuit_text(circuit)) == circuit
+    assert exact_circuit_text(stim.Circuit()) == '\n'
+
+
+def test_noisy_circuit_cache(tmp_path):
+    cache = NoisyCircuitCache(tmp_path)
+    circuit = surface_code_stability_experiment_circuit(diam=4, rounds=5, basis='Z')
+    noise = NoiseModel.depolarizing_cz_noise(1 / 3000)
+    other_noise = NoiseModel.depolarizing_cz_noise(2 / 3000)
+
+    assert cache.get(circuit, noise) is None
+    expected = noise.noisy_circuit(circuit)
+    assert cache.noisy_circuit(circuit, noise) == expected
+    assert cache.get(circuit, noise) == expected
+    assert cache.get(circuit, other_noise) is None
+
+    # Equal noise models share entries, even across cache instances.
+    assert NoisyCircuitCache(tmp_path).get(circuit, NoiseModel.depolarizing_cz_noise(1 / 3000)) == expected
+    assert len(list(tmp_path.glob('*.stim'))) == 1
+
+
+def test_noisy_circuit_cache_evicts_least_recently_used(tmp_path):
+    noise = NoiseModel.depolarizing_cz_noise(1e-3)
+    circuits = [surface_code_stability_experiment_circuit(diam=4, rounds=r, basis='Z') for r in [2, 3, 4]]
+    cache = NoisyCircuitCache(tmp_path, max_bytes=10**9)
+    paths = []
+    for k, c in enumerate(circuits):
+        paths.append(cache.put(c, noise, noise.noisy_circuit(c)))
+        os.utime(paths[-1], ns=(k * 10**9, k * 10**9))
+    cache.get(circuits[0], noise)
+
+    cache.max_bytes = paths[0].stat().st_size + paths[2].stat().st_size
+    cache.evict()
+    assert [p.exists() for p in paths] == [True, False, True]
+
+    cache.max_bytes = 1
+    cache.put(circuits[1], noise, noise.noisy_circuit(circuits[1]))
+    assert [p.exists() for p in paths] == [False, True, False]
@@ -0,0 +1,84 @@
+import re
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import stim
+
+from stability_paper.tools._noise import NoiseModel
+from stability_paper.tools._noise_cache import exact_circuit_text
+
+
+def _sentinel(rank: int) -> float:
+    """A probability that's unlikely to occur in a circuit by accident."""
+    return 0.01 * (rank + 1) + 1e-10 * 3.141592653589793
+
+
+class NoisyCircuitTemplate:
+    """A circuit compiled against a family of noise models, with the noise strengths left open.
+
+    Sweeps apply noise models that differ only in their probabilities (e.g. a measurement
+    noise strength and a data noise strength) to the same circuit, producing noisy circuits
+    with identical structure. A template applies the noise model once, using distinctive
+    placeholder probabilities, and remembers where each placeholder appears in the noisy
+    circuit's text. Instantiating the template for concrete strengths only fills numbers
+    into that text, without walking the circuit again.
+
+    The structure of a noisy circuit does depend on how the strengths compare to each other
+    (equal strengths can merge noise channels, and noise channels are sorted by strength)
+    and on which strengths are zero (zero strength noise is omitted). So one template is
+    compiled per ordering of the strengths, and strengths of zero fall back to applying the
+    noise model directly.
+    """
+
+    def __init__(self,
+                 *,
+                 circuit: stim.Circuit,
+                 noise_for: Callable[..., NoiseModel],
+                 slots: Sequence[str]):
+        """
+        Args:
+            circuit: The noiseless circuit.
+            noise_for: Makes the noise model for given strengths, taking each slot as a keyword
+                argument. Every non-zero probability in the noise model should be one of the
+                strengths.
+            slots: The names of the noise strengths.
+        """
+        self.circuit = circuit
+        self.noise_for = noise_for
+        self.slots = tuple(slots)
+        self._circuit_text = exact_circuit_text(circuit)
+        self._compiled: Dict[Tuple[int, ...], List[str]] = {}
+
+    def instantiate(self, **strengths: float) -> stim.Circuit:
+        """Returns the noisy circuit for the given noise strengths, one keyword argument per slot."""
+        if set(strengths) != set(self.slots):
+            raise ValueError(f'Expected strengths for {self.slots}, but got {sorted(strengths)}.')
+        values = [float(strengths[slot]) for slot in self.slots]
+        if any(not (v > 0) for v in values):
+            return self.noise_for(**strengths).noisy_circuit_vectorized(self.circuit)
+
+        distinct = sorted(set(values))
+        ranks = tuple(distinct.index(v) for v in values)
+        pieces = self._compiled.get(ranks)
+        if pieces is None:
+            pieces = self._compile(ranks)
+            self._compiled[ranks] = pieces
+
+        # Pieces alternate between literal text and the rank of the strength to insert.
+        text = ''.join(
+            piece if k % 2 == 0 else repr(distinct[int(piece)])
+            for k, piece in enumerate(pieces)
+        )
+        return stim.Circuit(text)
+
+    def _compile(self, ranks: Tuple[int, ...]) -> List[str]:
+        sentinels = {repr(_sentinel(r)): r for r in set(ranks)}
+        for s in sentinels:
+            if s in self._circuit_text:
+                raise ValueError(f'The circuit already contains the placeholder probability {s}.')
+        noise = self.noise_for(**{slot: _sentinel(r) for slot, r in zip(self.slots, ranks)})
+        text = exact_circuit_text(noise.noisy_circuit_vectorized(self.circuit))
+        pattern = r'(?<![\w.])(' + '|'.join(re.escape(s) for s in sentinels) + r')(?![\w.])'
+        pieces = re.split(pattern, text)
+        for k in range(1, len(pieces), 2):
+            pieces[k] = str(sentinels[pieces[k]])
+        return pieces
@@ -0,0 +1,48 @@
+import pytest
+import stim
+
+from stability_paper.circuits import surface_code_memory_experiment_circuit, \
+    surface_code_stability_experiment_circuit
+from stability_paper.scripts.generate_circuit_files import noise_model_for
+from stability_paper.tools._noise_template import NoisyCircuitTemplate, _sentinel
+
+
+def _noise_for(measure: float, data: float):
+    return noise_model_for(measure_noise=measure, data_noise=data)
+
+
+@pytest.mark.parametrize('constructor', [
+    surface_code_stability_experiment_circuit,
+    surface_code_memory_experiment_circuit,
+])
+def test_noisy_circuit_template_matches_noisy_circuit(constructor):
+    circuit = constructor(diam=4, rounds=4, basis='X')
+    template = NoisyCircuitTemplate(circuit=circuit, noise_for=_noise_for, slots=['measure', 'data'])
+    strengths = [0, 1e-4, 1 / 3000, 0.001, 0.01]
+    for measure in strengths:
+        for data in strengths:
+            assert template.instantiate(measure=measure, data=data) == _noise_for(
+                measure=measure, data=data).noisy_circuit(circuit)
+    # One template for each way the (non-zero) strengths can compare.
+    assert len(template._compiled) == 3
+
+
+def test_noisy_circuit_template_validation():
+    circuit = stim.Circuit('''
+        R 0 1
+        TICK
+        H 0
+        TICK
+        M 0 1
+    ''')
+    template = NoisyCircuitTemplate(circuit=circuit, noise_for=_noise_for, slots=['measure', 'data'])
+    with pytest.raises(ValueError, match='Expected strengths'):
+        template.instantiate(measure=0.1)
+    with pytest.raises(ValueError, match='Expected strengths'):
+        template.instantiate(measure=0.1, data=0.1, other=0.1)
+    assert template.instantiate(measure=0.25, data=0.125) == _noise_for(0.25, 0.125).noisy_circuit(circuit)
+
+    circuit.append('DETECTOR', [stim.target_rec(-1)], [_sentinel(0)])
+    template = NoisyCircuitTemplate(circuit=circuit, noise_for=_noise_for, slots=['measure', 'data'])
+    with pytest.raises(ValueError, match='placeholder'):
+        template.instantiate(measure=0.25, data=0.125)
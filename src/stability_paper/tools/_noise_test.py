@@ -1,6 +1,13 @@
+import io
+import json
+
+import pytest
 import stim
 
-from stability_paper.tools._noise import _measure_basis, _iter_split_op_moments, _occurs_in_classical_control_system
+import stability_paper
+
+from stability_paper.tools._noise import _measure_basis, _iter_split_op_moments, _occurs_in_classical_control_system, \
+    MomentCacheInfo, NoiseModel, NoiseRule
 
 
 def test_measure_basis():
@@ -78,3 +85,196 @@ def test_occurs_in_classical_control_system():
     assert _occurs_in_classical_control_system(split_op=stim.CircuitInstruction('DETECTOR', [stim.target_rec(-1)]))
     assert _occurs_in_classical_control_system(split_op=stim.CircuitInstruction('TICK', []))
     assert _occurs_in_classical_control_system(split_op=stim.CircuitInstruction('SHIFT_COORDS', []))
+
+
+def test_noisy_moment_memoization():
+    circuit = stim.Circuit("""
+        R 0 1 2
+        TICK
+        REPEAT 10 {
+            H 0
+            TICK
+            CZ 0 1
+            TICK
+            M 1
+            TICK
+            H 0
+            TICK
+            CZ 0 1
+            TICK
+            M 1
+        }
+    """)
+    noise = NoiseModel.depolarizing_cz_noise(1e-3)
+    expected = NoiseModel.depolarizing_cz_noise(1e-3).noisy_circuit(circuit)
+    assert noise.moment_cache_info() == MomentCacheInfo(hits=0, misses=0, maxsize=256, currsize=0)
+
+    assert noise.noisy_circuit(circuit) == expected
+    assert noise.moment_cache_info() == MomentCacheInfo(hits=3, misses=4, maxsize=256, currsize=4)
+    assert noise.noisy_circuit(circuit) == expected
+    assert noise.moment_cache_info() == MomentCacheInfo(hits=10, misses=4, maxsize=256, currsize=4)
+
+    # Different system qubits are a different signature.
+    noise.noisy_circuit(circuit, system_qubits={0, 1, 2, 3})
+    assert noise.moment_cache_info().misses == 8
+
+    # The vectorized engine shares the cache.
+    assert noise.noisy_circuit_vectorized(circuit) == expected
+    assert noise.noisy_circuit_vectorized(circuit) == expected
+    assert noise.moment_cache_info() == MomentCacheInfo(hits=23, misses=12, maxsize=256, currsize=12)
+
+    small = NoiseModel(
+        idle_depolarization=noise.idle_depolarization,
+        gate_rules=noise.gate_rules,
+        measure_rules=noise.measure_rules,
+        any_clifford_1q_rule=noise.any_clifford_1q_rule,
+        moment_cache_size=2,
+    )
+    assert small.noisy_circuit(circuit) == expected
+    assert small.moment_cache_info() == MomentCacheInfo(hits=0, misses=7, maxsize=2, currsize=2)
+
+
+def test_noise_model_rule_table():
+    noise = NoiseModel(
+        idle_depolarization=0,
+        any_clifford_1q_rule=NoiseRule(after={'X_ERROR': 0.1}),
+        measure_rules={'Z': NoiseRule(after={}, flip_result=0.2), 'XY': NoiseRule(after={}, flip_result=0.3)},
+        gate_rules={'H': NoiseRule(after={'Z_ERROR': 0.1}), 'MR': NoiseRule(after={}, flip_result=0.4)},
+    )
+    f = lambda e: noise._noise_rule_for_split_operation(split_op=stim.Circuit(e)[0])
+    assert f('H 0') is noise.gate_rules['H']
+    assert f('S 0') is noise.any_clifford_1q_rule
+    assert f('M 0') is noise.measure_rules['Z']
+    assert f('MZ 0') is noise.measure_rules['Z']
+    assert f('MPP Z0') is noise.measure_rules['Z']
+    assert f('MPP X0*Y1') is noise.measure_rules['XY']
+    assert f('MR 0') is noise.gate_rules['MR']
+    assert f('DETECTOR rec[-1]') is None
+    assert f('CX rec[-1] 0') is None
+    with pytest.raises(ValueError, match='No noise'):
+        f('CX 0 1')
+    with pytest.raises(ValueError, match='No noise'):
+        f('MX 0')
+    with pytest.raises(ValueError, match='No noise'):
+        f('MPP Y0')
+
+    # Noise models without gate rules are allowed.
+    noise = NoiseModel(idle_depolarization=0.1, any_clifford_1q_rule=NoiseRule(after={}))
+    assert noise.noisy_circuit(stim.Circuit('H 0 1')) == stim.Circuit('H 0 1')
+
+
+def test_noise_model_rule_table_rejects_bad_configurations():
+    with pytest.raises(ValueError, match='Unknown gate'):
+        NoiseModel(idle_depolarization=0, gate_rules={'NOT_A_GATE': NoiseRule(after={})})
+    with pytest.raises(ValueError, match='Annotations'):
+        NoiseModel(idle_depolarization=0, gate_rules={'DETECTOR': NoiseRule(after={})})
+    with pytest.raises(ValueError, match='flip_result'):
+        NoiseModel(idle_depolarization=0, gate_rules={'H': NoiseRule(after={}, flip_result=0.1)})
+    with pytest.raises(ValueError, match='flip_result'):
+        NoiseModel(idle_depolarization=0, any_clifford_2q_rule=NoiseRule(after={}, flip_result=0.1))
+    with pytest.raises(ValueError, match='Pauli product'):
+        NoiseModel(idle_depolarization=0, measure_rules={'ZA': NoiseRule(after={})})
+    with pytest.raises(ValueError, match='Pauli product'):
+        NoiseModel(idle_depolarization=0, measure_rules={'': NoiseRule(after={})})
+
+
+
+def test_noise_model_assignment_recompiles_rules():
+    noise = NoiseModel(idle_depolarization=0, any_clifford_1q_rule=NoiseRule(after={'DEPOLARIZE1': 0.1}))
+    assert noise.noisy_circuit(stim.Circuit("H 0")) == stim.Circuit("H 0\nDEPOLARIZE1(0.1) 0")
+    noise.any_clifford_1q_rule = NoiseRule(after={'X_ERROR': 0.2})
+    assert noise.noisy_circuit(stim.Circuit("H 0")) == stim.Circuit("H 0\nX_ERROR(0.2) 0")
+    assert noise.noisy_circuit_vectorized(stim.Circuit("H 0")) == stim.Circuit("H 0\nX_ERROR(0.2) 0")
+    noise.gate_rules = {'H': NoiseRule(after={'Z_ERROR': 0.3})}
+    assert noise.noisy_circuit(stim.Circuit("H 0")) == stim.Circuit("H 0\nZ_ERROR(0.3) 0")
+    noise.idle_depolarization = 0.4
+    assert noise.noisy_circuit(stim.Circuit("H 0"), system_qubits={0, 1}) == stim.Circuit("""
+        H 0
+        Z_ERROR(0.3) 0
+        DEPOLARIZE1(0.4) 1
+    """)
+
+    # Rule dictionaries can't be edited in place, because the edit wouldn't be seen.
+    with pytest.raises(TypeError):
+        noise.gate_rules['H'] = NoiseRule(after={})
+
+    # Invalid assignments are rejected and leave the model unchanged.
+    with pytest.raises(ValueError, match='Unknown gate'):
+        noise.gate_rules = {'NOT_A_GATE': NoiseRule(after={})}
+    assert dict(noise.gate_rules) == {'H': NoiseRule(after={'Z_ERROR': 0.3})}
+    assert noise.noisy_circuit(stim.Circuit("H 0")) == stim.Circuit("H 0\nZ_ERROR(0.3) 0")
+
+
+def test_noise_model_json_round_trip():
+    noise = NoiseModel(
+        idle_depolarization=0.001,
+        additional_depolarization_waiting_for_mr=1 / 3,
+        any_clifford_1q_rule=NoiseRule(after={'X_ERROR': 0.1, 'DEPOLARIZE1': 0.2}),
+        measure_rules={'Z': NoiseRule(after={}, flip_result=0.2)},
+    )
+    data = noise.to_json()
+    assert json.loads(json.dumps(data)) == data
+    assert NoiseModel.from_json(data) == noise
+    assert NoiseModel.from_json(data).content_hash() == noise.content_hash()
+    assert NoiseModel.from_json(data).gate_rules is None
+    assert eval(repr(noise), {'stability_paper': stability_paper}) == noise
+
+    assert noise == NoiseModel(
+        idle_depolarization=0.001,
+        additional_depolarization_waiting_for_mr=1 / 3,
+        any_clifford_1q_rule=NoiseRule(after={'DEPOLARIZE1': 0.2, 'X_ERROR': 0.1}, flip_result=0.0),
+        measure_rules={'Z': NoiseRule(after={}, flip_result=0.2)},
+    )
+    assert len({noise, NoiseModel.from_json(data)}) == 1
+    different = NoiseModel.from_json({**data, 'idle_depolarization': 0.002})
+    assert different != noise
+    assert different.content_hash() != noise.content_hash()
+
+    assert NoiseRule(after={'X_ERROR': 0.1}) == NoiseRule(after={'X_ERROR': 0.1}, flip_result=0.0)
+    assert hash(NoiseRule(after={'X_ERROR': 0.1})) == hash(NoiseRule(after={'X_ERROR': 0.1}, flip_result=0.0))
+    assert NoiseRule(after={'X_ERROR': 0.1}) != NoiseRule(after={'X_ERROR': 0.2})
+
+    # The hash is stable across processes and versions.
+    assert NoiseModel.depolarizing_cz_noise(0.001).content_hash() == (
+        '30dc3221ab7cd9b65e4e6ec7d0cd1b2203fef352f80bf9ea4beb0364c98d26bb')
+
+
+def test_write_noisy_circuit_matches_print():
+    noise = NoiseModel(
+        idle_depolarization=1 / 3000,
+        any_clifford_1q_rule=NoiseRule(after={'DEPOLARIZE1': 0.001}),
+        measure_rules={'Z': NoiseRule(after={'DEPOLARIZE1': 0.001}, flip_result=0.001)},
+        gate_rules={'R': NoiseRule(after={'X_ERROR': 0.001}), 'CZ': NoiseRule(after={'DEPOLARIZE2': 0.001})},
+    )
+    circuits = [
+        stim.Circuit(),
+        stim.Circuit("""
+            QUBIT_COORDS(0, 1) 0
+            R 0 1 2
+            TICK
+            REPEAT 3 {
+                H 0
+                TICK
+                REPEAT 2 {
+                    CZ 0 1
+                    TICK
+                    M 1
+                    DETECTOR(1, 2) rec[-1]
+                }
+                TICK
+                REPEAT 2 {
+                }
+                H 2
+            }
+            M 0 1 2
+            OBSERVABLE_INCLUDE(0) rec[-1]
+        """),
+    ]
+    for circuit in circuits:
+        expected = io.StringIO()
+        print(noise.noisy_circuit(circuit), file=expected)
+        actual = io.StringIO()
+        noise.write_noisy_circuit(circuit, actual)
+        assert actual.getvalue() == expected.getvalue()
+        assert ''.join(noise.iter_noisy_circuit_text(circuit, system_qubits={0, 1, 5})) == str(
+            noise.noisy_circuit(circuit, system_qubits={0, 1, 5})) + '\n'
@@ -0,0 +1,243 @@
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple, Union, TYPE_CHECKING
+
+import numpy as np
+import stim
+
+from stability_paper.tools._noise import ANNOTATION, CLIFFORD_2Q, COLLAPSING_OPS, MPP, OP_MEASURE_BASES, \
+    OP_TYPES, RESULT_PRODUCING_OP_TYPES
+
+if TYPE_CHECKING:
+    from stability_paper.tools._noise import NoiseModel, NoiseRule
+
+
+class _FallBack(Exception):
+    """The vectorized engine can't handle a case, and the reference engine should be used instead."""
+
+
+class _System(NamedTuple):
+    """The system qubits, as a hashable set (for memoization keys) and as a sorted array."""
+    qubits: frozenset
+    array: np.ndarray
+
+
+class _SplitOp:
+    """A split operation, with its targets kept as text (the way stim prints them)."""
+    __slots__ = ['name', 'args', 'tokens', 'classical']
+
+    def __init__(self, name: str, args: List[float], tokens: List[str], classical: bool):
+        self.name = name
+        self.args = args
+        self.tokens = tokens
+        self.classical = classical
+
+
+def noisy_circuit_vectorized(noise: 'NoiseModel',
+                             circuit: stim.Circuit,
+                             *,
+                             system_qubits: Optional[Set[int]] = None) -> stim.Circuit:
+    """Computes `noise.noisy_circuit(circuit)` using array operations and bulk text emission.
+
+    Instead of appending instructions to the result one at a time, each noisy moment is
+    written out as stim program text (with gate arguments formatted exactly) and the
+    whole result is parsed in one step. Idle qubits are found with boolean masks over
+    the qubit indices instead of set differences.
+
+    Falls back to the reference implementation in cases it doesn't handle, including
+    every case where the reference implementation raises an error, so errors are the same.
+    """
+    if system_qubits is None:
+        system_qubits = range(circuit.num_qubits)
+    system_qubits = frozenset(system_qubits)
+    system = _System(qubits=system_qubits, array=np.array(sorted(system_qubits), dtype=np.int64))
+    try:
+        lines = []
+        _append_noisy_lines(noise, circuit, system=system, out=lines)
+    except _FallBack:
+        return noise.noisy_circuit(circuit, system_qubits=system_qubits)
+    result = stim.Circuit()
+    if lines:
+        result.append_from_stim_program_text('\n'.join(lines))
+    return result
+
+
+def _append_noisy_lines(noise: 'NoiseModel',
+                        circuit: stim.Circuit,
+                        *,
+                        system: _System,
+                        out: List[str]) -> None:
+    first = True
+    last_was_block = False
+    for moment in _iter_text_moments(circuit):
+        if first:
+            first = False
+        elif last_was_block:
+            pass
+        else:
+            out.append('TICK')
+        if isinstance(moment, stim.CircuitRepeatBlock):
+            out.append(f'REPEAT {moment.repeat_count} {{')
+            _append_noisy_lines(noise, moment.body_copy(), system=system, out=out)
+            out.append('TICK')
+            out.append('}')
+            last_was_block = True
+        else:
+            key = ('text', system.qubits, tuple((op.name, tuple(op.args), tuple(op.tokens)) for op in moment))
+            noisy_lines = noise._memoized_moment(
+                key, lambda: _noisy_moment_lines(noise, moment, system=system.array))
+            out.extend(noisy_lines)
+            if noisy_lines:
+                last_was_block = False
+
+
+def _noisy_moment_lines(noise: 'NoiseModel',
+                        moment: List[_SplitOp],
+                        *,
+                        system: np.ndarray) -> Tuple[str, ...]:
+    out = []
+    after: Dict[Tuple[str, float], List[np.ndarray]] = {}
+    collapse_qubits = []
+    clifford_qubits = []
+    for op in moment:
+        if op.classical:
+            out.append(_format_line(op.name, op.args, op.tokens))
+            continue
+
+        qubits = _qubits_of(op.tokens)
+        if op.name in COLLAPSING_OPS:
+            collapse_qubits.append(qubits)
+        else:
+            clifford_qubits.append(qubits)
+
+        rule = _rule_for(noise, op)
+        args = op.args
+        if rule.flip_result:
+            if OP_TYPES[op.name] not in RESULT_PRODUCING_OP_TYPES or args:
+                raise _FallBack()
+            args = [rule.flip_result]
+        out.append(_format_line(op.name, args, op.tokens))
+        for key in rule.after.items():
+            after.setdefault(key, []).append(qubits)
+
+    for (name, arg) in sorted(after.keys()):
+        out.append(_format_line(name, [arg], np.concatenate(after[(name, arg)]).tolist()))
+
+    # Find idle qubits, and check for operation collisions.
+    collapse = np.concatenate(collapse_qubits) if collapse_qubits else np.zeros(0, dtype=np.int64)
+    clifford = np.concatenate(clifford_qubits) if clifford_qubits else np.zeros(0, dtype=np.int64)
+    size = int(max(
+        system[-1] + 1 if len(system) else 0,
+        collapse.max() + 1 if len(collapse) else 0,
+        clifford.max() + 1 if len(clifford) else 0,
+    ))
+    usage = np.bincount(collapse, minlength=size) + np.bincount(clifford, minlength=size)
+    if np.any(usage > 1):
+        raise _FallBack()
+    idle = system[usage[system] == 0]
+    if len(idle) and noise.idle_depolarization:
+        out.append(_format_line('DEPOLARIZE1', [noise.idle_depolarization], idle.tolist()))
+    if noise.additional_depolarization_waiting_for_mr:
+        collapsed = np.zeros(size, dtype=np.bool_)
+        collapsed[collapse] = True
+        if np.any(~collapsed[system]):
+            out.append(_format_line('DEPOLARIZE1', [noise.additional_depolarization_waiting_for_mr], idle.tolist()))
+    return tuple(out)
+
+
+def _rule_for(noise: 'NoiseModel', op: _SplitOp) -> 'NoiseRule':
+    basis = _measure_basis_of(op) if op.name in noise._basis_dependent_ops else None
+    rule = noise._rule_table.get((op.name, basis))
+    if rule is None:
+        raise _FallBack()
+    return rule
+
+
+def _measure_basis_of(op: _SplitOp) -> Optional[str]:
+    result = OP_MEASURE_BASES.get(op.name)
+    if result == '':
+        for token in op.tokens:
+            for part in token.split('*'):
+                pauli = part.lstrip('!')[:1]
+                if pauli not in ('X', 'Y', 'Z'):
+                    raise _FallBack()
+                result += pauli
+    return result
+
+
+def _qubits_of(tokens: List[str]) -> np.ndarray:
+    """Returns the qubit indices targeted by tokens like '5', '!5', or 'X5*!Z6'."""
+    try:
+        return np.array([int(t) for t in tokens], dtype=np.int64)
+    except ValueError:
+        pass
+    result = []
+    for token in tokens:
+        for part in token.split('*'):
+            part = part.lstrip('!').lstrip('XYZ')
+            if not part.isdigit():
+                raise _FallBack()
+            result.append(int(part))
+    return np.array(result, dtype=np.int64)
+
+
+def _format_line(name: str, args: List[float], targets: List[Any]) -> str:
+    line = name
+    if args:
+        line += '(' + ', '.join(repr(float(a)) for a in args) + ')'
+    if targets:
+        line += ' ' + ' '.join(map(str, targets))
+    return line
+
+
+def _iter_text_moments(circuit: stim.Circuit) -> Iterator[Union[stim.CircuitRepeatBlock, List[_SplitOp]]]:
+    """Mirrors `_iter_split_op_moments`, but keeps targets as text instead of as `stim.GateTarget`s.
+
+    The targets are read from the circuit's text, which lists them exactly. Gate arguments
+    are read from the instructions, because the text rounds them.
+    """
+    lines = iter(str(circuit).splitlines())
+    cur_moment = []
+    for op in circuit:
+        line = next(lines)
+        if isinstance(op, stim.CircuitRepeatBlock):
+            depth = 1
+            while depth:
+                inner = next(lines).strip()
+                if inner.endswith('{'):
+                    depth += 1
+                elif inner == '}':
+                    depth -= 1
+            yield op
+            continue
+        if op.name == 'TICK':
+            yield cur_moment
+            cur_moment = []
+            continue
+        close = line.find(')')
+        targets_text = line[close + 1:] if '(' in line.split(' ', 1)[0] else line[len(op.name):]
+        tokens = targets_text.split()
+        cur_moment.extend(_split_text_op(op.name, op.gate_args_copy(), tokens))
+    if cur_moment:
+        yield cur_moment
+
+
+def _split_text_op(name: str, args: List[float], tokens: List[str]) -> Iterator[_SplitOp]:
+    t = OP_TYPES.get(name)
+    if t is None:
+        raise _FallBack()
+    if t == ANNOTATION:
+        yield _SplitOp(name, args, tokens, True)
+    elif t == CLIFFORD_2Q:
+        if any(not token.isdigit() for token in tokens):
+            if any(not token.isdigit() and not token.startswith('rec[') for token in tokens):
+                raise _FallBack()
+            # Split classical control system operations away from quantum operations.
+            for k in range(0, len(tokens), 2):
+                pair = tokens[k:k + 2]
+                yield _SplitOp(name, args, pair, any(token.startswith('rec[') for token in pair))
+        else:
+            yield _SplitOp(name, args, tokens, False)
+    elif t == MPP:
+        for token in tokens:
+            yield _SplitOp(name, args, [token], False)
+    else:
+        yield _SplitOp(name, args, tokens, False)
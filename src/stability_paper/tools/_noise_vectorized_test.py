@@ -0,0 +1,124 @@
+import pytest
+import stim
+
+from stability_paper.circuits import surface_code_memory_experiment_circuit, \
+    surface_code_stability_experiment_circuit
+from stability_paper.scripts.generate_circuit_files import noise_model_for
+from stability_paper.tools import NoiseModel
+from stability_paper.tools._noise import NoiseRule
+
+NOISE_MODELS = [
+    NoiseModel.depolarizing_cz_noise(1e-3),
+    NoiseModel.depolarizing_two_body_measurement_noise(1e-3),
+    noise_model_for(measure_noise=0.002, data_noise=0.001),
+    noise_model_for(measure_noise=0, data_noise=0.001),
+    NoiseModel(
+        idle_depolarization=0,
+        additional_depolarization_waiting_for_mr=0.01,
+        any_clifford_1q_rule=NoiseRule(after={'DEPOLARIZE1': 0.1, 'X_ERROR': 0.05}),
+        any_clifford_2q_rule=NoiseRule(after={'DEPOLARIZE2': 0.1}),
+        measure_rules={
+            'Z': NoiseRule(after={}, flip_result=0.125),
+            'X': NoiseRule(after={'Z_ERROR': 0.1}),
+            'XZ': NoiseRule(after={'DEPOLARIZE2': 0.01}, flip_result=0.1),
+        },
+        gate_rules={
+            'R': NoiseRule(after={'X_ERROR': 0.1}),
+            'RX': NoiseRule(after={}),
+            'MR': NoiseRule(after={'X_ERROR': 0.2}, flip_result=0.01),
+        },
+    ),
+]
+
+
+def _assert_same_as_reference(noise: NoiseModel, circuit: stim.Circuit):
+    try:
+        expected = noise.noisy_circuit(circuit)
+    except Exception as ex:
+        with pytest.raises(type(ex)):
+            noise.noisy_circuit_vectorized(circuit)
+        return
+    assert noise.noisy_circuit_vectorized(circuit) == expected
+
+
+@pytest.mark.parametrize('noise', NOISE_MODELS)
+@pytest.mark.parametrize('circuit', [
+    stim.Circuit(),
+    stim.Circuit("""
+        H 0
+        TICK
+        TICK
+        H
+        CX 0 1
+    """),
+    stim.Circuit("""
+        QUBIT_COORDS(0.123456789, 2) 0
+        R 0 1 2 3
+        TICK
+        H 0
+        CX rec[-1] 1 2 3
+        TICK
+        MPP X0*Z1 !X2*Y3
+        TICK
+        REPEAT 3 {
+            RX 0
+            TICK
+            REPEAT 2 {
+                MR 1 2
+                TICK
+                H 3
+            }
+            M 0
+            DETECTOR(0.1234567891, 2) rec[-1]
+        }
+        MX !0
+        TICK
+        OBSERVABLE_INCLUDE(0) rec[-1]
+    """),
+    stim.Circuit("""
+        REPEAT 2 {
+            H 0
+        }
+        TICK
+        REPEAT 2 {
+            H 0
+        }
+        H 1
+    """),
+    stim.Circuit("""
+        H 0
+        CX 0 1
+    """),
+    stim.Circuit("""
+        M(0.25) 0
+    """),
+])
+def test_noisy_circuit_vectorized_matches_reference(noise: NoiseModel, circuit: stim.Circuit):
+    _assert_same_as_reference(noise, circuit)
+
+
+@pytest.mark.parametrize('noise', NOISE_MODELS)
+def test_noisy_circuit_vectorized_matches_reference_on_sweep(noise: NoiseModel):
+    for constructor in [surface_code_stability_experiment_circuit, surface_code_memory_experiment_circuit]:
+        for diam in [2, 3, 4, 5]:
+            for rounds in [2, 3, 5]:
+                for basis in 'XZ':
+                    try:
+                        circuit = constructor(diam=diam, rounds=rounds, basis=basis)
+                    except NotImplementedError:
+                        continue
+                    _assert_same_as_reference(noise, circuit)
+    _assert_same_as_reference(noise, surface_code_stability_experiment_circuit(
+        diam=4, rounds=3, basis='Z', patches=3))
+
+
+def test_noisy_circuit_vectorized_system_qubits():
+    circuit = stim.Circuit("""
+        H 0
+        TICK
+        H 1
+    """)
+    noise = NoiseModel.depolarizing_cz_noise(1e-3)
+    for system_qubits in [{0}, {0, 1, 5}, set()]:
+        assert noise.noisy_circuit_vectorized(circuit, system_qubits=system_qubits) == noise.noisy_circuit(
+            circuit, system_qubits=system_qubits)
@@ -0,0 +1,138 @@
+import math
+import pathlib
+import time
+from typing import Iterable, Iterator, Optional, Union
+
+import numpy as np
+import sinter
+import stim
+
+from stability_paper.tools._dem_sidecar import sinter_detector_error_model
+
+
+class PackedTask:
+    """Samples a task by sampling a circuit holding several independent copies of the task's circuit.
+
+    For small codes, most of the time spent sampling and decoding a shot goes to per-shot
+    overhead rather than to the actual simulation. Packing K copies of a circuit into one
+    circuit, with copy k setting observable k, turns each sampled shot into K shots of the
+    original task. Because the copies are independent, the statistics are unchanged. The
+    stats are reported against the original task's strong id, so they combine with stats
+    collected from the original task by `sinter.collect`.
+
+    Attributes:
+        task: The original task, which must have a decoder and a single observable.
+        packed_circuit: Circuit containing `patches` independent copies of the task's circuit.
+        patches: The number of copies in the packed circuit.
+    """
+
+    def __init__(self,
+                 *,
+                 task: sinter.Task,
+                 packed_circuit: stim.Circuit,
+                 patches: int,
+                 packed_detector_error_model: Optional[stim.DetectorErrorModel] = None):
+        if task.decoder is None:
+            raise ValueError("The task's decoder must be set.")
+        if task.circuit.num_observables != 1:
+            raise ValueError(f'{task.circuit.num_observables=} != 1')
+        if packed_circuit.num_observables != patches:
+            raise ValueError(f'{packed_circuit.num_observables=} != {patches=}')
+        if packed_circuit.num_detectors != patches * task.circuit.num_detectors:
+            raise ValueError(f'{packed_circuit.num_detectors=} != {patches=} * {task.circuit.num_detectors=}')
+        if task.detector_error_model is None:
+            task = sinter.Task(
+                circuit=task.circuit,
+                decoder=task.decoder,
+                detector_error_model=sinter_detector_error_model(task.circuit),
+                json_metadata=task.json_metadata,
+            )
+        if packed_detector_error_model is None:
+            packed_detector_error_model = sinter_detector_error_model(packed_circuit)
+        self.task = task
+        self.packed_circuit = packed_circuit
+        self.packed_detector_error_model = packed_detector_error_model
+        self.patches = patches
+
+    def sample(self, num_packed_shots: int) -> sinter.TaskStats:
+        """Samples and decodes the packed circuit, reporting the results as stats of the original task.
+
+        Returns:
+            Stats for `num_packed_shots * patches` shots of the original task.
+        """
+        t0 = time.monotonic()
+        errors = sample_observable_errors(
+            circuit=self.packed_circuit,
+            dem=self.packed_detector_error_model,
+            num_shots=num_packed_shots,
+            decoder=self.task.decoder,
+        )
+        return sinter.TaskStats(
+            strong_id=self.task.strong_id(),
+            decoder=self.task.decoder,
+            json_metadata=self.task.json_metadata,
+            shots=num_packed_shots * self.patches,
+            errors=int(np.sum(errors)),
+            discards=0,
+            seconds=time.monotonic() - t0,
+        )
+
+
+def sample_observable_errors(*,
+                             circuit: stim.Circuit,
+                             dem: stim.DetectorErrorModel,
+                             num_shots: int,
+                             decoder: str) -> np.ndarray:
+    """Samples a circuit and counts how often the decoder mispredicted each observable.
+
+    Returns:
+        An int64 array with the number of mistakes for each observable.
+    """
+    num_dets = circuit.num_detectors
+    num_obs = circuit.num_observables
+    samples = circuit.compile_detector_sampler().sample(num_shots, append_observables=True)
+    dets = samples[:, :num_dets]
+    actual = samples[:, num_dets:]
+    predictions = sinter.predict_observables_bit_packed(
+        dem=dem,
+        dets_bit_packed=np.packbits(dets, axis=1, bitorder='little'),
+        decoder=decoder,
+    )
+    predicted = np.unpackbits(predictions, axis=1, count=num_obs, bitorder='little').astype(np.bool_)
+    return np.count_nonzero(predicted != actual, axis=0).astype(np.int64)
+
+
+def collect_packed(*,
+                   tasks: Iterable[PackedTask],
+                   max_shots: int,
+                   max_errors: Optional[int] = None,
+                   max_batch_shots: int = 100_000,
+                   existing_data_filepath: Union[None, str, pathlib.Path] = None) -> Iterator[sinter.TaskStats]:
+    """Collects stats for packed tasks, until each reaches its shot or error budget.
+
+    The budgets are in terms of shots of the original tasks. Stats already recorded in
+    the given existing data file (e.g. a sinter save_resume_filepath) count towards the
+    budgets.
+
+    Yields:
+        Stats for each batch that was sampled, as the batches finish.
+    """
+    existing = {}
+    if existing_data_filepath is not None and pathlib.Path(existing_data_filepath).exists():
+        existing = {stats.strong_id: stats for stats in sinter.stats_from_csv_files(existing_data_filepath)}
+
+    for packed in tasks:
+        prior = existing.get(packed.task.strong_id())
+        shots = 0 if prior is None else prior.shots
+        errors = 0 if prior is None else prior.errors
+        batch_shots = 1000
+        while shots < max_shots and (max_errors is None or errors < max_errors):
+            num_packed_shots = min(
+                math.ceil(min(batch_shots, max_shots - shots) / packed.patches),
+                max_batch_shots,
+            )
+            stats = packed.sample(num_packed_shots)
+            shots += stats.shots
+            errors += stats.errors
+            batch_shots *= 2
+            yield stats
@@ -0,0 +1,67 @@
+import pytest
+import sinter
+import stim
+
+from stability_paper.circuits import surface_code_stability_experiment_circuit
+from stability_paper.tools import NoiseModel
+from stability_paper.tools._packed_sampling import PackedTask, collect_packed
+
+
+def _packed_task(patches: int) -> PackedTask:
+    noise = NoiseModel.depolarizing_cz_noise(1e-2)
+    circuit = noise.noisy_circuit(surface_code_stability_experiment_circuit(diam=3, rounds=3, basis='Z'))
+    packed_circuit = noise.noisy_circuit(surface_code_stability_experiment_circuit(
+        diam=3, rounds=3, basis='Z', patches=patches))
+    return PackedTask(
+        task=sinter.Task(circuit=circuit, decoder='pymatching', json_metadata={'d': 3}),
+        packed_circuit=packed_circuit,
+        patches=patches,
+    )
+
+
+def test_packed_task_sample():
+    packed = _packed_task(4)
+    stats = packed.sample(500)
+    assert stats.shots == 2000
+    assert 0 < stats.errors < 1000
+    assert stats.json_metadata == {'d': 3}
+    assert stats.decoder == 'pymatching'
+    assert stats.strong_id == sinter.Task(
+        circuit=packed.task.circuit,
+        decoder='pymatching',
+        detector_error_model=packed.task.circuit.detector_error_model(decompose_errors=True),
+        json_metadata={'d': 3},
+    ).strong_id()
+
+
+def test_packed_task_validation():
+    packed = _packed_task(2)
+    with pytest.raises(ValueError, match='decoder'):
+        PackedTask(task=sinter.Task(circuit=packed.task.circuit), packed_circuit=packed.packed_circuit, patches=2)
+    with pytest.raises(ValueError, match='num_observables'):
+        PackedTask(task=packed.task, packed_circuit=packed.packed_circuit, patches=3)
+    with pytest.raises(ValueError, match='num_observables'):
+        PackedTask(
+            task=sinter.Task(circuit=stim.Circuit('M 0'), decoder='pymatching'),
+            packed_circuit=packed.packed_circuit,
+            patches=2,
+        )
+
+
+def test_collect_packed_respects_budgets_and_existing_data(tmp_path):
+    packed = _packed_task(4)
+    all_stats = list(collect_packed(tasks=[packed], max_shots=5000))
+    assert sum(s.shots for s in all_stats) >= 5000
+    assert sum(s.shots for s in all_stats[:-1]) < 5000
+
+    path = tmp_path / 'stats.csv'
+    with open(path, 'w') as f:
+        print(sinter.CSV_HEADER, file=f)
+        for s in all_stats:
+            print(s.to_csv_line(), file=f)
+    assert list(collect_packed(tasks=[packed], max_shots=5000, existing_data_filepath=path)) == []
+    more = list(collect_packed(tasks=[packed], max_shots=10000, existing_data_filepath=path))
+    assert 5000 <= sum(s.shots for s in more) < 10000
+
+    few_errors = list(collect_packed(tasks=[packed], max_shots=10**9, max_errors=1))
+    assert sum(s.errors for s in few_errors) >= 1
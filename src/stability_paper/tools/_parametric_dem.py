@@ -0,0 +1,162 @@
+import itertools
+import math
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import stim
+
+from stability_paper.tools._dem_sidecar import sinter_detector_error_model
+from stability_paper.tools._noise import NoiseRule
+from stability_paper.tools._noise_template import NoisyCircuitTemplate, _sentinel
+
+# How each kind of noise channel's probability p becomes the probability q of each of the
+# independent error components that stim splits it into. Stored as log(1 - 2q) in terms of p:
+#     X_ERROR(p): one component with q = p.
+#     DEPOLARIZE1(p): three components with (1 - 2q)^2 = 1 - 4p/3.
+#     DEPOLARIZE2(p): fifteen components with (1 - 2q)^8 = 1 - 16p/15.
+_LOG_1_MINUS_2Q: Dict[str, Callable[[float], float]] = {
+    'p': lambda p: math.log1p(-2 * p),
+    'depolarize1': lambda p: 0.5 * math.log1p(-4 * p / 3),
+    'depolarize2': lambda p: 0.125 * math.log1p(-16 * p / 15),
+}
+_CHANNEL_KINDS = {
+    'X_ERROR': 'p',
+    'Y_ERROR': 'p',
+    'Z_ERROR': 'p',
+    'DEPOLARIZE1': 'depolarize1',
+    'DEPOLARIZE2': 'depolarize2',
+}
+
+
+class ParametricDetectorErrorModel:
+    """The detector error models of a noisy circuit template, as functions of the noise strengths.
+
+    Every noise strength of a `NoisyCircuitTemplate` produces the same error mechanisms
+    with the same symptoms; only their probabilities change. Each mechanism combines
+    independent error components, and a mechanism's probability P satisfies
+
+        1 - 2P = product over components of (1 - 2q)
+
+    where each component's probability q is a function of one noise strength that depends
+    on the kind of channel it came from (e.g. DEPOLARIZE1 vs X_ERROR). So
+
+        P = (1 - exp(sum over kinds k of m_k * log(1 - 2 q_k))) / 2
+
+    where m_k counts the components of kind k that the mechanism combines. The counts
+    are recovered by extracting error models at a few noise strengths and solving for
+    them. They are then checked against one more extraction. After that, error models
+    for any noise strengths are computed directly from the counts.
+
+    The instantiated probabilities agree with the ones stim computes to within floating
+    point error, but are not always bit-for-bit identical. Because sinter includes the
+    error model's text in a task's strong id, stats collected using instantiated error
+    models should not be mixed with stats collected using stim's error models.
+    """
+
+    def __init__(self,
+                 *,
+                 template: NoisyCircuitTemplate,
+                 dem_for: Callable[[stim.Circuit], stim.DetectorErrorModel] = sinter_detector_error_model):
+        """
+        Args:
+            template: The noisy circuit template to derive error models for.
+            dem_for: Derives the error model of a noisy circuit.
+        """
+        self.template = template
+        self.dem_for = dem_for
+        self.components = _noise_components(template)
+
+        num_points = len(self.components) + 1
+        rng = np.random.default_rng(0)
+        points = [
+            {slot: float(p) for slot, p in zip(template.slots, rng.uniform(0.01, 0.1, len(template.slots)))}
+            for _ in range(num_points)
+        ]
+        structures = [self._structure(template.instantiate(**point)) for point in points]
+        # The error model's text, split around the error probabilities.
+        self._pieces = structures[0][0]
+        for pieces, _ in structures[1:]:
+            if pieces != self._pieces:
+                raise ValueError("The error mechanisms depend on the noise strengths.")
+
+        # Solve for the component counts, using all but the last point.
+        a = np.array([self._log_terms(point) for point in points[:-1]])
+        y = np.log1p(-2 * np.array([probabilities for _, probabilities in structures[:-1]]))
+        counts, _, rank, _ = np.linalg.lstsq(a, y, rcond=None)
+        if rank < len(self.components):
+            raise ValueError("Couldn't separate the noise components.")
+        self.counts = np.round(counts.T).astype(np.int64)
+        if np.any(self.counts < 0) or np.any(np.abs(counts.T - self.counts) > 1e-3):
+            raise ValueError("The error probabilities aren't combinations of the noise components.")
+
+        # Check the counts against the last point.
+        expected = structures[-1][1]
+        actual = self._probabilities(points[-1])
+        if not np.allclose(actual, expected, rtol=1e-9, atol=0):
+            raise ValueError("The error probabilities aren't combinations of the noise components.")
+
+    def instantiate(self, **strengths: float) -> stim.DetectorErrorModel:
+        """Returns the error model of the template's noisy circuit for the given noise strengths."""
+        if any(not (strengths[slot] > 0) for slot in self.template.slots):
+            # Zero strength noise removes error mechanisms instead of just changing probabilities.
+            return self.dem_for(self.template.instantiate(**strengths))
+        probabilities = map(repr, self._probabilities(strengths).tolist())
+        text = ''.join(itertools.chain.from_iterable(zip(self._pieces, probabilities))) + self._pieces[-1]
+        return stim.DetectorErrorModel(text)
+
+    def _log_terms(self, strengths: Dict[str, float]) -> List[float]:
+        return [_LOG_1_MINUS_2Q[kind](strengths[slot]) for kind, slot in self.components]
+
+    def _probabilities(self, strengths: Dict[str, float]) -> np.ndarray:
+        return -np.expm1(self.counts @ np.array(self._log_terms(strengths))) / 2
+
+    def _structure(self, circuit: stim.Circuit) -> Tuple[List[str], List[float]]:
+        """Returns the error model's text split around its error probabilities, and the error probabilities."""
+        dem = self.dem_for(circuit)
+        pieces = []
+        probabilities = []
+        piece = []
+        for instruction in dem:
+            if isinstance(instruction, stim.DemRepeatBlock):
+                raise NotImplementedError("Error models with REPEAT blocks aren't supported.")
+            if instruction.type == 'error':
+                piece.append('error(')
+                pieces.append(''.join(piece))
+                piece = [') ', str(instruction).split(' ', 1)[1], '\n']
+                probabilities.append(instruction.args_copy()[0])
+            else:
+                piece.extend([str(instruction), '\n'])
+        pieces.append(''.join(piece))
+        return pieces, probabilities
+
+
+def _noise_components(template: NoisyCircuitTemplate) -> List[Tuple[str, str]]:
+    """Finds the (channel kind, noise strength slot) pairs that a template's noise models use."""
+    sentinels = {_sentinel(k): slot for k, slot in enumerate(template.slots)}
+    noise = template.noise_for(**{slot: p for p, slot in sentinels.items()})
+    components = set()
+
+    def add(kind: str, p: float, source: str):
+        if p == 0:
+            return
+        if p not in sentinels:
+            raise ValueError(f'The probability {p} of {source} is not one of the noise strengths.')
+        components.add((kind, sentinels[p]))
+
+    def add_rule(rule: Optional[NoiseRule]):
+        if rule is None:
+            return
+        add('p', rule.flip_result, 'a result flip')
+        for name, p in rule.after.items():
+            if name not in _CHANNEL_KINDS:
+                raise NotImplementedError(f'{name} noise')
+            add(_CHANNEL_KINDS[name], p, name)
+
+    add('depolarize1', noise.idle_depolarization, 'idle depolarization')
+    add('depolarize1', noise.additional_depolarization_waiting_for_mr, 'depolarization waiting for MR')
+    for rules in [noise.gate_rules, noise.measure_rules]:
+        for rule in (rules or {}).values():
+            add_rule(rule)
+    add_rule(noise.any_clifford_1q_rule)
+    add_rule(noise.any_clifford_2q_rule)
+    return sorted(components)
@@ -0,0 +1,83 @@
+import pytest
+import stim
+
+from stability_paper.circuits import surface_code_memory_experiment_circuit, \
+    surface_code_stability_experiment_circuit
+from stability_paper.scripts.generate_circuit_files import noise_model_for
+from stability_paper.tools import NoiseModel
+from stability_paper.tools._dem_sidecar import sinter_detector_error_model
+from stability_paper.tools._noise import NoiseRule
+from stability_paper.tools._noise_template import NoisyCircuitTemplate
+from stability_paper.tools._parametric_dem import ParametricDetectorErrorModel
+
+
+def _noise_for(measure: float, data: float) -> NoiseModel:
+    return noise_model_for(measure_noise=measure, data_noise=data)
+
+
+@pytest.mark.parametrize('constructor,basis', [
+    (surface_code_stability_experiment_circuit, 'X'),
+    (surface_code_memory_experiment_circuit, 'Z'),
+])
+def test_parametric_dem_matches_extracted_dems(constructor, basis):
+    template = NoisyCircuitTemplate(
+        circuit=constructor(diam=4, rounds=5, basis=basis),
+        noise_for=_noise_for,
+        slots=['measure', 'data'],
+    )
+    parametric_dem = ParametricDetectorErrorModel(template=template)
+    assert parametric_dem.components == [
+        ('depolarize1', 'data'),
+        ('depolarize1', 'measure'),
+        ('depolarize2', 'data'),
+        ('p', 'measure'),
+    ]
+    for measure in [0, 1e-4, 0.001, 0.01]:
+        for data in [0, 1e-4, 0.001, 0.02]:
+            actual = parametric_dem.instantiate(measure=measure, data=data)
+            expected = sinter_detector_error_model(template.instantiate(measure=measure, data=data))
+            assert actual.approx_equals(expected, atol=1e-14)
+
+
+def test_parametric_dem_channel_conversions():
+    circuit = stim.Circuit("""
+        R 0 1
+        TICK
+        H 0
+        TICK
+        CZ 0 1
+        TICK
+        H 0
+        TICK
+        M 0 1
+        DETECTOR rec[-2]
+        DETECTOR rec[-1]
+    """)
+    template = NoisyCircuitTemplate(
+        circuit=circuit,
+        noise_for=lambda a, b: NoiseModel(
+            idle_depolarization=0,
+            any_clifford_1q_rule=NoiseRule(after={'DEPOLARIZE1': a, 'Y_ERROR': b}),
+            gate_rules={'R': NoiseRule(after={'X_ERROR': b}), 'CZ': NoiseRule(after={'DEPOLARIZE2': a})},
+            measure_rules={'Z': NoiseRule(after={}, flip_result=b)},
+        ),
+        slots=['a', 'b'],
+    )
+    parametric_dem = ParametricDetectorErrorModel(template=template)
+    for a, b in [(0.1, 0.2), (0.3, 0.01), (0.05, 0.05)]:
+        expected = sinter_detector_error_model(template.instantiate(a=a, b=b))
+        assert parametric_dem.instantiate(a=a, b=b).approx_equals(expected, atol=1e-14)
+
+
+def test_parametric_dem_rejects_constant_probabilities():
+    template = NoisyCircuitTemplate(
+        circuit=stim.Circuit('H 0\nTICK\nM 0\nDETECTOR rec[-1]'),
+        noise_for=lambda p: NoiseModel(
+            idle_depolarization=p,
+            any_clifford_1q_rule=NoiseRule(after={'DEPOLARIZE1': 0.001}),
+            measure_rules={'Z': NoiseRule(after={})},
+        ),
+        slots=['p'],
+    )
+    with pytest.raises(ValueError, match='not one of the noise strengths'):
+        ParametricDetectorErrorModel(template=template)
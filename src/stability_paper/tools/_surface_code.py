@@ -1,7 +1,8 @@
-import collections
 import dataclasses
 import functools
-from typing import FrozenSet, Optional, List, Tuple
+from typing import FrozenSet, Iterator, Optional, List, Sequence, Tuple
+
+import numpy as np
 
 
 def checkerboard_basis(c: complex) -> str:
@@ -30,57 +31,120 @@ class Tile:
         return frozenset(t for t in self.ordered_data if t is not None)
 
 
+class TileSet(Sequence[Tile]):
+    """The tiles of a surface code layout, stored in numpy arrays.
+
+    Indexing or iterating produces `Tile` objects on demand, so existing callers can
+    treat a tile set as a sequence of tiles while large layouts stay compact.
+
+    Attributes:
+        diam: Data qubits are at x + 1j*y for 0 <= x, y < diam.
+        measure_qubits: complex128 array with the measurement qubit of each tile.
+        data_indices: int64 array of shape (len(tiles), 4) with each tile's ordered data
+            qubits, stored as x*diam + y. Missing data qubits are -1.
+        is_x: bool array that is True for X basis tiles and False for Z basis tiles.
+    """
+
+    def __init__(self, *, diam: int, measure_qubits: np.ndarray, data_indices: np.ndarray, is_x: np.ndarray):
+        self.diam = diam
+        self.measure_qubits = measure_qubits
+        self.data_indices = data_indices
+        self.is_x = is_x
+
+    def __len__(self) -> int:
+        return len(self.measure_qubits)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._tile(k) for k in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._tile(index)
+
+    def __iter__(self) -> Iterator[Tile]:
+        for k in range(len(self)):
+            yield self._tile(k)
+
+    def _tile(self, k: int) -> Tile:
+        diam = self.diam
+        return Tile(
+            ordered_data=tuple(None if i < 0 else complex(i // diam, i % diam) for i in self.data_indices[k].tolist()),
+            measure_qubit=complex(self.measure_qubits[k]),
+            basis='X' if self.is_x[k] else 'Z',
+        )
+
+
+def surface_code_tile_set(*,
+                          diam: int,
+                          side_basis: str,
+                          top_bot_basis: str,
+                          x_order: List[complex],
+                          z_order: List[complex]) -> TileSet:
+    """Vectorized equivalent of `surface_code_tiles`, returning the tiles as a `TileSet`."""
+    # Candidate tiles, identified by their top left data qubit.
+    xs, ys = np.meshgrid(np.arange(-1, diam), np.arange(-1, diam), indexing='ij')
+    xs = xs.ravel()
+    ys = ys.ravel()
+    is_x = (xs + ys) % 2 == 0
+
+    # Omit tiles on the boundary that don't match the boundary type.
+    keep = np.ones(len(xs), dtype=np.bool_)
+    on_side = (xs == -1) | (xs == diam - 1)
+    on_top_bot = (ys == -1) | (ys == diam - 1)
+    keep &= ~on_side | (is_x == (side_basis == 'X'))
+    keep &= ~on_top_bot | (is_x == (top_bot_basis == 'X'))
+    xs = xs[keep]
+    ys = ys[keep]
+    is_x = is_x[keep]
+
+    # Pick the orientation that avoids bad hook errors.
+    orders = np.where(is_x[:, None], np.array(x_order, dtype=np.complex128), np.array(z_order, dtype=np.complex128))
+    dx = orders.real
+    dy = orders.imag
+    data_xs = xs[:, None] + dx
+    data_ys = ys[:, None] + dy
+    present = (
+        (data_xs == np.floor(data_xs))
+        & (data_ys == np.floor(data_ys))
+        & (data_xs >= 0) & (data_xs < diam)
+        & (data_ys >= 0) & (data_ys < diam)
+    )
+    data_indices = np.where(present, data_xs * diam + data_ys, -1).astype(np.int64)
+    keep = np.count_nonzero(present, axis=1) >= 2
+    xs = xs[keep]
+    ys = ys[keep]
+    is_x = is_x[keep]
+    data_indices = data_indices[keep]
+
+    # Clip exposed corner squares into triangles.
+    present = data_indices >= 0
+    usage_count = np.bincount(data_indices[present], minlength=diam * diam)
+    clipped = present & (usage_count[np.where(present, data_indices, 0)] < 2)
+    data_indices[clipped] = -1
+    keep = np.any(data_indices >= 0, axis=1)
+    if not np.any(keep):
+        raise NotImplementedError("Spec resulted in no tiles.")
+
+    return TileSet(
+        diam=diam,
+        measure_qubits=(xs[keep] + 0.5) + 1j * (ys[keep] + 0.5),
+        data_indices=data_indices[keep],
+        is_x=is_x[keep],
+    )
+
+
 def surface_code_tiles(*,
                        diam: int,
                        side_basis: str,
                        top_bot_basis: str,
                        x_order: List[complex],
                        z_order: List[complex]) -> List[Tile]:
-    data_qubits = {
-        x + 1j * y
-        for x in range(diam)
-        for y in range(diam)
-    }
-
-    tiles = []
-    for x in range(-1, diam):
-        for y in range(-1, diam):
-            tl = x + 1j*y
-            basis = checkerboard_basis(tl)
-
-            # Omit tiles on the boundary that don't match the boundary type.
-            if x in [-1, diam - 1] and basis != side_basis:
-                continue
-            if y in [-1, diam - 1] and basis != top_bot_basis:
-                continue
-
-            # Pick the orientation that avoids bad hook errors.
-            d_order = z_order if basis == 'Z' else x_order
-            order = [tl + d for d in d_order]
-            kept = tuple((d if d in data_qubits else None) for d in order)
-            if sum(d is not None for d in kept) < 2:
-                continue
-            tiles.append(Tile(
-                ordered_data=kept,
-                measure_qubit=tl + 0.5 + 0.5j,
-                basis=basis,
-            ))
-
-    # Clip exposed corner squares into triangles.
-    usage_count = collections.Counter(d for tile in tiles for d in tile.data_set)
-    clipped_data_quits = {d for d, c in usage_count.items() if c < 2}
-    tiles = [
-        Tile(
-            ordered_data=tuple(None if d in clipped_data_quits else d for d in tile.ordered_data),
-            measure_qubit=tile.measure_qubit,
-            basis=tile.basis,
-        )
-        for tile in tiles
-    ]
-    tiles = [
-        tile for tile in tiles if tile.data_set
-    ]
-    if not tiles:
-        raise NotImplementedError("Spec resulted in no tiles.")
-
-    return tiles
+    return list(surface_code_tile_set(
+        diam=diam,
+        side_basis=side_basis,
+        top_bot_basis=top_bot_basis,
+        x_order=x_order,
+        z_order=z_order,
+    ))
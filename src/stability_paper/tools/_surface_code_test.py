@@ -1,4 +1,6 @@
-from stability_paper.tools import surface_code_tiles, Tile
+import numpy as np
+
+from stability_paper.tools import surface_code_tile_set, surface_code_tiles, Tile
 
 
 def test_surface_code_tiles():
@@ -14,3 +16,31 @@ def test_surface_code_tiles():
         Tile(ordered_data=(0j, 1j, 1, 1+1j), measure_qubit=(0.5+0.5j), basis='X'),
         Tile(ordered_data=(1j, 1+1j, None, None), measure_qubit=(0.5+1.5j), basis='Z'),
     ]
+
+
+def test_surface_code_tile_set():
+    tile_set = surface_code_tile_set(
+        diam=2,
+        side_basis='X',
+        top_bot_basis='Z',
+        z_order=[0, 1, 1j, 1 + 1j],
+        x_order=[0, 1j, 1, 1 + 1j],
+    )
+    np.testing.assert_array_equal(tile_set.measure_qubits, [0.5 - 0.5j, 0.5 + 0.5j, 0.5 + 1.5j])
+    np.testing.assert_array_equal(tile_set.data_indices, [[-1, -1, 0, 2], [0, 1, 2, 3], [1, 3, -1, -1]])
+    np.testing.assert_array_equal(tile_set.is_x, [False, True, False])
+
+    assert len(tile_set) == 3
+    assert tile_set[1] == Tile(ordered_data=(0j, 1j, 1, 1+1j), measure_qubit=(0.5+0.5j), basis='X')
+    assert tile_set[-1] == tile_set[2]
+    assert tile_set[1:] == list(tile_set)[1:]
+
+    big = surface_code_tile_set(
+        diam=9,
+        side_basis='Z',
+        top_bot_basis='X',
+        z_order=[0, 1, 1j, 1 + 1j],
+        x_order=[0, 1j, 1, 1 + 1j],
+    )
+    assert sorted(len(tile.data_set) for tile in big) == [2] * 16 + [4] * 64
+    assert len({q for tile in big for q in tile.data_set}) == 9 * 9
@@ -0,0 +1,427 @@
+import functools
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import stim
+
+StabilizerFlow = Tuple[Dict[str, Iterable[Any]], Dict[str, Iterable[Any]], Iterable[stim.GateTarget]]
+
+_MEASURE_BASES = {'M': 'Z', 'MX': 'X', 'MY': 'Y'}
+_RESET_BASES = {'R': 'Z', 'RX': 'X', 'RY': 'Y'}
+_MEASURE_RESET_BASES = {'MR': 'Z', 'MRX': 'X', 'MRY': 'Y'}
+_PAULI_TARGETS = {'X': stim.target_x, 'Y': stim.target_y, 'Z': stim.target_z}
+_IGNORED_OPS = {
+    'DETECTOR',
+    'OBSERVABLE_INCLUDE',
+    'TICK',
+    'QUBIT_COORDS',
+    'SHIFT_COORDS',
+    'X_ERROR',
+    'Y_ERROR',
+    'Z_ERROR',
+    'DEPOLARIZE1',
+    'DEPOLARIZE2',
+    'PAULI_CHANNEL_1',
+    'PAULI_CHANNEL_2',
+    'E',
+    'ELSE_CORRELATED_ERROR',
+}
+# For classically controlled two qubit gates: the Pauli that a measurement record or sweep bit controls,
+# keyed by the gate and the position of the classical bit in the target pair.
+_CLASSICALLY_CONTROLLED_PAULIS = {
+    ('CX', 0): 'X',
+    ('CY', 0): 'Y',
+    ('CZ', 0): 'Z',
+    ('CZ', 1): 'Z',
+    ('XCZ', 1): 'X',
+    ('YCZ', 1): 'Y',
+}
+
+
+class _Unsupported(Exception):
+    """The circuit contains something the batched analysis doesn't handle."""
+
+
+def failing_unsigned_stabilizers(
+        circuit: stim.Circuit,
+        stabilizers: Iterable[StabilizerFlow],
+        *,
+        q2i: Dict[Any, int] = None) -> List[int]:
+    """Returns the indices of the stabilizer rules that a circuit doesn't satisfy.
+
+    Checks the same rules as `circuit_has_unsigned_stabilizers`, with the same meaning, but
+    checks all of them in one backward pass over the circuit instead of analyzing a separate
+    copy of the circuit for each rule and initial basis. Each rule's travelling stabilizer
+    is propagated backwards through the circuit (as the Pauli terms that the rule's detector
+    is sensitive to), and a rule fails if its detector would be non-deterministic: if the
+    stabilizer anticommutes with a measurement or reset on the way, or if it doesn't match
+    the initial states.
+
+    Circuits containing operations that the batched pass doesn't handle are checked by
+    analyzing a copy of the circuit per rule and initial basis instead.
+
+    Args:
+        circuit: The circuit to test.
+        stabilizers: (inputs, outputs, measurements) triplets encoding a rule to check. See
+            `circuit_has_unsigned_stabilizers`.
+        q2i: Optional dictionary for mapping qubit objects to qubit indices in the circuit. If
+            not specified, directly use qubit indices.
+
+    Returns:
+        The indices (into `stabilizers`) of the rules the circuit doesn't have, in increasing order.
+    """
+    if q2i is None:
+        q2i = {}
+    stabilizers = list(stabilizers)
+    for before, after, measurements in stabilizers:
+        assert all(m.is_measurement_record_target for m in measurements)
+        assert set("XYZ").issuperset(before.keys())
+        assert set("XYZ").issuperset(after.keys())
+    if not stabilizers:
+        return []
+    try:
+        return _failing_unsigned_stabilizers_batched(circuit, stabilizers, q2i=q2i)
+    except _Unsupported:
+        return _failing_unsigned_stabilizers_by_case_circuits(circuit, stabilizers, q2i=q2i)
+
+
+def _pauli_product(paulis: Dict[str, Iterable[Any]], q2i: Dict[Any, int]) -> List[Tuple[str, int]]:
+    return [(p, q2i.get(t, t)) for p in 'XYZ' for t in paulis.get(p, [])]
+
+
+def _failing_unsigned_stabilizers_by_case_circuits(
+        circuit: stim.Circuit,
+        stabilizers: Sequence[StabilizerFlow],
+        *,
+        q2i: Dict[Any, int]) -> List[int]:
+    """Checks each rule by asking stim whether a detector comparing its stabilizers is deterministic.
+
+    For each rule and each initial basis, builds a circuit that resets every qubit into the
+    basis, measures the input stabilizer, runs the circuit, then measures the output stabilizer,
+    with a detector comparing the measurements.
+    """
+    nq = circuit.num_qubits
+    nm = circuit.num_measurements
+    failing = []
+    for k, (before, after, measurements) in enumerate(stabilizers):
+        for init_basis in 'YXZ':
+            offsets = [m.value for m in measurements]
+            case = stim.Circuit()
+            case.append(f"R{init_basis}", range(nq))
+
+            targets = _mpp_targets(_pauli_product(before, q2i))
+            if targets:
+                case.append("MPP", targets)
+                offsets.append(-nm - 1)
+
+            case += circuit
+
+            targets = _mpp_targets(_pauli_product(after, q2i))
+            if targets:
+                case.append("MPP", targets)
+                offsets.append(0)
+                offsets = [e - 1 for e in offsets]
+
+            case.append("DETECTOR", [stim.target_rec(e) for e in offsets])
+
+            try:
+                # Verify detector is deterministic.
+                case.detector_error_model()
+            except ValueError:
+                failing.append(k)
+                break
+    return failing
+
+
+def _mpp_targets(product: List[Tuple[str, int]]) -> List[stim.GateTarget]:
+    targets = []
+    for p, q in product:
+        targets.append(_PAULI_TARGETS[p](q))
+        targets.append(stim.target_combiner())
+    if targets:
+        targets.pop()
+    return targets
+
+
+@functools.lru_cache(maxsize=None)
+def _backward_images(gate: str) -> Optional[np.ndarray]:
+    """How a unitary gate maps Pauli terms backwards, ignoring signs.
+
+    Returns a boolean matrix whose row i holds the (x0, z0, x1, z1, ...) bits of the term that
+    the i'th input term (ordered x0, z0, x1, z1, ...) becomes when moved from after the gate to
+    before it. Returns None if the gate isn't a unitary gate known to stim.
+    """
+    try:
+        tableau = stim.Tableau.from_named_gate(gate)
+    except IndexError:
+        return None
+    inverse = tableau.inverse()
+    n = len(inverse)
+    images = np.zeros(shape=(2 * n, 2 * n), dtype=np.bool_)
+    for q in range(n):
+        for row, pauli in [(2 * q, inverse.x_output(q)), (2 * q + 1, inverse.z_output(q))]:
+            for q2 in range(n):
+                images[row, 2 * q2] = pauli[q2] in (1, 2)
+                images[row, 2 * q2 + 1] = pauli[q2] in (2, 3)
+    return images
+
+
+class _Sensitivities:
+    """The Pauli terms that each of a batch of detectors is sensitive to, and their pending measurements.
+
+    Attributes:
+        xs: Boolean array, indexed by detector then qubit, of the X bits of each detector's term.
+        zs: Boolean array, indexed by detector then qubit, of the Z bits of each detector's term.
+        pending: Boolean array, indexed by detector then measurement index, of the measurements
+            each detector includes that haven't been reached yet.
+        failed: Boolean array, indexed by detector, of whether the detector is known to be
+            non-deterministic.
+    """
+
+    def __init__(self, *, num_detectors: int, num_qubits: int, num_measurements: int):
+        self.xs = np.zeros(shape=(num_detectors, num_qubits), dtype=np.bool_)
+        self.zs = np.zeros(shape=(num_detectors, num_qubits), dtype=np.bool_)
+        self.pending = np.zeros(shape=(num_detectors, num_measurements), dtype=np.bool_)
+        self.failed = np.zeros(shape=num_detectors, dtype=np.bool_)
+
+    def anticommutes(self, basis: str, qubits: Any) -> np.ndarray:
+        """Whether each detector's term anticommutes with the given single qubit Pauli on the given qubits."""
+        if basis == 'X':
+            return self.zs[:, qubits]
+        if basis == 'Z':
+            return self.xs[:, qubits]
+        return self.xs[:, qubits] ^ self.zs[:, qubits]
+
+    def anticommutes_with_product(self, product: List[Tuple[str, int]]) -> np.ndarray:
+        result = np.zeros(shape=len(self.failed), dtype=np.bool_)
+        for p, q in product:
+            result ^= self.anticommutes(p, q)
+        return result
+
+    def multiply(self, rows: np.ndarray, basis: str, qubits: Any) -> None:
+        """Multiplies single qubit Paulis onto the terms of the detectors selected by `rows`."""
+        if basis in 'XY':
+            self.xs[:, qubits] ^= rows
+        if basis in 'YZ':
+            self.zs[:, qubits] ^= rows
+
+    def multiply_row(self, row: int, product: List[Tuple[str, int]]) -> None:
+        """Multiplies a Pauli product onto one detector's term."""
+        np.logical_xor.at(self.xs[row], [q for p, q in product if p in 'XY'], True)
+        np.logical_xor.at(self.zs[row], [q for p, q in product if p in 'YZ'], True)
+
+    def measure(self, basis: str, qubits: List[int], measurement_indices: List[int]) -> None:
+        for q, m in zip(qubits[::-1], measurement_indices[::-1]):
+            self.multiply(self.pending[:, m], basis, q)
+            self.pending[:, m] = False
+            self.failed |= self.anticommutes(basis, q)
+
+    def reset(self, basis: str, qubits: List[int]) -> None:
+        for q in qubits[::-1]:
+            self.failed |= self.anticommutes(basis, q)
+            self.xs[:, q] = False
+            self.zs[:, q] = False
+
+    def measure_product(self, product: List[Tuple[str, int]], measurement_index: int) -> None:
+        rows = self.pending[:, measurement_index].copy()
+        self.pending[:, measurement_index] = False
+        for p, q in product:
+            self.multiply(rows, p, q)
+        self.failed |= self.anticommutes_with_product(product)
+
+    def apply_unitary_backwards(self, images: np.ndarray, qubit_groups: np.ndarray) -> None:
+        """Moves the terms from after to before a gate applied to each group (row) of qubits."""
+        n = qubit_groups.shape[1]
+        inputs = []
+        for k in range(n):
+            inputs.append(self.xs[:, qubit_groups[:, k]])
+            inputs.append(self.zs[:, qubit_groups[:, k]])
+        outputs = [np.zeros_like(inputs[0]) for _ in range(2 * n)]
+        for i in range(2 * n):
+            for j in range(2 * n):
+                if images[i, j]:
+                    outputs[j] ^= inputs[i]
+        for k in range(n):
+            self.xs[:, qubit_groups[:, k]] = outputs[2 * k]
+            self.zs[:, qubit_groups[:, k]] = outputs[2 * k + 1]
+
+
+def _product_of(targets: List[stim.GateTarget]) -> Iterable[List[Tuple[str, int]]]:
+    """Splits MPP targets into the Pauli products being measured."""
+    product = []
+    expect_combiner = False
+    for t in targets:
+        if t.is_combiner:
+            expect_combiner = False
+            continue
+        if expect_combiner:
+            yield product
+            product = []
+        if t.is_x_target:
+            product.append(('X', t.value))
+        elif t.is_y_target:
+            product.append(('Y', t.value))
+        elif t.is_z_target:
+            product.append(('Z', t.value))
+        else:
+            raise _Unsupported()
+        expect_combiner = True
+    if product:
+        yield product
+
+
+def _has_repeated_qubit(product: List[Tuple[str, int]]) -> bool:
+    return len({q for _, q in product}) < len(product)
+
+
+def _failing_unsigned_stabilizers_batched(
+        circuit: stim.Circuit,
+        stabilizers: Sequence[StabilizerFlow],
+        *,
+        q2i: Dict[Any, int]) -> List[int]:
+    circuit = circuit.flattened()
+    nq = circuit.num_qubits
+    nm = circuit.num_measurements
+    befores = [_pauli_product(before, q2i) for before, _, _ in stabilizers]
+    afters = [_pauli_product(after, q2i) for _, after, _ in stabilizers]
+    num_qubits = max([nq] + [q + 1 for product in befores + afters for _, q in product])
+
+    # Find the measurements included by the circuit's own detectors and observables. Stim also
+    # checks these when analyzing each rule's circuit, so they fail every rule if they're
+    # non-deterministic.
+    circuit_detectors = []
+    observables = {}
+    m = 0
+    for instruction in circuit:
+        if instruction.name in ('DETECTOR', 'OBSERVABLE_INCLUDE'):
+            included = set()
+            for t in instruction.targets_copy():
+                if t.is_measurement_record_target and m + t.value >= 0:
+                    included ^= {m + t.value}
+            if instruction.name == 'DETECTOR':
+                circuit_detectors.append(included)
+            else:
+                key = int(instruction.gate_args_copy()[0])
+                observables[key] = observables.get(key, set()) ^ included
+        elif instruction.name == 'MPP':
+            m += sum(1 for _ in _product_of(instruction.targets_copy()))
+        elif instruction.name in _MEASURE_BASES or instruction.name in _MEASURE_RESET_BASES:
+            m += len(instruction.targets_copy())
+    circuit_detectors.extend(observables.values())
+
+    num_rules = len(stabilizers)
+    s = _Sensitivities(
+        num_detectors=num_rules + len(circuit_detectors),
+        num_qubits=num_qubits,
+        num_measurements=nm,
+    )
+    before_pending = np.zeros(shape=num_rules, dtype=np.bool_)
+    for k, (before, after, measurements) in enumerate(stabilizers):
+        # Start after the output stabilizer's measurement, which the rule's detector includes.
+        s.multiply_row(k, afters[k])
+        has_before = bool(befores[k])
+        before_pending[k] = has_before
+        for t in measurements:
+            index = has_before + nm + t.value
+            if index >= has_before:
+                s.pending[k, index - has_before] ^= True
+            elif index == 0:
+                before_pending[k] ^= True
+    for k, included in enumerate(circuit_detectors):
+        s.pending[num_rules + k, sorted(included)] = True
+
+    m = nm
+    for instruction in reversed(circuit):
+        name = instruction.name
+        if name in _IGNORED_OPS:
+            continue
+        targets = instruction.targets_copy()
+        if name in _MEASURE_BASES or name in _MEASURE_RESET_BASES or name in _RESET_BASES:
+            if not all(t.is_qubit_target for t in targets):
+                raise _Unsupported()
+            qubits = [t.value for t in targets]
+            if name in _RESET_BASES:
+                s.reset(_RESET_BASES[name], qubits)
+                continue
+            indices = list(range(m - len(qubits), m))
+            m -= len(qubits)
+            if name in _MEASURE_BASES:
+                s.measure(_MEASURE_BASES[name], qubits, indices)
+            else:
+                basis = _MEASURE_RESET_BASES[name]
+                for q, index in zip(qubits[::-1], indices[::-1]):
+                    s.reset(basis, [q])
+                    s.measure(basis, [q], [index])
+            continue
+        if name == 'MPP':
+            products = list(_product_of(targets))
+            if any(_has_repeated_qubit(product) for product in products):
+                raise _Unsupported()
+            for product in products[::-1]:
+                m -= 1
+                s.measure_product(product, m)
+            continue
+
+        images = _backward_images(name)
+        if images is None:
+            raise _Unsupported()
+        arity = images.shape[0] // 2
+        groups = [targets[k:k + arity] for k in range(0, len(targets), arity)]
+        if all(t.is_qubit_target for t in targets):
+            qubit_groups = np.array([[t.value for t in g] for g in groups], dtype=np.int64)
+            if len(set(qubit_groups.flat)) == qubit_groups.size:
+                s.apply_unitary_backwards(images, qubit_groups)
+                continue
+        for group in groups[::-1]:
+            if all(t.is_qubit_target for t in group):
+                s.apply_unitary_backwards(images, np.array([[t.value for t in group]], dtype=np.int64))
+                continue
+            classical = [k for k, t in enumerate(group) if not t.is_qubit_target]
+            pauli = _CLASSICALLY_CONTROLLED_PAULIS.get((name, classical[0]))
+            if len(classical) != 1 or pauli is None:
+                raise _Unsupported()
+            bit = group[classical[0]]
+            q = group[1 - classical[0]].value
+            if bit.is_measurement_record_target:
+                if m + bit.value >= 0:
+                    s.pending[:, m + bit.value] ^= s.anticommutes(pauli, q)
+            elif not bit.is_sweep_bit_target:
+                raise _Unsupported()
+
+    # The rules' detectors also include the input stabilizer's measurement (which happens
+    # before the circuit), and the circuit's detectors must not be disturbed by it.
+    rule_failed = s.failed[:num_rules].copy()
+    circuit_xs = s.xs[num_rules:]
+    circuit_zs = s.zs[num_rules:]
+    for k in range(num_rules):
+        if _has_repeated_qubit(befores[k]) or _has_repeated_qubit(afters[k]):
+            rule_failed[k] = True
+            continue
+        if not befores[k]:
+            continue
+        anticommutes = s.anticommutes_with_product(befores[k])
+        if anticommutes[k] or np.any(anticommutes[num_rules:]):
+            rule_failed[k] = True
+        if before_pending[k]:
+            s.multiply_row(k, befores[k])
+    if np.any(s.failed[num_rules:]):
+        rule_failed[:] = True
+
+    # Every qubit in the circuit is reset into the initial basis, and other qubits start in |0>.
+    for init_basis in 'YXZ':
+        xs = s.xs[:num_rules]
+        zs = s.zs[:num_rules]
+        for term_xs, term_zs, failed in [(xs, zs, rule_failed), (circuit_xs, circuit_zs, None)]:
+            if init_basis == 'X':
+                bad = term_zs[:, :nq]
+            elif init_basis == 'Z':
+                bad = term_xs[:, :nq]
+            else:
+                bad = term_xs[:, :nq] ^ term_zs[:, :nq]
+            bad = np.any(bad, axis=1) | np.any(term_xs[:, nq:], axis=1)
+            if failed is None:
+                if np.any(bad):
+                    rule_failed[:] = True
+            else:
+                failed |= bad
+    return [int(k) for k in np.flatnonzero(rule_failed)]
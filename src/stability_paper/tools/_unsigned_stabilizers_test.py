@@ -0,0 +1,93 @@
+import random
+
+import stim
+
+from stability_paper.tools._unsigned_stabilizers import failing_unsigned_stabilizers, \
+    _failing_unsigned_stabilizers_batched, _failing_unsigned_stabilizers_by_case_circuits
+
+
+def _random_circuit(rng: random.Random, num_qubits: int, depth: int, allow_blocks: bool = True) -> stim.Circuit:
+    circuit = stim.Circuit()
+    for _ in range(depth):
+        r = rng.random()
+        if r < 0.3:
+            circuit.append(rng.choice(['H', 'S', 'SQRT_X_DAG', 'C_XYZ', 'H_YZ', 'X', 'I']),
+                           rng.sample(range(num_qubits), rng.randint(1, num_qubits)))
+        elif r < 0.55 and num_qubits >= 2:
+            circuit.append(rng.choice(['CX', 'CY', 'CZ', 'SWAP', 'ISWAP', 'SQRT_XX', 'XCZ', 'YCX']),
+                           rng.sample(range(num_qubits), 2 * rng.randint(1, num_qubits // 2)))
+        elif r < 0.75:
+            circuit.append(rng.choice(['M', 'MX', 'MY', 'MR', 'MRX', 'MRY', 'R', 'RX', 'RY']),
+                           [rng.randrange(num_qubits) for _ in range(rng.randint(1, 2))])
+        elif r < 0.82:
+            targets = []
+            for _ in range(rng.randint(1, 2)):
+                for q in rng.sample(range(num_qubits), rng.randint(1, min(3, num_qubits))):
+                    targets.append(rng.choice([stim.target_x, stim.target_y, stim.target_z])(q))
+                    targets.append(stim.target_combiner())
+                targets.pop()
+            circuit.append('MPP', targets)
+        elif r < 0.87 and circuit.num_measurements:
+            circuit.append(rng.choice(['CX', 'CY', 'CZ']),
+                           [stim.target_rec(-rng.randint(1, circuit.num_measurements)), rng.randrange(num_qubits)])
+        elif r < 0.89:
+            circuit.append('CZ', [rng.randrange(num_qubits), stim.target_sweep_bit(0)])
+        elif r < 0.92 and circuit.num_measurements:
+            circuit.append('DETECTOR', [stim.target_rec(-rng.randint(1, circuit.num_measurements))])
+        elif r < 0.94 and circuit.num_measurements:
+            circuit.append('OBSERVABLE_INCLUDE', [stim.target_rec(-rng.randint(1, circuit.num_measurements))], 0)
+        elif r < 0.96:
+            circuit.append('X_ERROR', [rng.randrange(num_qubits)], 0.1)
+        elif allow_blocks:
+            body = _random_circuit(rng, num_qubits, rng.randint(1, 4), allow_blocks=False)
+            circuit.append(stim.CircuitRepeatBlock(rng.randint(1, 3), body))
+    return circuit
+
+
+def _random_paulis(rng: random.Random, num_qubits: int):
+    result = {}
+    for q in rng.sample(range(num_qubits + 1), rng.randint(0, min(3, num_qubits + 1))):
+        result.setdefault(rng.choice('XYZ'), []).append(q)
+    return result
+
+
+def test_batched_matches_case_circuits():
+    rng = random.Random(2022)
+    num_failing = 0
+    num_rules = 0
+    for _ in range(300):
+        num_qubits = rng.randint(1, 4)
+        circuit = _random_circuit(rng, num_qubits, rng.randint(0, 8))
+        nm = circuit.num_measurements
+        rules = []
+        for _ in range(rng.randint(1, 4)):
+            measurements = [stim.target_rec(-rng.randint(1, nm + 2)) for _ in range(rng.randint(0, 2))] if nm else []
+            rules.append((_random_paulis(rng, num_qubits), _random_paulis(rng, num_qubits), measurements))
+        expected = _failing_unsigned_stabilizers_by_case_circuits(circuit, rules, q2i={})
+        assert _failing_unsigned_stabilizers_batched(circuit, rules, q2i={}) == expected, (circuit, rules)
+        num_failing += len(expected)
+        num_rules += len(rules)
+    # Make sure both outcomes were covered.
+    assert 0 < num_failing < num_rules
+
+
+def test_failing_unsigned_stabilizers():
+    circuit = stim.Circuit("""
+        CX 0 1
+        M 1
+    """)
+    assert failing_unsigned_stabilizers(circuit, [
+        ({"Z": [0]}, {"Z": [0]}, []),
+        ({"X": [0]}, {"X": [0]}, []),
+        ({"Z": [0, 1]}, {}, [stim.target_rec(-1)]),
+        ({"Z": [1]}, {"Z": [0, 1]}, []),
+        ({"Z": [1]}, {"Z": [1]}, []),
+        ({"X": ["a"]}, {"X": ["a"]}, []),
+    ], q2i={"a": 2}) == [1, 4]
+    assert failing_unsigned_stabilizers(circuit, []) == []
+
+
+def test_failing_unsigned_stabilizers_fallback():
+    # Products measuring the same qubit twice aren't handled by the batched analysis.
+    circuit = stim.Circuit("MPP X0*X0")
+    assert failing_unsigned_stabilizers(circuit, [({"Z": [1]}, {"Z": [1]}, [])]) == [0]
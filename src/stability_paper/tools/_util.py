@@ -1,8 +1,10 @@
-from typing import List, Callable, Iterable, TypeVar, Any, Tuple, Dict
+from typing import List, Callable, Iterable, Iterator, TypeVar, Any, Tuple, Dict, Sequence
 
 import numpy as np
 import stim
 
+from stability_paper.tools._unsigned_stabilizers import failing_unsigned_stabilizers
+
 TItem = TypeVar('TItem')
 
 
@@ -39,63 +41,10 @@ def circuit_has_unsigned_stabilizers(
     Returns:
         True: The circuit has all the requested stabilizers.
         False: The circuit is bad and should feel bad.
+
+    Use `failing_unsigned_stabilizers` to find out which of the rules the circuit doesn't have.
     """
-    if q2i is None:
-        q2i = {}
-    for before, after, measurements in stabilizers:
-        assert all(m.is_measurement_record_target for m in measurements)
-        nq = circuit.num_qubits
-        nm = circuit.num_measurements
-        for init_basis in 'YXZ':
-            offsets = [m.value for m in measurements]
-            case = stim.Circuit()
-            case.append(f"R{init_basis}", range(nq))
-
-            if before:
-                assert set("XYZ").issuperset(before.keys())
-                targets = []
-                for t in before.get("X", []):
-                    targets.append(stim.target_x(q2i.get(t, t)))
-                    targets.append(stim.target_combiner())
-                for t in before.get("Y", []):
-                    targets.append(stim.target_y(q2i.get(t, t)))
-                    targets.append(stim.target_combiner())
-                for t in before.get("Z", []):
-                    targets.append(stim.target_z(q2i.get(t, t)))
-                    targets.append(stim.target_combiner())
-                if targets:
-                    targets.pop()
-                    case.append("MPP", targets)
-                    offsets.append(-nm - 1)
-
-            case += circuit
-
-            if after:
-                assert set("XYZ").issuperset(after.keys())
-                targets = []
-                for t in after.get("X", []):
-                    targets.append(stim.target_x(q2i.get(t, t)))
-                    targets.append(stim.target_combiner())
-                for t in after.get("Y", []):
-                    targets.append(stim.target_y(q2i.get(t, t)))
-                    targets.append(stim.target_combiner())
-                for t in after.get("Z", []):
-                    targets.append(stim.target_z(q2i.get(t, t)))
-                    targets.append(stim.target_combiner())
-                if targets:
-                    targets.pop()
-                    case.append("MPP", targets)
-                    offsets.append(0)
-                    offsets = [e - 1 for e in offsets]
-
-            case.append("DETECTOR", [stim.target_rec(k) for k in offsets])
-
-            try:
-                # Verify detector is deterministic.
-                case.detector_error_model()
-            except ValueError:
-                return False
-    return True
+    return not failing_unsigned_stabilizers(circuit, stabilizers, q2i=q2i)
 
 
 def score_binomial_line(*,
@@ -107,51 +56,120 @@ def score_binomial_line(*,
                         shots: List[int],
                         errors: List[int],
                         max_likelihood_factor: float,
-                        y_distortion: Callable[[float], float] = lambda e: e) -> Any:
-    from sinter.probability_util import log_binomial
+                        y_distortion: Callable[[float], float] = lambda e: e,
+                        resolution: int = 2000,
+                        max_memory_bytes: int = 1 << 28,
+                        method: str = 'grid') -> Any:
+    """Fits a line to binomial data points, in log space, and finds the band of plausible lines.
 
-    top_left_points = []
-    bottom_right_points = []
+    Candidate lines go from a point on the top or left edge of the plotting area to a point
+    on the bottom or right edge. The edges are each divided into `resolution` points, so
+    there are roughly (2 * resolution)**2 candidate lines. Candidates are scored in chunks
+    sized to stay within `max_memory_bytes`, so the chunk size only affects memory usage,
+    not the result.
+
+    With `method='optimize'`, the candidates aren't enumerated. Instead, the most likely
+    line is found by maximizing the likelihood directly, and the plausible lines are the
+    boundary of the region within the likelihood factor (found by root finding along rays
+    from the most likely line). This is much faster and uses little memory, and agrees
+    with the grid method up to the grid's resolution.
+    """
+    return score_binomial_lines(
+        min_x_lim=min_x_lim,
+        max_x_lim=max_x_lim,
+        min_p_lim=min_p_lim,
+        max_p_lim=max_p_lim,
+        groups=[(xs, shots, errors)],
+        max_likelihood_factor=max_likelihood_factor,
+        y_distortion=y_distortion,
+        resolution=resolution,
+        max_memory_bytes=max_memory_bytes,
+        method=method,
+    )[0]
+
+
+def score_binomial_lines(*,
+                         min_x_lim: float,
+                         max_x_lim: float,
+                         min_p_lim: float,
+                         max_p_lim: float,
+                         groups: Sequence[Tuple[List[float], List[int], List[int]]],
+                         max_likelihood_factor: float,
+                         y_distortion: Callable[[float], float] = lambda e: e,
+                         resolution: int = 2000,
+                         max_memory_bytes: int = 1 << 28,
+                         method: str = 'grid') -> List[Any]:
+    """Does `score_binomial_line` for several (xs, shots, errors) groups sharing the same plot limits.
+
+    With the grid method, the candidate lines are generated once and each chunk of them is
+    scored against every group, instead of generating them again for each group. Groups
+    that share x coordinates also share the work of converting candidates into probabilities.
+
+    Returns:
+        A list with the result `score_binomial_line` would return for each group.
+    """
+    if method not in ['grid', 'optimize']:
+        raise ValueError(f"Unknown method {method!r}. Expected 'grid' or 'optimize'.")
     min_y_lim = np.log(min_p_lim)
     max_y_lim = np.log(max_p_lim)
-    n = 2000
-    for x in np.linspace(min_x_lim, max_x_lim, n):
-        top_left_points.append(x + 1j*max_y_lim)
-        bottom_right_points.append(x + 1j*min_y_lim)
-    for y in np.linspace(min_y_lim, max_y_lim, n):
-        top_left_points.append(min_x_lim + 1j*y)
-        bottom_right_points.append(max_x_lim + 1j*y)
+    log_factor = np.log(max_likelihood_factor)
+
+    if method == 'optimize':
+        fits = [
+            _fit_binomial_line_optimized(
+                min_x_lim=min_x_lim,
+                max_x_lim=max_x_lim,
+                min_y_lim=min_y_lim,
+                max_y_lim=max_y_lim,
+                xs=xs,
+                shots=shots,
+                errors=errors,
+                log_factor=log_factor,
+                resolution=resolution,
+            )
+            for xs, shots, errors in groups
+        ]
+    else:
+        fits = _fit_binomial_lines_grid(
+            min_x_lim=min_x_lim,
+            max_x_lim=max_x_lim,
+            min_y_lim=min_y_lim,
+            max_y_lim=max_y_lim,
+            groups=groups,
+            log_factor=log_factor,
+            resolution=resolution,
+            max_memory_bytes=max_memory_bytes,
+        )
+
+    return [
+        _binomial_line_result(
+            min_x_lim=min_x_lim,
+            max_x_lim=max_x_lim,
+            min_p_lim=min_p_lim,
+            max_p_lim=max_p_lim,
+            xs=xs,
+            y_distortion=y_distortion,
+            best_offset=best_offset,
+            best_slope=best_slope,
+            possible_offsets=possible_offsets,
+            possible_slopes=possible_slopes,
+        )
+        for (xs, _, _), (best_offset, best_slope, possible_offsets, possible_slopes) in zip(groups, fits)
+    ]
+
 
-    v1 = np.zeros(shape=(2*n, 2*n), dtype=np.complex64)
-    v2 = np.zeros(shape=(2*n, 2*n), dtype=np.complex64)
-    v1 += top_left_points
-    v2 += bottom_right_points
-    v2 = v2.transpose()
-    v1 = v1.flatten()
-    v2 = v2.flatten()
-    positive_slope = (np.real(v2) > np.real(v1)) & (np.imag(v2) < np.imag(v1))
-    v1 = np.copy(v1[positive_slope])
-    v2 = np.copy(v2[positive_slope])
-    dv = v2 - v1
-    di = np.imag(dv)
-    dr = np.real(dv)
-    possible_slopes = di / dr
-    possible_offsets = v1.imag - possible_slopes * v1.real
-    reasonable_offsets = possible_offsets < 100
-    possible_slopes = possible_slopes[reasonable_offsets].astype(np.float64)
-    possible_offsets = possible_offsets[reasonable_offsets].astype(np.float64)
-
-    scores = np.zeros(possible_offsets.shape, dtype=np.float64)
-    for k in range(len(xs)):
-        p = np.exp(possible_offsets + possible_slopes * xs[k])
-        scores += log_binomial(p=p, n=shots[k], hits=errors[k])
-    best_k = np.argmax(scores)
-    best_offset = possible_offsets[best_k]
-    best_slope = possible_slopes[best_k]
-    max_likelihood = scores[best_k]
-    kept = scores >= max_likelihood - np.log(max_likelihood_factor)
-    possible_offsets = np.copy(possible_offsets[kept])
-    possible_slopes = np.copy(possible_slopes[kept])
+def _binomial_line_result(*,
+                          min_x_lim: float,
+                          max_x_lim: float,
+                          min_p_lim: float,
+                          max_p_lim: float,
+                          xs: List[float],
+                          y_distortion: Callable[[float], float],
+                          best_offset: float,
+                          best_slope: float,
+                          possible_offsets: np.ndarray,
+                          possible_slopes: np.ndarray) -> Any:
+    """Returns the line to draw and the outline of the plausible lines around it."""
     xs2, ys = outline(
         min_x=min_x_lim,
         max_x=max_x_lim,
@@ -182,6 +200,240 @@ def score_binomial_line(*,
     return [x1, x2], [np.exp(y1), np.exp(y2)], xs2, ys
 
 
+class _KeptLines:
+    """The most likely line seen so far, and the lines within the likelihood factor of it."""
+
+    def __init__(self, log_factor: float):
+        self.log_factor = log_factor
+        self.best_offset = None
+        self.best_slope = None
+        self.max_likelihood = None
+        self.offsets = []
+        self.slopes = []
+        self.scores = []
+
+    def add(self, offsets: np.ndarray, slopes: np.ndarray, scores: np.ndarray) -> None:
+        best_k = np.argmax(scores)
+        if self.max_likelihood is None or scores[best_k] > self.max_likelihood:
+            self.best_offset = offsets[best_k]
+            self.best_slope = slopes[best_k]
+            self.max_likelihood = scores[best_k]
+            # Forget previously kept lines that are no longer within the likelihood factor.
+            for k in range(len(self.scores)):
+                still_kept = self.scores[k] >= self.max_likelihood - self.log_factor
+                self.offsets[k] = self.offsets[k][still_kept]
+                self.slopes[k] = self.slopes[k][still_kept]
+                self.scores[k] = self.scores[k][still_kept]
+        kept = scores >= self.max_likelihood - self.log_factor
+        self.offsets.append(offsets[kept])
+        self.slopes.append(slopes[kept])
+        self.scores.append(scores[kept])
+
+
+def _fit_binomial_lines_grid(*,
+                             min_x_lim: float,
+                             max_x_lim: float,
+                             min_y_lim: float,
+                             max_y_lim: float,
+                             groups: Sequence[Tuple[List[float], List[int], List[int]]],
+                             log_factor: float,
+                             resolution: int,
+                             max_memory_bytes: int) -> List[Tuple[float, float, np.ndarray, np.ndarray]]:
+    """Returns the most likely candidate line and the candidate lines within the likelihood factor, per group."""
+    kept_lines = [_KeptLines(log_factor) for _ in groups]
+    num_distinct_xs = len({x for xs, _, _ in groups for x in xs})
+    for possible_offsets, possible_slopes in _iter_candidate_lines(
+            min_x_lim=min_x_lim,
+            max_x_lim=max_x_lim,
+            min_y_lim=min_y_lim,
+            max_y_lim=max_y_lim,
+            resolution=resolution,
+            max_memory_bytes=max_memory_bytes,
+            extra_bytes_per_candidate=8 * (len(groups) + num_distinct_xs)):
+        if not len(possible_offsets):
+            continue
+        all_scores = _score_line_groups(offsets=possible_offsets, slopes=possible_slopes, groups=groups)
+        for kept, scores in zip(kept_lines, all_scores):
+            kept.add(possible_offsets, possible_slopes, scores)
+    return [
+        (kept.best_offset, kept.best_slope, np.concatenate(kept.offsets), np.concatenate(kept.slopes))
+        for kept in kept_lines
+    ]
+
+
+def _fit_binomial_line_optimized(*,
+                                 min_x_lim: float,
+                                 max_x_lim: float,
+                                 min_y_lim: float,
+                                 max_y_lim: float,
+                                 xs: List[float],
+                                 shots: List[int],
+                                 errors: List[int],
+                                 log_factor: float,
+                                 resolution: int,
+                                 num_rays: int = 1024) -> Tuple[float, float, np.ndarray, np.ndarray]:
+    """Returns the most likely line, and lines around the boundary of the region within the likelihood factor.
+
+    Lines are restricted to the same region the grid method covers: decreasing lines that cross
+    the plotting area, with offsets below 100 and slopes no steeper than the grid's steepest line.
+    The log likelihood is concave in (offset, slope), so the constrained region within the
+    likelihood factor is convex and rays from the most likely line cross its boundary once.
+    """
+    import scipy.optimize
+
+    xs_arr = np.array(xs, dtype=np.float64)
+    shots_arr = np.array(shots, dtype=np.float64)
+    hits_arr = np.array(errors, dtype=np.float64)
+    misses_arr = shots_arr - hits_arr
+    min_slope = (min_y_lim - max_y_lim) / ((max_x_lim - min_x_lim) / (resolution - 1))
+    max_offset = 100
+
+    def log_likelihood(offsets: np.ndarray, slopes: np.ndarray) -> np.ndarray:
+        """The log likelihood of the data, up to a constant, for each line."""
+        result = np.zeros(np.shape(offsets), dtype=np.float64)
+        for k in range(len(xs_arr)):
+            # Clamp log(p) below 0 to avoid log(0) warnings; p=1 is still vastly unlikely.
+            log_p = np.minimum(offsets + slopes * xs_arr[k], -1e-300)
+            if hits_arr[k]:
+                result += log_p * hits_arr[k]
+            if misses_arr[k]:
+                result += np.log(-np.expm1(log_p)) * misses_arr[k]
+        return result
+
+    def offset_range(slope: float) -> Tuple[float, float]:
+        lo = min_y_lim - slope * min_x_lim
+        hi = min(max_offset, max_y_lim - slope * max_x_lim)
+        return lo, hi
+
+    def best_offset_for(slope: float) -> float:
+        lo, hi = offset_range(slope)
+        if lo >= hi:
+            return lo
+        return scipy.optimize.minimize_scalar(
+            lambda offset: -log_likelihood(offset, slope),
+            bounds=(lo, hi),
+            method='bounded',
+            options={'xatol': 1e-10},
+        ).x
+
+    # Maximize the profile likelihood over the slope.
+    best_slope = scipy.optimize.minimize_scalar(
+        lambda slope: -log_likelihood(best_offset_for(slope), slope),
+        bounds=(min_slope, 0),
+        method='bounded',
+        options={'xatol': 1e-10},
+    ).x
+    best_offset = best_offset_for(best_slope)
+    threshold = log_likelihood(best_offset, best_slope) - log_factor
+
+    # Cast rays from the most likely line, in terms of the line's values at two reference x positions.
+    x1 = np.min(xs_arr)
+    x2 = max(np.max(xs_arr), x1 + 1)
+    angles = np.linspace(0, 2 * np.pi, num_rays, endpoint=False)
+    d_slopes = (np.sin(angles) - np.cos(angles)) / (x2 - x1)
+    d_offsets = np.cos(angles) - d_slopes * x1
+
+    # Distance along each ray until leaving the allowed region, from constraints of the form
+    # `c_offset * offset + c_slope * slope <= bound`.
+    constraints = [
+        (-1, -min_x_lim, -min_y_lim),
+        (1, max_x_lim, max_y_lim),
+        (1, 0, max_offset),
+        (0, 1, 0),
+        (0, -1, -min_slope),
+    ]
+    t_max = np.full(num_rays, np.inf)
+    for c_offset, c_slope, bound in constraints:
+        slack = max(bound - (c_offset * best_offset + c_slope * best_slope), 0)
+        rate = c_offset * d_offsets + c_slope * d_slopes
+        with np.errstate(divide='ignore'):
+            t_max = np.where(rate > 0, np.minimum(t_max, slack / rate), t_max)
+
+    # Bisect for where each ray leaves the region within the likelihood factor.
+    lo = np.zeros(num_rays)
+    hi = t_max
+    for _ in range(64):
+        mid = (lo + hi) / 2
+        inside = log_likelihood(best_offset + d_offsets * mid, best_slope + d_slopes * mid) >= threshold
+        lo = np.where(inside, mid, lo)
+        hi = np.where(inside, hi, mid)
+    inside = log_likelihood(best_offset + d_offsets * t_max, best_slope + d_slopes * t_max) >= threshold
+    t = np.where(inside, t_max, lo)
+    offsets = np.concatenate([[best_offset], best_offset + d_offsets * t])
+    slopes = np.concatenate([[best_slope], best_slope + d_slopes * t])
+    return best_offset, best_slope, offsets, slopes
+
+
+def _iter_candidate_lines(*,
+                          min_x_lim: float,
+                          max_x_lim: float,
+                          min_y_lim: float,
+                          max_y_lim: float,
+                          resolution: int,
+                          max_memory_bytes: int,
+                          extra_bytes_per_candidate: int = 0) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Yields the (offsets, slopes) of candidate lines, a chunk at a time.
+
+    Candidate lines connect a point on the top or left edge to a point on the bottom or right
+    edge, and have positive slope. Arithmetic is done in single precision (then converted to
+    double precision) and candidates are yielded in order of their bottom/right point then
+    their top/left point, regardless of chunk size.
+    """
+    n = resolution
+    top_left_points = []
+    bottom_right_points = []
+    for x in np.linspace(min_x_lim, max_x_lim, n):
+        top_left_points.append(x + 1j*max_y_lim)
+        bottom_right_points.append(x + 1j*min_y_lim)
+    for y in np.linspace(min_y_lim, max_y_lim, n):
+        top_left_points.append(min_x_lim + 1j*y)
+        bottom_right_points.append(max_x_lim + 1j*y)
+    top_left_points = np.array(top_left_points).astype(np.complex64)
+    bottom_right_points = np.array(bottom_right_points).astype(np.complex64)
+
+    # Rough peak number of bytes used per candidate line while it's being created and scored.
+    bytes_per_candidate = 128 + extra_bytes_per_candidate
+    rows_per_chunk = max(1, max_memory_bytes // (bytes_per_candidate * 2 * n))
+    for row_start in range(0, 2 * n, rows_per_chunk):
+        rows = bottom_right_points[row_start:row_start + rows_per_chunk]
+        v1 = np.tile(top_left_points, len(rows))
+        v2 = np.repeat(rows, 2 * n)
+        positive_slope = (np.real(v2) > np.real(v1)) & (np.imag(v2) < np.imag(v1))
+        v1 = v1[positive_slope]
+        v2 = v2[positive_slope]
+        dv = v2 - v1
+        di = np.imag(dv)
+        dr = np.real(dv)
+        possible_slopes = di / dr
+        possible_offsets = v1.imag - possible_slopes * v1.real
+        reasonable_offsets = possible_offsets < 100
+        yield (
+            possible_offsets[reasonable_offsets].astype(np.float64),
+            possible_slopes[reasonable_offsets].astype(np.float64),
+        )
+
+
+def _score_line_groups(*,
+                       offsets: np.ndarray,
+                       slopes: np.ndarray,
+                       groups: Sequence[Tuple[List[float], List[int], List[int]]]) -> List[np.ndarray]:
+    """Returns the log likelihood of each group's binomial data points, for each line."""
+    from sinter.probability_util import log_binomial
+
+    ps = {}
+    result = []
+    for xs, shots, errors in groups:
+        scores = np.zeros(offsets.shape, dtype=np.float64)
+        for k in range(len(xs)):
+            p = ps.get(xs[k])
+            if p is None:
+                p = np.exp(offsets + slopes * xs[k])
+                ps[xs[k]] = p
+            scores += log_binomial(p=p, n=shots[k], hits=errors[k])
+        result.append(scores)
+    return result
+
+
 def outline(*,
             min_y: float,
             max_y: float,
@@ -210,13 +462,15 @@ def outline(*,
     rot_slopes = (in2s.imag - in1s.imag) / (in2s.real - in1s.real)
     rot_offsets = in1s.imag - rot_slopes * in1s.real
 
-    outs1 = []
-    outs2 = []
-    for x in np.linspace(np.min(np.real(corners)), np.max(np.real(corners)), 128):
-        vs = rot_offsets + rot_slopes * x
-        outs1.append(x + 1j*np.min(vs))
-        outs2.append(x + 1j*np.max(vs))
-    outs = np.array(outs1 + outs2[::-1], dtype=np.complex128)
+    xs = np.linspace(np.min(np.real(corners)), np.max(np.real(corners)), 128)
+    lows = np.full(len(xs), np.inf)
+    highs = np.full(len(xs), -np.inf)
+    chunk = 1 << 14
+    for start in range(0, len(rot_offsets), chunk):
+        vs = rot_offsets[start:start + chunk, np.newaxis] + rot_slopes[start:start + chunk, np.newaxis] * xs
+        lows = np.minimum(lows, np.min(vs, axis=0))
+        highs = np.maximum(highs, np.max(vs, axis=0))
+    outs = np.concatenate([xs + 1j*lows, (xs + 1j*highs)[::-1]])
     outs *= ref
     outs += best_offset * 1j
     return np.real(outs), np.imag(outs)
@@ -1,8 +1,10 @@
+import numpy as np
+import pytest
 import sinter
 import stim
 
 from stability_paper.tools._util import circuit_has_unsigned_stabilizers, \
-    score_binomial_line
+    score_binomial_line, score_binomial_lines
 
 
 def test_circuit_has_unsigned_stabilizers():
@@ -70,3 +72,60 @@ def test_score_binomial_line():
     )
     assert 0 < b[0] < 10**10
     assert 0 < b[1] < 10**10
+
+
+def test_score_binomial_line_chunking_does_not_change_result():
+    kwargs = dict(
+        min_x_lim=0,
+        max_x_lim=30,
+        min_p_lim=1e-6,
+        max_p_lim=0.5,
+        xs=[3, 5, 7, 9],
+        shots=[10000] * 4,
+        errors=[800, 200, 50, 12],
+        max_likelihood_factor=1000,
+        resolution=200,
+    )
+    expected = score_binomial_line(**kwargs, max_memory_bytes=1 << 30)
+    for max_memory_bytes in [1, 1 << 16, 1 << 20]:
+        actual = score_binomial_line(**kwargs, max_memory_bytes=max_memory_bytes)
+        for a, e in zip(actual, expected):
+            np.testing.assert_array_equal(a, e)
+
+
+def test_score_binomial_line_optimize_matches_grid():
+    kwargs = dict(
+        min_x_lim=0,
+        max_x_lim=20,
+        min_p_lim=1e-8,
+        max_p_lim=1,
+        xs=[2, 4, 6, 8, 10],
+        shots=[10**5, 10**5, 10**6, 10**6, 10**7],
+        errors=[3000, 400, 500, 70, 100],
+        max_likelihood_factor=1000,
+    )
+    grid = score_binomial_line(**kwargs, resolution=1000)
+    optimized = score_binomial_line(**kwargs, method='optimize')
+    np.testing.assert_allclose(grid[0], optimized[0])
+    np.testing.assert_allclose(np.log(grid[1]), np.log(optimized[1]), atol=0.05)
+    np.testing.assert_allclose(grid[2], optimized[2], atol=0.05)
+    np.testing.assert_allclose(grid[3], optimized[3], atol=0.05)
+
+    with pytest.raises(ValueError, match='method'):
+        score_binomial_line(**kwargs, method='other')
+
+
+def test_score_binomial_lines_matches_score_binomial_line():
+    limits = dict(min_x_lim=0, max_x_lim=30, min_p_lim=1e-6, max_p_lim=0.5, max_likelihood_factor=1000, resolution=200)
+    groups = [
+        ([3, 5, 7, 9], [10000] * 4, [800, 200, 50, 12]),
+        ([3, 5, 7], [10000, 20000, 40000], [1500, 900, 400]),
+        ([4, 8], [1000, 1000], [0, 0]),
+    ]
+    for method in ['grid', 'optimize']:
+        batch = score_binomial_lines(**limits, groups=groups, method=method)
+        assert len(batch) == len(groups)
+        for (xs, shots, errors), actual in zip(groups, batch):
+            expected = score_binomial_line(**limits, xs=xs, shots=shots, errors=errors, method=method)
+            for a, e in zip(actual, expected):
+                np.testing.assert_array_equal(a, e)
@@ -8,7 +8,7 @@ PROCESSES=$3
 DECODER=$4
 
 if [ -z "${CIRCUIT_DIR}" ]; then
-  echo "First arg must be the circuits directory."
+  echo "First arg must be the circuits directory (or a circuit bundle file)."
   exit 1
 fi
 if [ -z "${OUT_CSV}" ]; then
@@ -24,6 +24,17 @@ if [ -z "${DECODER}" ]; then
   exit 1
 fi
 
+if [ -f "${CIRCUIT_DIR}" ]; then
+  PYTHONPATH=src python3 src/stability_paper/scripts/collect_stats.py \
+      --bundles "${CIRCUIT_DIR}" \
+      --decoders "${DECODER}" \
+      --max_shots 100_000_000 \
+      --max_errors 1000 \
+      --save_resume_filepath "${OUT_CSV}" \
+      --processes "${PROCESSES}"
+  exit 0
+fi
+
 sinter collect \
     --circuits "${CIRCUIT_DIR}"/*.stim \
     --metadata_func "sinter.comma_separated_key_values(path)" \